@@ -0,0 +1,188 @@
+"""
+Batch installs
+"""
+
+import logging
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cbdep.scheduler import DEFAULT_JOBS, DependencyGraph
+
+logger = logging.getLogger("cbdep")
+
+
+class BatchInstaller:
+    """
+    Installs a list of packages using a single parsed configuration.
+    All descriptor blocks, including those of nested 'cbdep' installs, are
+    resolved before anything is downloaded, then all 'url' actions are
+    downloaded concurrently, and finally the packages are installed,
+    concurrently except where they share nested installs or run commands
+    (see DependencyGraph.run()).
+    """
+
+    def __init__(self, installer, jobs=DEFAULT_JOBS):
+        """
+        "installer" is a template Installer whose configuration, cache,
+        platforms, arches and options are used for every package; "jobs"
+        is the maximum number of concurrent downloads and installs.
+        """
+
+        self.installer = installer
+        self.jobs = max(1, jobs)
+        self.items = []
+
+    @staticmethod
+    def parse_manifest(manifest, default_dir):
+        """
+        Converts a loaded manifest (a list of mappings with keys
+        'package', 'version' and optionally 'dir', 'base_url' and
+        'cbdeps') into a list of argument dictionaries for add().
+        Entries without a 'dir' are installed into default_dir.
+        """
+
+        if isinstance(manifest, dict):
+            manifest = manifest.get("packages")
+        if not isinstance(manifest, list):
+            logger.error("Malformed manifest (expected a list of packages)")
+            sys.exit(1)
+
+        entries = []
+        for entry in manifest:
+            if not isinstance(entry, dict) \
+                    or "package" not in entry or "version" not in entry:
+                logger.error(f"Malformed manifest entry: {entry}")
+                sys.exit(1)
+            entries.append({
+                "package": entry["package"],
+                "version": str(entry["version"]),
+                "install_dir": entry.get("dir", default_dir),
+                "base_url": entry.get("base_url"),
+                "force_cbdeps": entry.get("cbdeps", False),
+            })
+
+        return entries
+
+    def add(self, package, version, install_dir, base_url=None,
+            force_cbdeps=False):
+        """
+        Queue a package for installation. Identical requests are only
+        installed once.
+        """
+
+        install_dir = os.path.abspath(install_dir)
+        item = (package, version, install_dir, base_url, force_cbdeps)
+        if item in self.items:
+            logger.debug(f"Skipping duplicate request for {package} {version}")
+            return
+        self.items.append(item)
+
+    def install(self):
+        """
+        Resolve, download and install all queued packages
+        """
+
+        # Resolve everything first so that configuration errors are
+        # reported before any time is spent downloading. (Nested installs
+        # are skipped in cache-only mode, as by Installer.install().)
+        graph = DependencyGraph(
+            self.installer, include_nested=not self.installer.cache_only)
+        for package, version, install_dir, base_url, force_cbdeps \
+                in self.items:
+            graph.add(package, version, install_dir, base_url, force_cbdeps)
+
+        # Download everything concurrently
+        logger.info(
+            f"Downloading files for {len(graph.nodes)} packages "
+            f"({self.jobs} at a time)"
+        )
+        graph.fetch(self.jobs)
+
+        if self.installer.cache_only:
+            return
+
+        # Finally run the install actions; all 'url' actions will now be
+        # cache hits
+        for node in graph.nodes.values():
+            node.installer.set_recache(False)
+        graph.run(self.jobs)
+
+
+class Prefetcher:
+    """
+    Downloads the files needed to install a list of packages into the
+    cache, without installing anything, for any number of target systems.
+    Each target is a tuple of (list of platforms, list of arches), as
+    would be introspected on that system. All the packages, and their
+    nested 'cbdep' installs, are resolved for every target before
+    everything is downloaded concurrently. Packages which aren't
+    available for a target are skipped.
+    """
+
+    def __init__(self, installer, targets, jobs=DEFAULT_JOBS):
+        """
+        "installer" is a template Installer whose configuration, cache and
+        options are used; "targets" is the list of targets; "jobs" is the
+        maximum number of concurrent downloads.
+        """
+
+        self.installer = installer
+        self.targets = targets
+        self.jobs = max(1, jobs)
+        self.items = []
+
+    def add(self, package, version, base_url=None, force_cbdeps=False):
+        """
+        Queue a package for prefetching. Identical requests are only
+        prefetched once.
+        """
+
+        item = (package, str(version), base_url, force_cbdeps)
+        if item not in self.items:
+            self.items.append(item)
+
+    def prefetch(self, install_dir):
+        """
+        Resolve and download all queued packages for all targets. Some
+        descriptors refer to the install directory "install_dir", but
+        nothing is written there. Returns the number of (package, target)
+        combinations skipped as unavailable.
+        """
+
+        nodes = []
+        skipped = 0
+        for platforms, arches in self.targets:
+            template = self.installer.copy()
+            template.platforms = list(platforms)
+            template.arches = list(arches)
+            template.set_recache(self.installer.recache)
+            template.set_force(True)
+            graph = DependencyGraph(template)
+            for package, version, base_url, force_cbdeps in self.items:
+                # Packages may not exist for every target, but any other
+                # problem (eg. an unknown package) is an error as usual
+                key = graph.add(package, version, install_dir, base_url,
+                                force_cbdeps, required=False)
+                if key is None:
+                    logger.warning(
+                        f"Skipping {package} {version}, which is not "
+                        f"available for {','.join(platforms)}/"
+                        f"{','.join(arches)}"
+                    )
+                    skipped += 1
+            nodes.extend(graph.nodes.values())
+
+        logger.info(
+            f"Prefetching files for {len(nodes)} packages "
+            f"({self.jobs} at a time)"
+        )
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [
+                executor.submit(node.installer.fetch_block, node.block)
+                for node in nodes
+            ]
+            for future in futures:
+                future.result()
+        return skipped
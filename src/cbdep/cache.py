@@ -7,13 +7,53 @@ import logging
 import os
 import pathlib
 import re
-import requests
 import shutil
+import threading
+import time
 import urllib.parse
 
+from concurrent.futures import ThreadPoolExecutor
+
+from cbdep.cache_index import CacheIndex
+from cbdep.locking import FileLock
+
 # Set up logging and handler
 logger = logging.getLogger('cbdep')
 
+# Default HTTP connection settings
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_CONNECT_TIMEOUT = 30.0
+DEFAULT_READ_TIMEOUT = 30.0
+
+# Size of each read from the network when downloading
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Files at least this large may be downloaded in concurrent segments
+DEFAULT_SEGMENT_THRESHOLD = 64 * 1024 * 1024
+
+# Cache eviction policies: least-recently-used and least-frequently-used
+GC_POLICIES = ["lru", "lfu"]
+
+# Unreferenced blobs younger than this (in seconds) are not removed
+GC_GRACE_PERIOD = 60 * 60
+
+# Supported checksum algorithms, keyed by the length of their hex digests
+CHECKSUM_ALGORITHMS = {64: "sha256", 128: "sha512"}
+
+# URLs found to be missing (in seconds) are not retried for this long
+DEFAULT_MISSING_TTL = 24 * 60 * 60
+
+# HTTP status codes which mark a URL as missing
+MISSING_STATUS_CODES = (404, 410)
+
+
+class ChecksumError(Exception):
+    """
+    Raised when downloaded content does not match its expected checksum
+    """
+
 
 class Cache:
     """
@@ -22,39 +62,187 @@ class Cache:
     Local cache directory structure is keyed on an MD5 checksum of the
     URL, and contains directories named:
         <first 2 chars of checksum> / <checksum> /
-    In each directory will be three files:
+    In each directory will be four files:
         url - contains the input URL
         filename - contains the filename associated with the download
         [filename] - contains the downloaded contents
+        sha256 - contains the SHA-256 digest of the contents
+    An interrupted download additionally leaves:
+        download.part - the partially-downloaded contents
+        download.validator - the ETag or Last-Modified value of the
+            partial contents, used to resume the download
+
+    The contents themselves are stored once per SHA-256 digest in
+        blobs / <first 2 chars of digest> / <digest>
+    and [filename] is a hard link to that blob, so the same content
+    downloaded from several URLs only occupies disk space once. (Where
+    hard links are not supported, [filename] is a copy.)
+
+    Every entry is also recorded, along with its size, digest and usage
+    statistics, in the CacheIndex "index.log", so cache hits and cache
+    listings do not need to probe the directory tree.
+
+    A second CacheIndex, "aliases.log", records facts about URLs rather
+    than contents: for a URL which was one of several alternatives, the
+    alternative which was actually downloaded ("target"), and for a URL
+    which returned 404 or 410, the time that was discovered ("missing").
+
+    Optionally, the cache also keeps pristine unpacked copies of archives,
+    in
+        trees / <first 2 chars of digest> / <digest> / <key>
+    where <digest> is the SHA-256 digest of the archive and <key> is
+    chosen by the caller to identify how it was unpacked. gc() removes
+    the trees of archives which are no longer in the blob store.
+
+    The cache may be shared by several processes. Each URL has a lock file
+        locks / <first 2 chars of checksum> / <checksum>.lock
+    held while it is downloaded, so concurrent requests for the same URL
+    wait for a single download; and all files are published by atomic
+    renames, so readers never see partially-written contents.
+
+    All downloads share a single HTTP session, so connections to the same
+    host are kept alive and reused.
     """
 
-    def __init__(self, directory):
+    def __init__(self, directory, pool_size=DEFAULT_POOL_SIZE,
+                 retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, segments=1,
+                 segment_threshold=DEFAULT_SEGMENT_THRESHOLD,
+                 max_size=None, max_age=None, policy="lru",
+                 missing_ttl=DEFAULT_MISSING_TTL):
         """
-        Initialize a cache based at the specified directory
+        Initialize a cache based at the specified directory. "pool_size"
+        is the number of connections kept alive per host; "retries" and
+        "backoff" control retrying of failed connections and transient
+        server errors; "connect_timeout" and "read_timeout" are in seconds.
+        Downloads of at least "segment_threshold" bytes are split into
+        "segments" concurrent ranged requests, if the server allows it.
+        gc() evicts entries unused for "max_age" seconds, and then entries
+        chosen by "policy" ("lru" or "lfu") until the cache is no larger
+        than "max_size" bytes. URLs which were missing on the server are
+        reported by is_missing() for "missing_ttl" seconds.
         """
         self.directory = pathlib.Path(directory)
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = (connect_timeout, read_timeout)
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.max_size = max_size
+        self.max_age = max_age
+        if policy not in GC_POLICIES:
+            raise ValueError(f"Unknown cache eviction policy {policy}")
+        self.policy = policy
+        self.missing_ttl = missing_ttl
+        self.index = CacheIndex(self.directory / "index.log")
+        self.aliases = CacheIndex(self.directory / "aliases.log")
+        self._index_lock = threading.Lock()
+        self._index_checked = False
+        self._session = None
+        self._session_lock = threading.Lock()
 
-    def get(self, url, recache=False):
+    @property
+    def session(self):
+        """
+        Returns the shared requests.Session, creating it on first use
+        """
+
+        with self._session_lock:
+            if self._session is None:
+                # requests is slow to import, and many commands don't
+                # need it
+                import requests
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=self.backoff,
+                    status_forcelist=[429, 500, 502, 503, 504],
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size,
+                    max_retries=retry
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+
+        return self._session
+
+    def get(self, url, recache=False, checksum=None, sink=None):
         """
         Downloads url (if necessary), saves in local cache. If recache is
-        True, will always re-download the url.
+        True, will always re-download the url. If checksum is specified,
+        it is an (algorithm, hex digest) tuple which the contents must
+        match; a cached file which does not match is re-downloaded, and
+        a download which does not match raises ChecksumError.
+
+        If sink is specified and the whole of url is downloaded in a
+        single stream, sink.write() is called with each chunk of the
+        contents as it arrives, followed by sink.close(). (It is not
+        called at all for cache hits or resumed downloads.)
         """
 
-        cachedir = self._cachedir(url)
-        cachefilename = self._cachefilename(cachedir)
+        if not recache:
+            cachefile = self.lookup(url)
+            if cachefile is not None and self._verify(url, cachefile, checksum):
+                logger.debug(f"Cache hit for {url}")
+                self.index.touch(url, time.time())
+                return cachefile
 
-        # If "filename" file exists, it's a hit; read the actual filename
-        # from there and return the cached content file
-        if cachefilename.exists() and not recache:
-            logger.debug(f"Cache hit for {url}")
-            with open(cachefilename) as f:
-                filename = f.readline()
-                return cachedir / filename
+        # Only one process or thread downloads a given URL at a time;
+        # any others wait for it and then use its download
+        with FileLock(self._lockpath(url)) as lock:
+            if lock.waited:
+                cachefile = self.lookup(url)
+                if cachefile is not None \
+                        and self._verify(url, cachefile, checksum):
+                    logger.debug(f"Using concurrent download of {url}")
+                    return cachefile
+            return self._download(url, recache, checksum, sink)
+
+    def _download(self, url, recache, checksum, sink=None):
+        """
+        Downloads url into the cache, verifying checksum if specified.
+        Caller must hold the entry's lock.
+        """
 
-        # Cache miss; attempt to download the URL
-        with requests.get(url, allow_redirects=True, stream=True,
-                          timeout=30.0) as r:
+        cachedir = self._cachedir(url, create=False)
+
+        # Cache miss; attempt to download the URL. The download goes to
+        # a partial file which is only renamed into place once complete.
+        partfile = cachedir / "download.part"
+        validatorfile = cachedir / "download.validator"
+        if recache:
+            self._discard_partial(cachedir)
+
+        # If a previous download was interrupted, try to resume it
+        offset = 0
+        validator = None
+        headers = {}
+        if partfile.exists() and validatorfile.exists():
+            offset = partfile.stat().st_size
+            validator = validatorfile.read_text()
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+
+        with self.session.get(url, allow_redirects=True, stream=True,
+                              timeout=self.timeout, headers=headers) as r:
+            if r.status_code == 416:
+                # The partial file is not a prefix of the current content
+                r.close()
+                self._discard_partial(cachedir)
+                return self._download(url, recache, checksum, sink)
+            if r.status_code in MISSING_STATUS_CODES:
+                self._set_missing(url, time.time())
             r.raise_for_status()
+            self._cachedir(url)
 
             # Determine download filename
             filename = None
@@ -65,27 +253,216 @@ class Cache:
                     filename = filenames[0]
             if filename is None:
                 filename = os.path.basename(urllib.parse.urlparse(url).path)
-            logger.info(f"Caching {url} ({filename})")
 
-            cachefile = cachedir / filename
+            # The server will ignore the range request (and send the whole
+            # file) if the content has changed since the partial download
+            content_range = r.headers.get('content-range', '')
+            if r.status_code != 206 \
+                    or not content_range.startswith(f"bytes {offset}-"):
+                offset = 0
+            if offset > 0:
+                logger.info(f"Resuming {url} ({filename}) at byte {offset}")
+            else:
+                logger.info(f"Caching {url} ({filename})")
+
+                # Remember how to recognize this content if we need to
+                # resume the download later
+                validator = r.headers.get('etag') \
+                    or r.headers.get('last-modified')
+                if validator is not None and validator.startswith("W/"):
+                    validator = None
+                if validator is not None:
+                    validatorfile.write_text(validator)
+                elif validatorfile.exists():
+                    validatorfile.unlink()
+
+            segmented = offset == 0 and validator is not None \
+                and self._can_segment(r)
+            # Compute the content address, and the checksum to verify (if
+            # different), while downloading
+            digests = {"sha256": hashlib.sha256()}
+            if checksum is not None:
+                digests.setdefault(checksum[0], hashlib.new(checksum[0]))
             try:
                 # Download file
-                with open(cachefile, 'wb') as fd:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        fd.write(chunk)
-
-                self._writefilename(cachedir, filename)
+                with open(partfile, 'r+b' if offset > 0 else 'wb') as fd:
+                    if segmented:
+                        r.close()
+                        self._stream_segments(
+                            url, fd, int(r.headers['content-length']),
+                            validator
+                        )
+                        self._hash_file(partfile, *digests.values())
+                    else:
+                        if offset > 0:
+                            self._hash_file(partfile, *digests.values())
+                        fd.seek(offset)
+                        self._stream(r, fd, digests.values(),
+                                     sink if offset == 0 else None)
 
             except:
-                if cachefile.exists():
-                    cachefile.unlink()
-                if cachefilename.exists():
-                    cachefilename.unlink()
+                # Keep the partial file for resuming later, if possible
+                if segmented or not validatorfile.exists():
+                    self._discard_partial(cachedir)
                 raise
 
-        logger.debug("Downloaded file")
+        hexdigests = {
+            name: digest.hexdigest() for name, digest in digests.items()
+        }
+        if checksum is not None:
+            algorithm, expected = checksum
+            if hexdigests[algorithm] != expected:
+                self._discard_partial(cachedir)
+                raise ChecksumError(
+                    f"{algorithm} checksum mismatch for {url}: "
+                    f"expected {expected}, got {hexdigests[algorithm]}"
+                )
+            logger.debug(f"Verified {algorithm} checksum of {url}")
+
+        sha256 = hexdigests.pop("sha256")
+        cachefile = self._store(
+            url, cachedir, partfile, filename, sha256, hexdigests)
+        if validatorfile.exists():
+            validatorfile.unlink()
+
         return cachefile
 
+    def _stream(self, r, fd, digests, sink=None):
+        """
+        Writes the body of streaming response r to the open file fd at its
+        current position, updating each of the hashlib objects "digests"
+        with each chunk (and passing it to sink, if specified), and reports
+        the download throughput. Returns the number of bytes written.
+        """
+
+        self._preallocate(r, fd)
+
+        start = time.monotonic()
+        size = 0
+        try:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                fd.write(chunk)
+                for digest in digests:
+                    digest.update(chunk)
+                if sink is not None:
+                    sink.write(chunk)
+                size += len(chunk)
+        finally:
+            # Discard any preallocated space beyond what was actually
+            # received, so an interrupted download can be resumed
+            fd.truncate()
+
+        if sink is not None:
+            sink.close()
+        self._report_throughput(size, start)
+        return size
+
+    def _can_segment(self, r):
+        """
+        Returns True if the body of response r is large enough to be worth
+        downloading in several concurrent ranged segments, and the server
+        supports that. The caller must also have a strong validator (ETag
+        or Last-Modified) for the content.
+        """
+
+        if self.segments < 2 or not hasattr(os, 'pwrite'):
+            return False
+        length = r.headers.get('content-length')
+        return length is not None \
+            and int(length) >= self.segment_threshold \
+            and r.headers.get('accept-ranges') == 'bytes' \
+            and r.headers.get('content-encoding', 'identity') == 'identity'
+
+    def _stream_segments(self, url, fd, length, validator):
+        """
+        Downloads url into the open file fd using self.segments concurrent
+        ranged requests, each writing directly to its own region of the
+        file. "validator" is the ETag or Last-Modified value of the
+        original response, ensuring all segments come from the same content.
+        """
+
+        segment_size = -(-length // self.segments)
+        logger.debug(
+            f"Downloading {length} bytes in {self.segments} segments"
+        )
+        fd.truncate(length)
+
+        def fetch(first, last):
+            headers = {
+                "Range": f"bytes={first}-{last}",
+                "If-Range": validator
+            }
+            with self.session.get(url, allow_redirects=True, stream=True,
+                                  timeout=self.timeout,
+                                  headers=headers) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise IOError(f"Server did not honor range request for {url}")
+                position = first
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    os.pwrite(fd.fileno(), chunk, position)
+                    position += len(chunk)
+                if position != last + 1:
+                    raise IOError(f"Incomplete segment download for {url}")
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.segments) as executor:
+            futures = [
+                executor.submit(
+                    fetch, first, min(first + segment_size, length) - 1
+                )
+                for first in range(0, length, segment_size)
+            ]
+            for future in futures:
+                future.result()
+
+        self._report_throughput(length, start)
+
+    @staticmethod
+    def _report_throughput(size, start):
+        """
+        Logs the throughput of a download of "size" bytes which began at
+        time.monotonic() value "start"
+        """
+
+        elapsed = max(time.monotonic() - start, 0.001)
+        megabytes = size / (1024 * 1024)
+        logger.info(
+            f"Downloaded {megabytes:.1f} MiB in {elapsed:.1f}s "
+            f"({megabytes / elapsed:.1f} MiB/s)"
+        )
+
+    @staticmethod
+    def _preallocate(r, fd):
+        """
+        If the size of the response r is known in advance, reserve that
+        much space for the open file fd (from its current position) to
+        reduce fragmentation. This is only an optimization, so any failure
+        is ignored.
+        """
+
+        length = r.headers.get('content-length')
+        encoding = r.headers.get('content-encoding', 'identity')
+        if length is None or encoding != 'identity' \
+                or not hasattr(os, 'posix_fallocate'):
+            return
+
+        try:
+            os.posix_fallocate(fd.fileno(), fd.tell(), int(length))
+        except (OSError, ValueError):
+            pass
+
+    @staticmethod
+    def _discard_partial(cachedir):
+        """
+        Removes any partially-downloaded file from cachedir
+        """
+
+        for name in ["download.part", "download.validator"]:
+            partial = cachedir / name
+            if partial.exists():
+                partial.unlink()
+
     def put(self, url, localfile):
         """
         Copies the specified local pathlib handle into the cache keyed by the
@@ -96,9 +473,250 @@ class Cache:
         cachedir = self._cachedir(url)
         filename = localfile.name
 
-        logger.debug(f"Storing {localfile} in cache for {url}")
-        shutil.copy2(localfile, cachedir / filename)
-        self._writefilename(cachedir, filename)
+        # Hold the URL's lock, as get() does, so as not to disturb any
+        # download of the same URL; the local file supersedes any partial
+        # download left behind
+        with FileLock(self._lockpath(url)):
+            logger.debug(f"Storing {localfile} in cache for {url}")
+            self._discard_partial(cachedir)
+            partfile = cachedir / "download.part"
+            shutil.copy2(localfile, partfile)
+            digest = self._hash_file(partfile, hashlib.sha256())
+            return self._store(
+                url, cachedir, partfile, filename, digest.hexdigest())
+
+    def lookup(self, url):
+        """
+        Returns pathlib handle to the cached file for url, or None if url
+        is not cached. Nothing is downloaded.
+        """
+
+        self._check_index()
+        entry = self.index.get(url)
+        if entry is not None:
+            cachefile = self.directory / entry["dir"] / entry["filename"]
+            if cachefile.exists():
+                return cachefile
+            # Entry was removed behind our back
+            self.index.remove(url)
+
+        # Fall back to probing the directory tree, in case the entry was
+        # created by another process since the index was loaded
+        cachedir = self._cachedir(url, create=False)
+        cachefilename = self._cachefilename(cachedir)
+        if not cachefilename.exists():
+            return None
+        with open(cachefilename) as f:
+            cachefile = cachedir / f.readline()
+        if not cachefile.exists():
+            return None
+        self.index.update(url, **self._index_fields(cachedir, cachefile))
+        return cachefile
+
+    def alias(self, url):
+        """
+        Returns the URL recorded by set_alias() for url, or None
+        """
+
+        entry = self.aliases.get(url)
+        return entry.get("target") if entry else None
+
+    def set_alias(self, url, target):
+        """
+        Records that target is the URL actually used in place of url, eg.
+        when url is the first of several alternative URLs but target was
+        the one which could be downloaded
+        """
+
+        if self.alias(url) != target:
+            self.aliases.update(url, target=target)
+
+    def is_missing(self, url):
+        """
+        Returns True if downloading url failed with "not found" within
+        the last missing_ttl seconds
+        """
+
+        entry = self.aliases.get(url)
+        missing = entry.get("missing") if entry else None
+        return missing is not None and time.time() - missing < self.missing_ttl
+
+    def probe(self, urls):
+        """
+        Checks concurrently whether each of urls exists on its server,
+        without downloading it, and returns the first of urls (in list
+        order) which does, or None. URLs which are not found are recorded
+        as for is_missing().
+        """
+
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(len(urls), self.pool_size)))
+        try:
+            futures = [executor.submit(self._probe, url) for url in urls]
+            for url, future in zip(urls, futures):
+                if future.result():
+                    return url
+            return None
+        finally:
+            # Don't wait for probes of less-preferred URLs
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _probe(self, url):
+        """
+        Returns True if url exists. Uses a HEAD request, or a one-byte
+        ranged GET for servers which do not support HEAD.
+        """
+
+        import requests
+
+        try:
+            r = self.session.head(
+                url, allow_redirects=True, timeout=self.timeout)
+            if r.status_code in (405, 501):
+                with self.session.get(
+                        url, allow_redirects=True, stream=True,
+                        timeout=self.timeout,
+                        headers={"Range": "bytes=0-0"}) as r:
+                    pass
+        except requests.RequestException as e:
+            logger.debug(f"Probing {url} failed: {e}")
+            return False
+
+        logger.debug(f"Probing {url}: {r.status_code}")
+        if r.status_code in MISSING_STATUS_CODES:
+            self._set_missing(url, time.time())
+        return r.ok
+
+    def _set_missing(self, url, when):
+        """
+        Records that url was not found at time "when" (None to clear)
+        """
+
+        self.aliases.update(url, missing=when)
+
+    def digest(self, url):
+        """
+        Returns the SHA-256 digest of the cached file for url, or None if
+        url is not cached
+        """
+
+        if self.lookup(url) is None:
+            return None
+        return self.index.get(url).get("sha256")
+
+    def tree(self, digest, key):
+        """
+        Returns pathlib handle to the unpacked tree stored by put_tree()
+        for digest and key, or None
+        """
+
+        tree = self._treepath(digest, key)
+        return tree if tree.is_dir() else None
+
+    def put_tree(self, digest, key, source):
+        """
+        Stores directory "source", the unpacked contents of the archive
+        with SHA-256 "digest", as the tree for digest and key. source is
+        moved into the cache if possible (and copied otherwise). Returns
+        pathlib handle to the stored tree.
+        """
+
+        tree = self._treepath(digest, key)
+        tree.parent.mkdir(parents=True, exist_ok=True)
+        temp = tree.with_name(
+            f"{tree.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            os.rename(source, temp)
+        except OSError:
+            shutil.copytree(source, temp, symlinks=True)
+        try:
+            os.rename(temp, tree)
+        except OSError:
+            # Another process stored the same tree first
+            shutil.rmtree(temp, ignore_errors=True)
+        return tree
+
+    def _treepath(self, digest, key):
+        """
+        Returns pathlib handle to the tree for digest and key
+        """
+
+        return self.directory / "trees" / digest[:2] / digest / key
+
+    def _verify(self, url, cachefile, checksum):
+        """
+        Returns True if checksum is None, or if the cached file for url
+        matches checksum. Digests computed here are recorded in the index,
+        so each entry is only hashed once per algorithm.
+        """
+
+        if checksum is None:
+            return True
+
+        algorithm, expected = checksum
+        entry = self.index.get(url) or {}
+        digests = dict(entry.get("digests") or {})
+        if algorithm == "sha256":
+            actual = entry.get("sha256")
+        else:
+            actual = digests.get(algorithm)
+
+        if actual is None:
+            logger.debug(f"Computing {algorithm} checksum of {cachefile}")
+            actual = self._hash_file(
+                cachefile, hashlib.new(algorithm)).hexdigest()
+            if algorithm == "sha256":
+                self.index.update(url, sha256=actual)
+            else:
+                digests[algorithm] = actual
+                self.index.update(url, digests=digests)
+
+        if actual != expected:
+            logger.warning(
+                f"Cached {cachefile} does not match expected {algorithm} "
+                f"checksum; downloading again"
+            )
+            return False
+        return True
+
+    def entries(self):
+        """
+        Returns a list of dictionaries describing each cache entry; see
+        CacheIndex for the available fields
+        """
+
+        self._check_index()
+        return self.index.entries()
+
+    def migrate(self):
+        """
+        Moves the contents of any cache entries created before the
+        content-addressed blob store existed into the blob store,
+        replacing duplicate contents with hard links. Returns the number
+        of bytes of disk space freed.
+        """
+
+        freed = 0
+        for cachefilename in self.directory.glob("??/*/filename"):
+            cachedir = cachefilename.parent
+            if (cachedir / "sha256").exists():
+                continue
+            with open(cachefilename) as f:
+                filename = f.readline()
+            cachefile = cachedir / filename
+            if not cachefile.is_file():
+                continue
+
+            logger.info(f"Migrating {cachefile}")
+            digest = self._hash_file(cachefile, hashlib.sha256()).hexdigest()
+            blob = self._blobpath(digest)
+            if blob.exists():
+                freed += cachefile.stat().st_size
+            url = (cachedir / "url").read_text()
+            self._store(url, cachedir, cachefile, filename, digest)
+
+        logger.info(f"Migration freed {freed / (1024 * 1024):.1f} MiB")
+        return freed
 
     def report(self, url):
         """
@@ -114,16 +732,16 @@ class Cache:
 
         shutil.copy2(self.get(url), output)
 
-    def _cachedir(self, url):
+    def _cachedir(self, url, create=True):
         """
-        Returns pathlib handle to cache directory for given URL. Creates cachedir
-        if necessary, with initial "url" file entry.
+        Returns pathlib handle to cache directory for given URL. If create
+        is True, creates cachedir if necessary, with initial "url" file entry.
         """
 
         md5 = hashlib.md5(url.encode('utf-8')).hexdigest()
         cachedir = self.directory / md5[0:2] / md5
 
-        if not cachedir.exists():
+        if create and not cachedir.exists():
             logger.debug(f"Creating cache directory {cachedir}")
             cachedir.mkdir(parents=True)
             with open(cachedir / "url", 'w') as f:
@@ -148,8 +766,356 @@ class Cache:
                     cachedfile.unlink()
 
         logger.debug(f"Recording filename {filename}")
-        with open(cachefilename, 'w') as f:
-            f.write(filename)
+        self._write_atomic(cachefilename, filename)
+
+    @staticmethod
+    def _write_atomic(path, text):
+        """
+        Writes text to the pathlib handle path, such that concurrent
+        readers see either the old or the new contents
+        """
+
+        temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(temp, 'w') as f:
+            f.write(text)
+        os.replace(temp, path)
+
+    def _lockpath(self, url):
+        """
+        Returns pathlib handle to the lock file for the given URL. Lock
+        files are kept outside the cache directories, so that locking
+        does not create cache directories and survives their removal.
+        """
+
+        md5 = hashlib.md5(url.encode('utf-8')).hexdigest()
+        return self.directory / "locks" / md5[0:2] / f"{md5}.lock"
+
+    def gc(self):
+        """
+        Evicts cache entries according to max_age, max_size and policy.
+        Content shared by several entries is only removed once no entry
+        refers to it. Entries being downloaded by another process are
+        left alone. Unpacked trees count towards the size of their
+        archive's content, and are removed along with it. Returns the
+        number of bytes freed.
+        """
+
+        gc_lock = FileLock(self.directory / "locks" / "gc.lock")
+        if not gc_lock.acquire(blocking=False):
+            logger.info("Cache garbage collection already in progress")
+            return 0
+        try:
+            return self._gc()
+        finally:
+            gc_lock.release()
+
+    def _gc(self):
+        """
+        Implementation of gc(); caller must hold the gc lock
+        """
+
+        self._check_index()
+        now = time.time()
+        entries = []
+        refcounts = {}
+        total = 0
+
+        # Unpacked trees are often much larger than their archives
+        tree_sizes = {
+            treedir.name: self._tree_size(treedir)
+            for treedir in self.directory.glob("trees/??/*")
+        }
+        for cachedir in self.directory.glob("??/*"):
+            entry = self._entry_info(cachedir)
+            entries.append(entry)
+            total += entry["partial"]
+
+            # Entries refer to their blob by digest. Those linked to it
+            # share its storage; those which had to be copied (eg. where
+            # hard links aren't supported) take up space of their own.
+            if not entry["linked"]:
+                total += entry["size"]
+            digest = entry["digest"]
+            if digest is not None:
+                if digest not in refcounts:
+                    refcounts[digest] = 0
+                    total += entry["blob_size"] + tree_sizes.get(digest, 0)
+                refcounts[digest] += 1
+
+        # Blobs no longer referenced by any entry are garbage, unless they
+        # were only just created and are about to be linked into an entry
+        freed = 0
+        for blob in self.directory.glob("blobs/??/*"):
+            stat = blob.stat()
+            if blob.name not in refcounts \
+                    and now - stat.st_ctime > GC_GRACE_PERIOD:
+                logger.debug(f"Removing unreferenced blob {blob}")
+                blob.unlink()
+                self._remove_empty_dir(blob.parent)
+                freed += stat.st_size
+
+        def evict(entry):
+            nonlocal total, freed
+            if entry["url"] is not None:
+                lock = FileLock(self._lockpath(entry["url"]))
+                if not lock.acquire(blocking=False):
+                    logger.debug(f"Not evicting {entry['dir']}; in use")
+                    return
+                try:
+                    self.index.remove(entry["url"])
+                    shutil.rmtree(entry["dir"], ignore_errors=True)
+                finally:
+                    lock.release()
+            else:
+                shutil.rmtree(entry["dir"], ignore_errors=True)
+            logger.debug(f"Evicted {entry['dir']}")
+            self._remove_empty_dir(entry["dir"].parent)
+            size = entry["partial"]
+            if not entry["linked"]:
+                size += entry["size"]
+            digest = entry["digest"]
+            if digest is not None:
+                refcounts[digest] -= 1
+                if refcounts[digest] == 0 and entry["blob"].exists():
+                    entry["blob"].unlink()
+                    self._remove_empty_dir(entry["blob"].parent)
+                    size += entry["blob_size"]
+                    treedir = self.directory / "trees" / digest[:2] / digest
+                    if treedir.exists():
+                        logger.debug(f"Removing unpacked trees {treedir}")
+                        shutil.rmtree(treedir, ignore_errors=True)
+                        self._remove_empty_dir(treedir.parent)
+                        size += tree_sizes.get(digest, 0)
+            total -= size
+            freed += size
+
+        if self.policy == "lfu":
+            entries.sort(key=lambda e: (e["hits"], e["last_access"]))
+        else:
+            entries.sort(key=lambda e: e["last_access"])
+
+        for entry in entries:
+            expired = self.max_age is not None \
+                and now - entry["last_access"] > self.max_age
+            oversize = self.max_size is not None and total > self.max_size
+            if expired or oversize:
+                evict(entry)
+
+        # Unpacked trees are only kept as long as their archive
+        for treedir in self.directory.glob("trees/??/*"):
+            blob = self.directory / "blobs" / treedir.parent.name / treedir.name
+            if not blob.exists():
+                logger.debug(f"Removing unpacked trees {treedir}")
+                shutil.rmtree(treedir, ignore_errors=True)
+                self._remove_empty_dir(treedir.parent)
+                freed += tree_sizes.get(treedir.name, 0)
+
+        logger.info(
+            f"Cache garbage collection freed {freed / (1024 * 1024):.1f} MiB; "
+            f"cache is now {total / (1024 * 1024):.1f} MiB"
+        )
+        return freed
+
+    def _entry_info(self, cachedir):
+        """
+        Returns a dictionary describing the cache entry in cachedir: the
+        size in bytes of its contents and of any partial download, the
+        digest, blob and blob size of its contents (None if the entry is
+        not in the blob store), whether its contents are a hard link to
+        the blob, the time it was last used, and its hit count
+        """
+
+        url = None
+        urlfile = cachedir / "url"
+        if urlfile.exists():
+            url = urlfile.read_text()
+
+        info = {
+            "dir": cachedir,
+            "url": url,
+            "size": 0,
+            "partial": 0,
+            "digest": None,
+            "blob": None,
+            "blob_size": 0,
+            "linked": False,
+            "last_access": cachedir.stat().st_mtime,
+            "hits": 0,
+        }
+
+        entry = self.index.get(url) if url is not None else None
+        cachefilename = self._cachefilename(cachedir)
+        if cachefilename.exists():
+            info["last_access"] = cachefilename.stat().st_mtime
+            with open(cachefilename) as f:
+                cachefile = cachedir / f.readline()
+            if cachefile.is_file():
+                stat = cachefile.stat()
+                info["size"] = stat.st_size
+                digest = entry.get("sha256") if entry is not None else None
+                shafile = cachedir / "sha256"
+                if digest is None and shafile.exists():
+                    digest = shafile.read_text()
+                if digest:
+                    blob = self._blobpath(digest)
+                    if blob.exists():
+                        blob_stat = blob.stat()
+                        info["digest"] = digest
+                        info["blob"] = blob
+                        info["blob_size"] = blob_stat.st_size
+                        info["linked"] = blob_stat.st_ino == stat.st_ino
+
+        # An interrupted download may be resumed later, so count it too
+        partfile = cachedir / "download.part"
+        if partfile.exists():
+            stat = partfile.stat()
+            info["partial"] = stat.st_size
+            info["last_access"] = max(info["last_access"], stat.st_mtime)
+
+        if entry is not None:
+            info["last_access"] = entry.get("last_access", info["last_access"])
+            info["hits"] = entry.get("hits", 0)
+
+        return info
+
+    @staticmethod
+    def _tree_size(path):
+        """
+        Returns the total size in bytes of the files in directory tree path
+        """
+
+        size = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    size += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+        return size
+
+    @staticmethod
+    def _remove_empty_dir(directory):
+        """
+        Removes directory if it is empty
+        """
+
+        try:
+            directory.rmdir()
+        except OSError:
+            pass
+
+    def _store(self, url, cachedir, sourcefile, filename, digest,
+               digests=None):
+        """
+        Moves sourcefile into the blob store under the SHA-256 "digest"
+        (or discards it if that blob is already present), and then makes
+        the blob available as "filename" in cachedir, the cache directory
+        for url. "digests" optionally maps other algorithm names to
+        verified hex digests of the contents, to record in the index.
+        Returns pathlib handle to the cached file.
+        """
+
+        blob = self._blobpath(digest)
+        cachefile = cachedir / filename
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            # Fails if another download already created the blob
+            os.link(sourcefile, blob)
+        except FileExistsError:
+            logger.debug(f"Content already cached as {blob}")
+        except OSError:
+            # No hard link support
+            if not blob.exists():
+                shutil.copy2(sourcefile, blob)
+        if sourcefile != cachefile:
+            sourcefile.unlink()
+
+        # Link into place under a temporary name first, so any existing
+        # file of the same name is replaced atomically
+        templink = cachedir / f"download.{os.getpid()}.link"
+        if templink.exists():
+            templink.unlink()
+        try:
+            os.link(blob, templink)
+        except OSError:
+            shutil.copy2(blob, templink)
+        os.replace(templink, cachefile)
+
+        self._write_atomic(cachedir / "sha256", digest)
+        self._writefilename(cachedir, filename)
+        fields = self._index_fields(cachedir, cachefile)
+        fields["digests"] = digests or {}
+        self.index.update(url, **fields)
+        if self.is_missing(url):
+            self._set_missing(url, None)
+        return cachefile
+
+    def _index_fields(self, cachedir, cachefile):
+        """
+        Returns the CacheIndex fields describing cachefile in cachedir
+        """
+
+        shafile = cachedir / "sha256"
+        return {
+            "dir": cachedir.relative_to(self.directory).as_posix(),
+            "filename": cachefile.name,
+            "size": cachefile.stat().st_size,
+            "sha256": shafile.read_text() if shafile.exists() else None,
+            "digests": {},
+            "last_access": time.time(),
+            "hits": 0,
+        }
+
+    def _check_index(self):
+        """
+        Creates the index from the directory tree if it does not exist
+        yet, eg. for caches created by older versions of cbdep
+        """
+
+        with self._index_lock:
+            if self._index_checked:
+                return
+            self._index_checked = True
+            if self.index.exists() or not self.directory.exists():
+                return
+
+            logger.info(f"Indexing cache {self.directory}")
+            entries = {}
+            for cachefilename in self.directory.glob("??/*/filename"):
+                cachedir = cachefilename.parent
+                urlfile = cachedir / "url"
+                with open(cachefilename) as f:
+                    cachefile = cachedir / f.readline()
+                if not urlfile.exists() or not cachefile.is_file():
+                    continue
+                fields = self._index_fields(cachedir, cachefile)
+                fields["last_access"] = cachefilename.stat().st_mtime
+                entries[urlfile.read_text()] = fields
+            self.index.rebuild(entries)
+
+    def _blobpath(self, digest):
+        """
+        Returns pathlib handle to the blob storing content with the given
+        SHA-256 digest
+        """
+
+        return self.directory / "blobs" / digest[0:2] / digest
+
+    @staticmethod
+    def _hash_file(path, *digests):
+        """
+        Updates each of the hashlib objects "digests" with the contents of
+        the file at path, and returns the first
+        """
+
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                for digest in digests:
+                    digest.update(chunk)
+        return digests[0]
 
     def _cachefilename(self, cachedir):
         """
@@ -0,0 +1,245 @@
+"""
+Cache index
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+
+from cbdep.locking import FileLock
+
+logger = logging.getLogger('cbdep')
+
+# Indexes with usage records not yet written to disk, flushed at exit.
+# Indexes are only kept here (and so kept alive) while they have any.
+_unflushed = set()
+_unflushed_lock = threading.Lock()
+
+
+@atexit.register
+def _flush_all():
+    """
+    Writes the pending usage records of every index
+    """
+
+    with _unflushed_lock:
+        indexes = list(_unflushed)
+    for index in indexes:
+        index.flush()
+
+
+class CacheIndex:
+    """
+    Persistent index of cache entries, keyed by URL, so that lookups do
+    not need to probe the cache directory tree.
+
+    The index is an append-only log of JSON records, one per line. Each
+    record has a "url" key; the remaining keys are merged into the entry
+    for that URL, except that a record with "removed" set deletes the
+    entry. The whole log is loaded into memory on first use and compacted
+    when it contains many superseded records.
+
+    Entry fields are:
+        dir - cache directory of the entry, relative to the cache root
+        filename - name of the cached file in that directory
+        size - size of the cached file in bytes
+        sha256 - SHA-256 digest of the cached file
+        digests - dictionary of other verified digests of the cached
+            file, keyed by algorithm name
+        last_access - time.time() of the most recent use
+        hits - number of times the entry has been used
+    """
+
+    def __init__(self, path):
+        """
+        Initialize an index stored in the specified pathlib handle
+        """
+
+        self.path = path
+        self._entries = None
+        self._records = 0
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def exists(self):
+        """
+        Returns True if the index file has been created
+        """
+
+        return self.path.exists()
+
+    def get(self, url):
+        """
+        Returns the entry for url, or None
+        """
+
+        with self._lock:
+            self._load()
+            return self._entries.get(url)
+
+    def entries(self):
+        """
+        Returns a list of all entries
+        """
+
+        with self._lock:
+            self._load()
+            return [dict(entry, url=url) for url, entry in self._entries.items()]
+
+    def update(self, url, **fields):
+        """
+        Updates (or creates) the entry for url with the given fields
+        """
+
+        with self._lock:
+            self._load()
+            self._pending.pop(url, None)
+            self._append([dict(fields, url=url)])
+
+    def remove(self, url):
+        """
+        Removes the entry for url
+        """
+
+        with self._lock:
+            self._load()
+            self._pending.pop(url, None)
+            self._append([{"url": url, "removed": True}])
+
+    def touch(self, url, when):
+        """
+        Records a use of the entry for url at time "when". To keep cache
+        hits cheap this is only written to disk by flush(), which happens
+        automatically at exit.
+        """
+
+        with self._lock:
+            self._load()
+            entry = self._entries.get(url)
+            if entry is None:
+                return
+            entry["last_access"] = when
+            entry["hits"] = entry.get("hits", 0) + 1
+            self._pending[url] = {
+                "url": url,
+                "last_access": when,
+                "hits": entry["hits"],
+            }
+            with _unflushed_lock:
+                _unflushed.add(self)
+
+    def flush(self):
+        """
+        Writes any pending usage records to disk
+        """
+
+        with self._lock:
+            with _unflushed_lock:
+                _unflushed.discard(self)
+            if self._pending:
+                records = list(self._pending.values())
+                self._pending = {}
+                try:
+                    self._append(records)
+                except OSError as e:
+                    # Usage tracking is only advisory
+                    logger.debug(f"Unable to update cache index: {e}")
+
+    def rebuild(self, entries):
+        """
+        Replaces the index contents with "entries", a dictionary mapping
+        URLs to entry fields
+        """
+
+        with self._lock, self._file_lock():
+            self._entries = entries
+            self._pending = {}
+            self._compact()
+
+    def _load(self):
+        """
+        Reads the index file into memory, if not already done
+        """
+
+        if self._entries is not None:
+            return
+
+        self._read()
+        if self._records > 2 * len(self._entries) + 1000:
+            with self._file_lock():
+                # Pick up anything appended by other processes meanwhile
+                self._read()
+                self._compact()
+
+    def _read(self):
+        """
+        Replaces the in-memory entries with the contents of the index file
+        """
+
+        self._entries = {}
+        self._records = 0
+        if not self.path.exists():
+            return
+
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    url = record.pop("url")
+                except (ValueError, KeyError):
+                    # Most likely a partially-written final line
+                    continue
+                self._apply(url, record)
+                self._records += 1
+
+    def _apply(self, url, record):
+        """
+        Merges a single record into the in-memory entries
+        """
+
+        if record.get("removed"):
+            self._entries.pop(url, None)
+        else:
+            self._entries.setdefault(url, {}).update(record)
+
+    def _append(self, records):
+        """
+        Applies records to the in-memory entries and appends them to the
+        index file
+        """
+
+        lines = []
+        for record in records:
+            record = dict(record)
+            url = record.pop("url")
+            self._apply(url, record)
+            lines.append(json.dumps(dict(record, url=url)) + "\n")
+
+        with self._file_lock():
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write("".join(lines))
+        self._records += len(lines)
+
+    def _compact(self):
+        """
+        Rewrites the index file with one record per entry. Caller must
+        hold the file lock.
+        """
+
+        logger.debug(f"Compacting cache index {self.path}")
+        temp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(temp, 'w', encoding='utf-8') as f:
+            for url, entry in self._entries.items():
+                f.write(json.dumps(dict(entry, url=url)) + "\n")
+        os.replace(temp, self.path)
+        self._records = len(self._entries)
+
+    def _file_lock(self):
+        """
+        Returns a FileLock serializing writes to the index file between
+        processes
+        """
+
+        return FileLock(self.path.with_name(f"{self.path.name}.lock"))
@@ -3,19 +3,25 @@ Dependency Management System
 """
 
 import argparse
-import cbdep
-import importlib
+import datetime
+import json
 import logging
 import os
 import os.path
 import pathlib
 import shutil
 import sys
-import yaml
 
-from cbdep.cache import Cache
-from cbdep.install import Installer
-from cbdep.platform_introspection import get_arches, get_platforms, override_platforms, override_arch
+from cbdep.cache import Cache, DEFAULT_POOL_SIZE, DEFAULT_RETRIES, \
+    DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT, GC_POLICIES
+from cbdep.config import load_config, load_yaml
+from cbdep.install_state import VERIFY_MODES
+from cbdep.materialize import MATERIALIZE_MODES
+from cbdep.matrix import MATRIX_ARCHES, MATRIX_PLATFORMS
+from cbdep.platform_introspection import (
+    get_arches, get_platforms, get_target_platforms, set_cache_file
+)
+from cbdep.scheduler import DEFAULT_JOBS
 
 
 # Set up logging and handler
@@ -28,20 +34,122 @@ handler.setLevel(logging.INFO)
 logger.addHandler(handler)
 
 
+class VersionAction(argparse.Action):
+    """
+    Like argparse's "version" action, but only looks up the version of
+    cbdep when it is requested, as importlib.metadata is slow to import
+    """
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings=option_strings, dest=dest,
+                         default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        import importlib.metadata
+
+        version = importlib.metadata.version(__package__)
+        parser._print_message(f"cbdep version {version}\n")
+        parser.exit()
+
+
+def parse_size(size):
+    """
+    Converts a size such as "500M" or "20G" to a number of bytes
+    """
+
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper().removesuffix("B")
+    try:
+        if size and size[-1] in units:
+            return int(float(size[:-1]) * units[size[-1]])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {size}")
+
+
+def parse_days(days):
+    """
+    Converts a number of days to seconds
+    """
+
+    try:
+        return float(days) * 24 * 60 * 60
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid number of days: {days}")
+
+
+def parse_target(target):
+    """
+    Converts a target system such as "linux/aarch64", "windows" or
+    "ubuntu-22.04,linux/x86_64" into a tuple of (name, list of platforms,
+    arch or None)
+    """
+
+    name, _, arch = target.partition("/")
+    platforms = get_target_platforms(name)
+    if not platforms:
+        raise argparse.ArgumentTypeError(f"invalid target: {target}")
+    return (name, platforms, arch or None)
+
+
 class Cbdep:
     """
 
     """
 
-    def __init__(self):
+    def __init__(self, platforms=None, arch=None, **http_options):
+        """
+        "platforms" and "arch" override the introspected list of platforms
+        and machine type. Any other keyword arguments are passed to the
+        Cache to configure its HTTP session
+        """
+
         cachedir = pathlib.Path.home() / ".cbdepcache"
-        self.cache = Cache(str(cachedir))
+        self.cache = Cache(str(cachedir), **http_options)
+        set_cache_file(str(self.cache.directory / "platform.json"))
+        self._platforms = platforms
+        self.arch = arch
+
+        # Parsed config files, by (path, modification time, size) - only
+        # useful for a daemon, which loads them repeatedly
+        self.configs = {}
+
+    @property
+    def platforms(self):
+        """
+        The list of platforms of this system (possibly overridden)
+        """
+
+        if self._platforms is None:
+            self._platforms = get_platforms()
+        return self._platforms
+
+    @property
+    def arches(self):
+        """
+        The list of arches of this system (possibly overridden)
+        """
+
+        return get_arches(self.arch, self.platforms)
 
     def do_cache(self, args):
         """
-        Cache a URL
+        Cache a URL, or perform a cache maintenance command
         """
 
+        # Maintenance commands share the "cache" subcommand; they can't be
+        # mistaken for URLs
+        commands = {
+            "gc": self.do_cache_gc,
+            "list": self.do_cache_list,
+            "migrate": self.do_cache_migrate,
+            "stats": self.do_cache_stats,
+        }
+        if args.url in commands:
+            commands[args.url](args)
+            return
+
         self.cache.get(args.url, args.recache)
 
         # Output the cache filename, if requested
@@ -52,6 +160,60 @@ class Cbdep:
         if args.output is not None:
             self.cache.save(args.url, args.output)
 
+    def do_cache_gc(self, args):
+        """
+        Evict old cache entries
+        """
+
+        if self.cache.max_size is None and self.cache.max_age is None:
+            logger.error(
+                "Specify --cache-max-size and/or --cache-max-age for gc")
+            sys.exit(1)
+        self.cache.gc()
+
+    def auto_gc(self):
+        """
+        Garbage-collect the cache after an install, if limits were given
+        """
+
+        if self.cache.max_size is not None or self.cache.max_age is not None:
+            self.cache.gc()
+
+    def do_cache_list(self, args):
+        """
+        List cache entries
+        """
+
+        for entry in sorted(self.cache.entries(), key=lambda e: e["url"]):
+            last_access = datetime.datetime.fromtimestamp(
+                entry.get("last_access", 0)).strftime("%Y-%m-%d %H:%M")
+            print(
+                f"{entry.get('size', 0):>12}  {last_access}  "
+                f"{entry.get('hits', 0):>5}  {entry['url']}"
+            )
+
+    def do_cache_stats(self, args):
+        """
+        Display cache statistics
+        """
+
+        entries = self.cache.entries()
+        total = sum(entry.get("size", 0) for entry in entries)
+        unique = {}
+        for entry in entries:
+            unique[entry.get("sha256") or entry["url"]] = entry.get("size", 0)
+        print(f"Entries: {len(entries)}")
+        print(f"Unique files: {len(unique)}")
+        print(f"Total size: {total / (1024 * 1024):.1f} MiB")
+        print(f"Size on disk: {sum(unique.values()) / (1024 * 1024):.1f} MiB")
+
+    def do_cache_migrate(self, args):
+        """
+        Move old cache entries into the content-addressed blob store
+        """
+
+        self.cache.migrate()
+
     @staticmethod
     def do_platform(self, args):
         """
@@ -59,44 +221,82 @@ class Cbdep:
         """
 
         logger.debug("Determining platform and arch...")
-        print(get_platforms())
-        print(get_arches())
+        print(self.platforms)
+        print(self.arches)
 
-    @staticmethod
-    def loadconfig(args):
+    def do_serve(self, args):
         """
-        Returns the contents of the config file defining the available packages
+        Run as a daemon, handling commands forwarded by other cbdep
+        processes
         """
 
-        yamlfile = args.config_file
-        if yamlfile is not None:
-            # Load text of file
-            with open(yamlfile, 'r') as y:
-                return y.read()
+        from cbdep.daemon import Daemon, socket_path
 
-        return (importlib.resources.files(cbdep) / "cbdep.config").read_text()
+        path = args.socket if args.socket is not None else socket_path()
+        Daemon(self, path, run_command).serve()
 
-    def do_install(self, args):
+    def loadconfig(self, args):
         """
-        Install a package based on a descriptor YAML
+        Returns the parsed config file defining the available packages
+        """
+
+        key = None
+        if args.config_file is not None:
+            st = os.stat(args.config_file)
+            key = (os.path.abspath(args.config_file), st.st_mtime_ns, st.st_size)
+        config = self.configs.get(key)
+        if config is None:
+            config = load_config(
+                args.config_file, self.cache.directory / "config")
+            self.configs[key] = config
+        return config
+
+    @staticmethod
+    def installdir(args):
+        """
+        Returns the absolute installation directory requested by args
         """
 
         installdir = args.dir
         if installdir is None:
             installdir = "install"
-        installdir = str(pathlib.Path(installdir).resolve())
+        return str(pathlib.Path(installdir).resolve())
 
-        installer = Installer.fromYaml(
+    def make_installer(self, args):
+        """
+        Returns an Installer configured from the command-line args
+        """
+
+        # Imported here so that commands which don't install anything
+        # start faster
+        from cbdep.install import Installer
+
+        installer = Installer(
             self.loadconfig(args),
             self.cache,
-            get_platforms(),
-            "x86" if args.x32 else get_arches()
+            self.platforms,
+            "x86" if args.x32 else self.arches
         )
         installer.set_cache_only(args.cache_only)
         installer.set_recache(args.recache)
+        installer.set_probe_urls(args.probe_urls)
+        installer.set_tree_cache(args.tree_cache)
+        installer.set_verify(args.verify)
+        installer.set_force(args.force)
+        return installer
+
+    def do_install(self, args):
+        """
+        Install a package based on a descriptor YAML
+        """
+
+        installdir = self.installdir(args)
+        installer = self.make_installer(args)
+        installer.set_stream_extract(args.stream_extract)
         if args.cache_local_file is not None:
             installer.set_from_local_file(args.cache_local_file)
             installer.set_cache_only(True)
+        installer.set_need_installer_file(args.output is not None)
 
         installer.install(
             args.package,
@@ -107,15 +307,136 @@ class Cbdep:
         )
 
         if args.output is not None:
+            installer_file = installer.get_installer_file()
+            if installer_file is None:
+                logger.error(
+                    f"{args.package} {args.version} has no downloaded file "
+                    f"to copy to {args.output}")
+                sys.exit(1)
             logger.debug(f"Copying downloaded file to {args.output}")
-            shutil.copy2(installer.get_installer_file(), args.output)
+            shutil.copy2(installer_file, args.output)
+
+        self.auto_gc()
+
+    def do_install_many(self, args):
+        """
+        Install all packages listed in a YAML or JSON manifest
+        """
+
+        from cbdep.batch import BatchInstaller
+
+        with open(args.manifest, 'r') as m:
+            manifest = load_yaml(m.read())
+
+        batch = BatchInstaller(self.make_installer(args), args.jobs)
+        for entry in BatchInstaller.parse_manifest(
+                manifest, self.installdir(args)):
+            batch.add(**entry)
+        batch.install()
+
+        self.auto_gc()
+
+    def do_prefetch(self, args):
+        """
+        Download the files for many packages, for any number of target
+        systems, into the cache without installing anything
+        """
+
+        from cbdep.batch import Prefetcher
+        from cbdep.install import Installer
+
+        items = self.package_items(args)
+        if args.target:
+            targets = [
+                (platforms, get_arches(arch or self.arch, platforms))
+                for _, platforms, arch in args.target
+            ]
+        else:
+            targets = [(self.platforms, self.arches)]
+
+        installer = Installer(
+            self.loadconfig(args), self.cache, self.platforms, self.arches)
+        installer.set_recache(args.recache)
+        installer.set_probe_urls(args.probe_urls)
+        prefetcher = Prefetcher(installer, targets, args.jobs)
+        for item in items:
+            prefetcher.add(*item)
+        skipped = prefetcher.prefetch(self.installdir(args))
+        if skipped:
+            logger.info(f"Skipped {skipped} unavailable packages")
+
+        self.auto_gc()
+
+    def do_resolve(self, args):
+        """
+        Output the URLs which would be downloaded to install packages, for
+        any number of target systems
+        """
+
+        from cbdep.install import Installer
+        from cbdep.matrix import matrix_targets, resolve_matrix
+
+        items = self.package_items(args)
+        if args.matrix:
+            targets = matrix_targets(
+                args.platforms.split(",") if args.platforms else None,
+                args.arches.split(",") if args.arches else None
+            )
+        elif args.target:
+            targets = [
+                (name, platforms, arch or self.arch)
+                for name, platforms, arch in args.target
+            ]
+        else:
+            targets = [(",".join(self.platforms), self.platforms, self.arch)]
+
+        installer = Installer(
+            self.loadconfig(args), self.cache, self.platforms, self.arches)
+        results = resolve_matrix(
+            installer, items, targets, self.installdir(args))
+        if args.json:
+            print(json.dumps(results, indent=2))
+            return
+        for result in results:
+            for urls in result["urls"]:
+                for url in urls:
+                    print(
+                        f"{result['package']}\t{result['version']}\t"
+                        f"{result['platform']}\t{result['arch']}\t{url}"
+                    )
+
+    def package_items(self, args):
+        """
+        Returns a list of (package, version, base URL, force cbdeps) for
+        the PACKAGE@VERSION arguments and --manifest of args
+        """
+
+        from cbdep.batch import BatchInstaller
+
+        items = []
+        if args.manifest is not None:
+            with open(args.manifest, 'r') as m:
+                manifest = load_yaml(m.read())
+            for entry in BatchInstaller.parse_manifest(manifest, None):
+                items.append((entry["package"], entry["version"],
+                              entry["base_url"], entry["force_cbdeps"]))
+        for item in args.packages:
+            package, _, version = item.partition("@")
+            if not package or not version:
+                logger.error(f"Expected PACKAGE@VERSION, not {item}")
+                sys.exit(1)
+            items.append((package, version, args.base_url, args.cbdeps))
+        if not items:
+            logger.error("Specify packages and/or --manifest")
+            sys.exit(1)
+        return items
 
     def do_list(self, args):
         """
         List available packages
         """
 
-        config = yaml.safe_load(self.loadconfig(args))
+        config = self.loadconfig(args)
         pkgs = list(config['packages'].keys()) \
             + config['cbdeps']['packages']
         print(
@@ -126,18 +447,11 @@ class Cbdep:
         print()
 
 
-def main():
+def make_parser():
     """
+    Returns the parser for cbdep's command line
     """
 
-    # PyInstaller binaries get LD_LIBRARY_PATH set for them, and that
-    # can have unwanted side-effects for our own subprocesses. Remove
-    # that here - it can still be set by a set_env: entry in cbdep.config
-    # for an install directive.
-    # This needs to be done very early - even the call to get_platforms()
-    # below indirectly shells out to lsb_release.
-    os.environ.pop("LD_LIBRARY_PATH", None)
-
     parser = argparse.ArgumentParser(
         description='Dependency Management System'
     )
@@ -145,6 +459,10 @@ def main():
         "--debug", action="store_true",
         help="Enable debugging output"
     )
+    parser.add_argument(
+        "--no-daemon", action="store_true",
+        help="Don't forward the command to a running 'cbdep serve'"
+    )
     parser.add_argument(
         "-p", "--platform", type=str,
         default=None,
@@ -156,9 +474,48 @@ def main():
         help="Override detected architecture"
     )
     parser.add_argument(
-        "-V", "--version", action="version",
-        help="Display cbdep version information",
-        version=f"cbdep version {importlib.metadata.version(__package__)}"
+        "--pool-size", type=int, default=DEFAULT_POOL_SIZE,
+        help="Number of HTTP connections to keep alive per host "
+             f"(default {DEFAULT_POOL_SIZE})"
+    )
+    parser.add_argument(
+        "--retries", type=int, default=DEFAULT_RETRIES,
+        help="Number of times to retry failed HTTP connections "
+             f"(default {DEFAULT_RETRIES})"
+    )
+    parser.add_argument(
+        "--connect-timeout", type=float, default=DEFAULT_CONNECT_TIMEOUT,
+        help="HTTP connection timeout in seconds "
+             f"(default {DEFAULT_CONNECT_TIMEOUT})"
+    )
+    parser.add_argument(
+        "--read-timeout", type=float, default=DEFAULT_READ_TIMEOUT,
+        help="HTTP read timeout in seconds "
+             f"(default {DEFAULT_READ_TIMEOUT})"
+    )
+    parser.add_argument(
+        "--segments", type=int, default=1,
+        help="Download large files using this many concurrent ranged "
+             "requests (default 1)"
+    )
+    parser.add_argument(
+        "--cache-max-size", type=parse_size, default=None,
+        help="Maximum size of the download cache, eg. 20G; if set, the "
+             "cache is garbage-collected after each install"
+    )
+    parser.add_argument(
+        "--cache-max-age", type=parse_days, default=None,
+        help="Evict cache entries unused for this many days; if set, the "
+             "cache is garbage-collected after each install"
+    )
+    parser.add_argument(
+        "--cache-policy", choices=GC_POLICIES, default="lru",
+        help="Which entries to evict first when the cache is too large: "
+             "least-recently used (lru) or least-frequently used (lfu)"
+    )
+    parser.add_argument(
+        "-V", "--version", action=VersionAction,
+        help="Display cbdep version information"
     )
 
     subparsers = parser.add_subparsers()
@@ -166,7 +523,13 @@ def main():
     cache_parser = subparsers.add_parser(
         "cache", help="Add downloaded URL to local cache"
     )
-    cache_parser.add_argument("url", type=str, help="URL to cache")
+    cache_parser.add_argument(
+        "url", type=str,
+        help="URL to cache; or 'gc' to evict entries according to "
+             "--cache-max-size/--cache-max-age; 'list' to list entries; "
+             "'stats' to summarize cache usage; or 'migrate' to move old "
+             "cache entries into the deduplicated blob store"
+    )
     cache_parser.add_argument(
         "-r", "--report", action="store_true",
         help="Report the filename in the cache"
@@ -229,17 +592,218 @@ def main():
         "--recache", action="store_true",
         help="Re-download any installer files to cache, replacing files in cache"
     )
+    install_parser.add_argument(
+        "-f", "--force", action="store_true",
+        help="Install even if the same package is already installed"
+    )
+    install_parser.add_argument(
+        "--verify", choices=VERIFY_MODES, default="stat",
+        help="How to check that a previous install is intact: compare file "
+             "counts, sizes and times ('stat', default) or contents ('hash')"
+    )
+    install_parser.add_argument(
+        "--tree-cache", nargs="?", const="reflink", default=None,
+        choices=MATERIALIZE_MODES,
+        help="Cache unpacked archives, and install them again by copying "
+             "with reflinks (default), hard links ('link') or plain copies"
+    )
+    install_parser.add_argument(
+        "--probe-urls", action="store_true",
+        help="Check all alternative URLs for a download concurrently "
+             "before downloading"
+    )
+    install_parser.add_argument(
+        "--stream-extract", action="store_true",
+        help="Unpack tar archives while downloading them"
+    )
     install_parser.add_argument(
         "--cache-local-file", type=str,
         help="Populate cache with local file rather than downloading. Implies --cache-only."
     )
     install_parser.set_defaults(func=Cbdep.do_install)
 
+    install_many_parser = subparsers.add_parser(
+        "install-many", help="Install all packages listed in a manifest"
+    )
+    install_many_parser.add_argument(
+        "manifest", type=str,
+        help="YAML or JSON list of packages, each with 'package', 'version' "
+             "and optionally 'dir', 'base_url' and 'cbdeps' keys"
+    )
+    install_many_parser.add_argument(
+        "-3", "--x32", action="store_true",
+        help="Download 32-bit packages (default false; only works on "
+             "a few packages)"
+    )
+    install_many_parser.add_argument(
+        "-c", "--config-file", type=str,
+        help="YAML file descriptor"
+    )
+    install_many_parser.add_argument(
+        "-d", "--dir", type=str,
+        help="Directory to unpack into for packages without a 'dir'"
+    )
+    install_many_parser.add_argument(
+        "-j", "--jobs", type=int, default=DEFAULT_JOBS,
+        help=f"Number of concurrent downloads and installs "
+             f"(default {DEFAULT_JOBS})"
+    )
+    install_many_parser.add_argument(
+        "-n", "--cache-only", action='store_true',
+        help="Only download any installer files, do not install"
+    )
+    install_many_parser.add_argument(
+        "--recache", action="store_true",
+        help="Re-download any installer files to cache, replacing files in cache"
+    )
+    install_many_parser.add_argument(
+        "-f", "--force", action="store_true",
+        help="Install even if the same package is already installed"
+    )
+    install_many_parser.add_argument(
+        "--verify", choices=VERIFY_MODES, default="stat",
+        help="How to check that a previous install is intact: compare file "
+             "counts, sizes and times ('stat', default) or contents ('hash')"
+    )
+    install_many_parser.add_argument(
+        "--tree-cache", nargs="?", const="reflink", default=None,
+        choices=MATERIALIZE_MODES,
+        help="Cache unpacked archives, and install them again by copying "
+             "with reflinks (default), hard links ('link') or plain copies"
+    )
+    install_many_parser.add_argument(
+        "--probe-urls", action="store_true",
+        help="Check all alternative URLs for a download concurrently "
+             "before downloading"
+    )
+    install_many_parser.set_defaults(func=Cbdep.do_install_many)
+
+    prefetch_parser = subparsers.add_parser(
+        "prefetch",
+        help="Download packages for one or more systems into the cache"
+    )
+    prefetch_parser.add_argument(
+        "packages", nargs="*", metavar="PACKAGE@VERSION",
+        help="Packages to download"
+    )
+    prefetch_parser.add_argument(
+        "-m", "--manifest", type=str,
+        help="YAML or JSON list of packages to download, as for install-many"
+    )
+    prefetch_parser.add_argument(
+        "-t", "--target", type=parse_target, action="append", default=[],
+        metavar="PLATFORM[/ARCH]",
+        help="Download packages for this system, eg. linux/aarch64 or "
+             "windows/x86_64 (may be repeated; the platform may be a "
+             "comma-separated list, as for --platform; default: this system)"
+    )
+    prefetch_parser.add_argument(
+        "-c", "--config-file", type=str,
+        help="YAML file descriptor"
+    )
+    prefetch_parser.add_argument(
+        "-d", "--dir", type=str,
+        help="Install directory assumed when evaluating descriptors "
+             "(nothing is installed)"
+    )
+    prefetch_parser.add_argument(
+        "-b", "--base-url", type=str,
+        help="Alternate base URL for the packages given on the command line"
+    )
+    prefetch_parser.add_argument(
+        "-C", "--cbdeps", action="store_true",
+        help="Force interpreting the packages given on the command line as "
+             "cbdeps packages"
+    )
+    prefetch_parser.add_argument(
+        "-j", "--jobs", type=int, default=DEFAULT_JOBS,
+        help=f"Number of concurrent downloads (default {DEFAULT_JOBS})"
+    )
+    prefetch_parser.add_argument(
+        "--recache", action="store_true",
+        help="Re-download files, replacing files in cache"
+    )
+    prefetch_parser.add_argument(
+        "--probe-urls", action="store_true",
+        help="Check all alternative URLs for a download concurrently "
+             "before downloading"
+    )
+    prefetch_parser.set_defaults(func=Cbdep.do_prefetch)
+
+    resolve_parser = subparsers.add_parser(
+        "resolve",
+        help="Output the URLs of packages for one or more systems, without "
+             "downloading them"
+    )
+    resolve_parser.add_argument(
+        "packages", nargs="*", metavar="PACKAGE@VERSION",
+        help="Packages to resolve"
+    )
+    resolve_parser.add_argument(
+        "-m", "--manifest", type=str,
+        help="YAML or JSON list of packages to resolve, as for install-many"
+    )
+    resolve_parser.add_argument(
+        "-t", "--target", type=parse_target, action="append", default=[],
+        metavar="PLATFORM[/ARCH]",
+        help="Resolve packages for this system, as for prefetch (may be "
+             "repeated; default: this system)"
+    )
+    resolve_parser.add_argument(
+        "--matrix", action="store_true",
+        help="Resolve packages for every combination of --platforms and "
+             "--arches"
+    )
+    resolve_parser.add_argument(
+        "--platforms", type=str,
+        help="Comma-separated platforms for --matrix (default: "
+             f"{','.join(MATRIX_PLATFORMS)})"
+    )
+    resolve_parser.add_argument(
+        "--arches", type=str,
+        help="Comma-separated arches for --matrix (default: "
+             f"{','.join(MATRIX_ARCHES)})"
+    )
+    resolve_parser.add_argument(
+        "--json", action="store_true",
+        help="Output JSON rather than lines of package, version, platform, "
+             "arch and URL"
+    )
+    resolve_parser.add_argument(
+        "-c", "--config-file", type=str,
+        help="YAML file descriptor"
+    )
+    resolve_parser.add_argument(
+        "-d", "--dir", type=str,
+        help="Install directory assumed when evaluating descriptors"
+    )
+    resolve_parser.add_argument(
+        "-b", "--base-url", type=str,
+        help="Alternate base URL for the packages given on the command line"
+    )
+    resolve_parser.add_argument(
+        "-C", "--cbdeps", action="store_true",
+        help="Force interpreting the packages given on the command line as "
+             "cbdeps packages"
+    )
+    resolve_parser.set_defaults(func=Cbdep.do_resolve)
+
     platform_parser = subparsers.add_parser(
         "platform", help="Dump introspected platform information"
     )
     platform_parser.set_defaults(func=Cbdep.do_platform)
 
+    serve_parser = subparsers.add_parser(
+        "serve", help="Run as a daemon, which later cbdep commands are "
+                      "forwarded to"
+    )
+    serve_parser.add_argument(
+        "--socket", type=str, default=None,
+        help="Unix domain socket to listen on (default $CBDEP_SOCKET, or "
+             "cbdep.sock in the cache directory)"
+    )
+    serve_parser.set_defaults(func=Cbdep.do_serve)
+
     list_parser = subparsers.add_parser(
         "list", help="List available cbdep packages"
     )
@@ -248,7 +812,62 @@ def main():
     )
     list_parser.set_defaults(func=Cbdep.do_list)
 
-    args = parser.parse_args()
+    return parser
+
+
+def can_forward(parser, args):
+    """
+    Returns True if the command "args" may be run by a cbdep daemon:
+    that is, it isn't "serve" itself and no global options other than
+    --debug were given, as the daemon uses its own
+    """
+
+    if args.func is Cbdep.do_serve:
+        return False
+    defaults = vars(parser.parse_args([]))
+    return all(
+        getattr(args, name) == value
+        for name, value in defaults.items() if name != "debug"
+    )
+
+
+def run_command(cbdep, argv):
+    """
+    Runs the cbdep command line argv (without the program name) using
+    the existing Cbdep "cbdep", writing output to the current sys.stdout
+    and sys.stderr. Used by the daemon.
+    """
+
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if "func" not in args or not can_forward(parser, args):
+        logger.error("Command cannot be run by the cbdep daemon")
+        sys.exit(1)
+
+    stream = handler.setStream(sys.stderr)
+    level = handler.level
+    handler.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    try:
+        args.func(cbdep, args)
+    finally:
+        handler.setLevel(level)
+        handler.setStream(stream)
+
+
+def main(argv=None):
+    """
+    """
+
+    # PyInstaller binaries get LD_LIBRARY_PATH set for them, and that
+    # can have unwanted side-effects for our own subprocesses. Remove
+    # that here - it can still be set by a set_env: entry in cbdep.config
+    # for an install directive.
+    # This needs to be done before anything runs a subprocess - platform
+    # introspection, for instance, may shell out to lsb_release.
+    os.environ.pop("LD_LIBRARY_PATH", None)
+
+    parser = make_parser()
+    args = parser.parse_args(argv)
 
     # Set logging to debug level on stream handler if --debug was set
     if args.debug:
@@ -257,19 +876,38 @@ def main():
     # Override architecture if specified
     if args.arch is not None:
         logger.debug(f"Overriding architecture to {args.arch}")
-        override_arch(args.arch)
 
     # Override platform if specified
+    platforms = None
     if args.platform is not None:
         logger.debug(f"Overriding platform to {args.platform}")
-        override_platforms(args.platform.split(','))
+        platforms = args.platform.split(',')
 
     # Check that a command was specified
     if "func" not in args:
         parser.print_help()
         sys.exit(1)
 
-    cbdep = Cbdep()
+    # Let a running daemon do the work, if there is one
+    if can_forward(parser, args):
+        from cbdep.daemon import forward, socket_path
+        returncode = forward(
+            socket_path(), sys.argv[1:] if argv is None else argv)
+        if returncode is not None:
+            sys.exit(returncode)
+
+    cbdep = Cbdep(
+        platforms=platforms,
+        arch=args.arch,
+        pool_size=args.pool_size,
+        retries=args.retries,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        segments=args.segments,
+        max_size=args.cache_max_size,
+        max_age=args.cache_max_age,
+        policy=args.cache_policy
+    )
     args.func(cbdep, args)
 
 
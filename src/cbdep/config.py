@@ -0,0 +1,117 @@
+"""
+Loading of configuration files
+"""
+
+import hashlib
+import importlib.resources
+import json
+import logging
+import os
+
+import cbdep
+
+logger = logging.getLogger('cbdep')
+
+# Bump this when the format of compiled configurations changes
+COMPILED_VERSION = 2
+
+# Number of compiled configurations to keep
+COMPILED_KEEP = 20
+
+
+def load_yaml(text):
+    """
+    Parses YAML text, as yaml.safe_load() but faster where possible
+    """
+
+    # PyYAML is slow to import, and isn't needed at all when a compiled
+    # configuration exists
+    import yaml
+
+    # Use libyaml's parser if PyYAML was built with it; it's many times faster
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    return yaml.load(text, Loader=loader)
+
+
+def read_config(config_file=None):
+    """
+    Returns the text of config_file, or of the bundled configuration
+    file if config_file is None
+    """
+
+    if config_file is not None:
+        with open(config_file, 'r') as y:
+            return y.read()
+    return (importlib.resources.files(cbdep) / "cbdep.config").read_text()
+
+
+def load_config(config_file=None, cache_dir=None):
+    """
+    Returns the parsed contents of config_file, or of the bundled
+    configuration file if config_file is None.
+
+    If cache_dir is specified, the parsed configuration is stored there
+    as JSON, keyed by a digest of the configuration text, and later calls
+    with the same text load that instead of parsing the YAML again. (The
+    cache directory may be shared, so nothing able to run code, such as
+    pickle, is used to load it.)
+    """
+
+    text = read_config(config_file)
+    if cache_dir is None:
+        return load_yaml(text)
+
+    key = hashlib.sha256(
+        f"{COMPILED_VERSION}\0{text}".encode("utf-8")).hexdigest()
+    compiled = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(compiled, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.debug(f"Ignoring unreadable compiled config {compiled}: {e}")
+
+    config = load_yaml(text)
+    try:
+        # YAML can express more than JSON, eg. dates or integer keys;
+        # such configurations are simply parsed every time
+        serialized = json.dumps(config)
+        if json.loads(serialized) != config:
+            logger.debug("Configuration cannot be compiled to JSON")
+            return config
+    except (TypeError, ValueError) as e:
+        logger.debug(f"Configuration cannot be compiled to JSON: {e}")
+        return config
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp = f"{compiled}.{os.getpid()}.tmp"
+        with open(temp, 'w', encoding='utf-8') as f:
+            f.write(serialized)
+        os.replace(temp, compiled)
+        _prune(cache_dir)
+    except OSError as e:
+        # Only an optimization
+        logger.debug(f"Unable to save compiled config {compiled}: {e}")
+    return config
+
+
+def _prune(cache_dir):
+    """
+    Removes all but the COMPILED_KEEP most recent compiled configurations,
+    and any left by older versions of cbdep
+    """
+
+    compiled = []
+    stale = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".json"):
+            compiled.append(entry)
+        elif entry.name.endswith(".pickle"):
+            stale.append(entry)
+    compiled.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in compiled[COMPILED_KEEP:] + stale:
+        try:
+            os.unlink(entry.path)
+        except OSError:
+            pass
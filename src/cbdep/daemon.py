@@ -0,0 +1,335 @@
+"""
+A long-running cbdep process which other cbdep processes forward their
+commands to, so that the configuration, platform introspection, cache
+index and HTTP connections are set up only once.
+
+The daemon listens on a Unix domain socket. A client sends a single line
+of JSON describing the command:
+    {"argv": [...], "cwd": "...", "env": {...}}
+along with its standard input, output and error file descriptors (as
+SCM_RIGHTS ancillary data), and the daemon runs it in that working
+directory and environment with those file descriptors, so that the output
+of the command and of any processes it starts goes straight to the
+client's. It then sends back a line of JSON:
+    {"exit": code} - the command's exit code; always the last line
+If no file descriptors were sent, the daemon instead sends the output of
+the command itself (but not of its subprocesses) as lines of JSON:
+    {"stdout": "..."} or {"stderr": "..."}
+Commands are run one at a time, as they change the working directory,
+environment and file descriptors of the whole process.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+logger = logging.getLogger('cbdep')
+
+# Environment variable overriding the default socket path
+SOCKET_VARIABLE = "CBDEP_SOCKET"
+
+# Maximum size of a request read at once, along with its file descriptors
+REQUEST_CHUNK = 65536
+
+
+def socket_path():
+    """
+    Returns the path of the daemon's socket
+    """
+
+    path = os.environ.get(SOCKET_VARIABLE)
+    if path:
+        return path
+    return str(pathlib.Path.home() / ".cbdepcache" / "cbdep.sock")
+
+
+def forward(path, argv):
+    """
+    Sends the cbdep command line argv (without the program name) to the
+    daemon listening on "path", copying its output to sys.stdout and
+    sys.stderr. Returns the command's exit code, or None if there is no
+    daemon running.
+    """
+
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError as e:
+        logger.debug(f"Not using cbdep daemon at {path}: {e}")
+        sock.close()
+        return None
+
+    logger.debug(f"Forwarding command to cbdep daemon at {path}")
+    request = {"argv": list(argv), "cwd": os.getcwd(),
+               "env": dict(os.environ)}
+    request = json.dumps(request).encode("utf-8") + b"\n"
+    with sock, sock.makefile("rb") as f:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fds = _stdio_fds()
+        if fds:
+            socket.send_fds(sock, [request], fds)
+        else:
+            sock.sendall(request)
+        for line in f:
+            message = json.loads(line)
+            if "stdout" in message:
+                sys.stdout.write(message["stdout"])
+                sys.stdout.flush()
+            elif "stderr" in message:
+                sys.stderr.write(message["stderr"])
+                sys.stderr.flush()
+            elif "exit" in message:
+                return message["exit"]
+
+    logger.error(f"cbdep daemon at {path} exited unexpectedly")
+    return 1
+
+
+def _stdio_fds():
+    """
+    Returns the list of this process's standard input, output and error
+    file descriptors, or an empty list if they can't all be sent
+    """
+
+    if not hasattr(socket, "send_fds"):
+        return []
+    try:
+        for fd in range(3):
+            os.fstat(fd)
+    except OSError:
+        return []
+    return [0, 1, 2]
+
+
+class _Terminate(BaseException):
+    """
+    Raised by SIGTERM to stop the daemon; not an Exception, so that it
+    isn't caught by the command being run
+    """
+
+
+def _terminate(signum, frame):
+    raise _Terminate()
+
+
+class _ClientStream:
+    """
+    File-like object sending everything written to it to a client, as
+    the output stream "name"
+    """
+
+    def __init__(self, wfile, name, lock):
+        self.wfile = wfile
+        self.name = name
+        self.lock = lock
+        self.closed = False
+
+    def write(self, text):
+        if not text or self.closed:
+            return len(text)
+        line = json.dumps({self.name: text}).encode("utf-8") + b"\n"
+        with self.lock:
+            try:
+                self.wfile.write(line)
+                self.wfile.flush()
+            except OSError:
+                # The client went away; finish the command regardless
+                self.closed = True
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Runs one forwarded command
+    """
+
+    def handle(self):
+        fds = []
+        try:
+            # The file descriptors arrive with the first part of the request
+            data, fds, _, _ = socket.recv_fds(self.request, REQUEST_CHUNK, 3)
+            if data and not data.endswith(b"\n"):
+                data += self.rfile.readline()
+            request = json.loads(data)
+            argv = [str(arg) for arg in request["argv"]]
+            cwd = request["cwd"]
+            env = request["env"]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.debug(f"Ignoring invalid request: {e}")
+            for fd in fds:
+                os.close(fd)
+            return
+
+        lock = threading.Lock()
+        try:
+            if len(fds) == 3:
+                returncode = self.server.daemon.run(
+                    argv, cwd, env, fds=fds)
+            else:
+                stdout = _ClientStream(self.wfile, "stdout", lock)
+                stderr = _ClientStream(self.wfile, "stderr", lock)
+                returncode = self.server.daemon.run(
+                    argv, cwd, env, stdout, stderr)
+        finally:
+            for fd in fds:
+                os.close(fd)
+        with lock:
+            try:
+                self.wfile.write(
+                    json.dumps({"exit": returncode}).encode("utf-8") + b"\n")
+            except OSError:
+                pass
+
+
+class Daemon:
+    """
+    Serves forwarded commands on a Unix domain socket, running each of
+    them with the same Cbdep object
+    """
+
+    def __init__(self, cbdep, path, run_command):
+        """
+        "cbdep" is the Cbdep object to run commands with, "path" is the
+        socket to listen on, and run_command(cbdep, argv) runs a command
+        """
+
+        self.cbdep = cbdep
+        self.path = path
+        self.run_command = run_command
+
+    def run(self, argv, cwd, env, stdout=None, stderr=None, fds=None):
+        """
+        Runs the command line argv in the working directory cwd and
+        environment env, with output to stdout and stderr (default, the
+        current sys.stdout and sys.stderr). If "fds" is a list of standard
+        input, output and error file descriptors, they replace the
+        process's own for the duration, for subprocesses as well. Returns
+        the exit code.
+        """
+
+        saved_cwd = os.getcwd()
+        saved_env = dict(os.environ)
+        saved_streams = (sys.stdout, sys.stderr)
+        saved_fds = []
+        returncode = 0
+        try:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(env)
+            if fds:
+                self._flush()
+                saved_fds = [os.dup(fd) for fd in range(len(fds))]
+                for fd, client_fd in enumerate(fds):
+                    os.dup2(client_fd, fd)
+            sys.stdout = stdout or sys.stdout
+            sys.stderr = stderr or sys.stderr
+            self.run_command(self.cbdep, argv)
+        except SystemExit as e:
+            if e.code is None:
+                returncode = 0
+            elif isinstance(e.code, int):
+                returncode = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                returncode = 1
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+            returncode = 1
+        finally:
+            self._flush()
+            sys.stdout, sys.stderr = saved_streams
+            for fd, saved_fd in enumerate(saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+            os.environ.clear()
+            os.environ.update(saved_env)
+            os.chdir(saved_cwd)
+        logger.debug(f"Ran {argv}: exit code {returncode}")
+        return returncode
+
+    @staticmethod
+    def _flush():
+        """
+        Flushes any output buffered for the current file descriptors
+        """
+
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except (AttributeError, OSError, ValueError):
+                pass
+
+    def serve(self):
+        """
+        Listens on the socket and runs commands until interrupted
+        """
+
+        if not hasattr(socket, "AF_UNIX"):
+            logger.error("cbdep serve requires Unix domain sockets")
+            sys.exit(1)
+
+        self._remove_stale_socket()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+
+        # Anyone who can connect can run commands as us
+        umask = os.umask(0o177)
+        try:
+            server = socketserver.UnixStreamServer(
+                self.path, _RequestHandler)
+        finally:
+            os.umask(umask)
+        server.daemon = self
+
+        # Get the slow parts of starting up out of the way now
+        self.cbdep.cache.session
+
+        logger.info(f"cbdep daemon listening on {self.path}")
+        signal.signal(signal.SIGTERM, _terminate)
+        try:
+            server.serve_forever()
+        except (KeyboardInterrupt, _Terminate):
+            logger.info("cbdep daemon exiting")
+        finally:
+            server.server_close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def _remove_stale_socket(self):
+        """
+        Removes the socket left behind by a daemon which is no longer
+        running, or exits if one is still running
+        """
+
+        if not os.path.exists(self.path):
+            return
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            logger.debug(f"Removing stale socket {self.path}")
+            os.unlink(self.path)
+            return
+        finally:
+            sock.close()
+        logger.error(f"A cbdep daemon is already listening on {self.path}")
+        sys.exit(1)
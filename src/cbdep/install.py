@@ -2,6 +2,9 @@
 Install
 """
 
+import functools
+import hashlib
+import json
 import logging
 import os
 import pathlib
@@ -11,16 +14,85 @@ import stat
 import string
 import sys
 import tempfile
-import yaml
+import threading
 
-from packaging.specifiers import SpecifierSet
 from subprocess import run, CalledProcessError
 
-import cbdep.zipfile_with_permissions as zipfile_with_permissions
+from cbdep.cache import CHECKSUM_ALGORITHMS, ChecksumError
+from cbdep.config import load_yaml
+from cbdep.install_state import InstallState
+from cbdep.materialize import materialize
 from cbdep.platform_introspection import get_default_arches
+from cbdep.scheduler import DependencyGraph
 
 logger = logging.getLogger("cbdep")
-zipfile_with_permissions.register()
+
+# Whether _register_unpackers() has been called
+_unpackers_registered = False
+_unpackers_lock = threading.Lock()
+
+
+def _register_unpackers():
+    """
+    Configures shutil.unpack_archive to use our native decompressors and
+    custom unzipper. Done on first use rather than at import, as it
+    imports several modules most invocations never need.
+    """
+
+    global _unpackers_registered
+    with _unpackers_lock:
+        if _unpackers_registered:
+            return
+        import cbdep.native_unpack as native_unpack
+        import cbdep.zipfile_with_permissions as zipfile_with_permissions
+        native_unpack.register()
+        zipfile_with_permissions.register()
+        _unpackers_registered = True
+
+
+@functools.lru_cache(maxsize=None)
+def _specifier_set(expression):
+    """
+    Returns the SpecifierSet for the if_version expression "expression"
+    """
+
+    from packaging.specifiers import SpecifierSet
+
+    return SpecifierSet(expression)
+
+
+@functools.lru_cache(maxsize=None)
+def _parse_version(version):
+    """
+    Returns version as a packaging Version, or unchanged if it isn't a
+    valid one (which no SpecifierSet will then contain)
+    """
+
+    from packaging.version import InvalidVersion, Version
+
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return version
+
+
+class _BlockIndex:
+    """
+    The outcome of matching each of a list of descriptor blocks against
+    the current platforms and arches, which don't change, so that finding
+    the block for a version only has to check if_version expressions.
+    Each entry is a tuple of:
+        block
+        symbols - dictionary of the symbols set while matching the block
+        system - True if the block's if_platform and if_arch match
+        if_version - the block's if_version expression, if any
+    "results" memoizes find_block(): (block, symbols) by safe version.
+    """
+
+    def __init__(self, blocks, entries):
+        self.blocks = blocks
+        self.entries = entries
+        self.results = {}
 
 
 class Installer:
@@ -63,12 +135,53 @@ class Installer:
         # Default, can be overridden by self.set_recache()
         self.recache = False
 
+        # Default, can be overridden by self.set_probe_urls()
+        self.probe_urls = False
+
+        # Default, can be overridden by self.set_stream_extract()
+        self.stream_extract = False
+
+        # Default, can be overridden by self.set_tree_cache()
+        self.tree_cache = None
+
+        # Defaults, can be overridden by self.set_verify() and
+        # self.set_force()
+        self.verify = "stat"
+        self.force = False
+
         # Default, can be overridden by self.set_from_local_file()
         self.from_local_file = None
 
+        # Default, can be overridden by self.set_need_installer_file()
+        self.need_installer_file = False
+
         # Populated by do_url() to be the final single downloaded installer
         self.installer_file = None
 
+        # Populated by do_url() with the URL of installer_file, if it is
+        # the cached file for that URL
+        self.installer_url = None
+
+        # Populated by execute_block() for the install record: the
+        # directories created, the files downloaded and the nested cbdep
+        # installs
+        self.installed_paths = []
+        self.downloads = []
+        self.nested = []
+
+        # Keys (see install_key()) of the installs completed by this
+        # Installer and all its copies
+        self.completed = set()
+
+        # _BlockIndex for each list of blocks searched by find_block(),
+        # shared by all copies of this Installer
+        self.block_indexes = {}
+
+        # Populated by do_url() in stream-extract mode with a tuple of
+        # (downloaded file, TemporaryDirectory containing the unpacked
+        # archive) for the following do_unarchive()
+        self.unpacked = None
+
         # Create a temp directory that action blocks can use
         self.temp_dir = tempfile.mkdtemp()
         self.symbols["TEMP_DIR"] = self.temp_dir
@@ -85,7 +198,7 @@ class Installer:
         Constructor from a YAML configuration file
         """
 
-        config = yaml.safe_load(yamltext)
+        config = load_yaml(yamltext)
         return cls(config, cache, platforms, arches)
 
     def copy(self):
@@ -94,9 +207,17 @@ class Installer:
         as this Installer. Necessary to call a nested install().
         """
 
-        return Installer(
+        installer = Installer(
             self.descriptor, self.cache, self.platforms, self.arches
         )
+        installer.set_probe_urls(self.probe_urls)
+        installer.set_stream_extract(self.stream_extract)
+        installer.set_tree_cache(self.tree_cache)
+        installer.set_verify(self.verify)
+        installer.set_force(self.force)
+        installer.completed = self.completed
+        installer.block_indexes = self.block_indexes
+        return installer
 
     def set_cache_only(self, cache_only):
         """
@@ -115,6 +236,50 @@ class Installer:
 
         self.recache = recache
 
+    def set_probe_urls(self, probe_urls):
+        """
+        If set to true, then when a 'url' directive lists several URLs,
+        all of them are checked concurrently before downloading the first
+        one which exists, rather than attempting each download in turn
+        """
+
+        self.probe_urls = probe_urls
+
+    def set_stream_extract(self, stream_extract):
+        """
+        If set to true, then a tar archive downloaded by a 'url' directive
+        which is immediately followed by an 'unarchive' directive is
+        unpacked while it is being downloaded
+        """
+
+        self.stream_extract = stream_extract
+
+    def set_tree_cache(self, mode):
+        """
+        If a mode (one of materialize.MATERIALIZE_MODES) is specified, then
+        'unarchive' directives keep a pristine copy of what they unpack in
+        the cache, and later unpack the same archive with the same options
+        by copying that tree into place using "mode"
+        """
+
+        self.tree_cache = mode
+
+    def set_verify(self, mode):
+        """
+        Sets how a previous install of a package is checked before it is
+        skipped; one of install_state.VERIFY_MODES
+        """
+
+        self.verify = mode
+
+    def set_force(self, force):
+        """
+        If set to true, then packages are installed even if a previous
+        install of them is intact
+        """
+
+        self.force = force
+
     def set_from_local_file(self, from_local_file):
         """
         If a filename is specified here, "cbdep install" will cache and use
@@ -129,6 +294,15 @@ class Installer:
                 f"Specified local file {from_local_file} does not exist!")
             sys.exit(1)
 
+    def set_need_installer_file(self, need_installer_file):
+        """
+        If set to true, then the downloaded installer file is needed after
+        install() (eg. to copy it elsewhere), so a previous install of the
+        package is only skipped if that file is still in the cache
+        """
+
+        self.need_installer_file = need_installer_file
+
     def get_installer_file(self):
         """
         Returns the (most recent) installer_file, ie, the resulting
@@ -142,6 +316,37 @@ class Installer:
         Entry point to install a version of named package
         """
 
+        block = self.resolve(package, version, base_url, inst_dir, force_cbdeps)
+
+        # Download the files for any nested cbdep installs concurrently
+        # first; do_cbdep() then installs them in order from the cache
+        if not self.cache_only:
+            graph = DependencyGraph(self)
+            for dep in graph.nested(self, block):
+                graph.add(*dep, base_url=self.base_url)
+            graph.fetch()
+
+        self.execute_block(block)
+
+    @staticmethod
+    def install_key(package, version, install_dir, base_url=None,
+                    force_cbdeps=False):
+        """
+        Returns a key identifying an install, for the "completed" set
+        """
+
+        return (package, str(version), os.path.abspath(install_dir),
+                base_url, force_cbdeps)
+
+    def resolve(self, package, version, base_url, inst_dir, force_cbdeps=False,
+                required=True):
+        """
+        Prepares the symbol table for installing a version of named
+        package, and returns the descriptor block appropriate for the
+        current system. Nothing is downloaded or installed. If no block
+        is appropriate, returns None if "required" is False.
+        """
+
         self.package = package
         self.symbols['PACKAGE'] = package
         self.version = version
@@ -279,12 +484,12 @@ class Installer:
         logger.debug(f"Starting install for package {package}")
 
         block = self.find_block(blocks)
-        if block is None:
+        if block is None and required:
             logger.error(f"No blocks for package {package} {version} "
                          f"are appropriate for current system")
             sys.exit(1)
 
-        self.execute_block(block)
+        return block
 
     def find_block(self, blocks):
         """
@@ -294,22 +499,71 @@ class Installer:
         Returns: Said block, or None if none match
         """
 
-        for block in blocks:
-            if self.match_platform(block) and \
-               self.match_arch(block) and \
-               self.match_version(block):
-                return block
+        index = self._block_index(blocks)
+        result = index.results.get(self.safe_version)
+        if result is None:
+            # Blocks are still checked in order, as the symbols set by
+            # blocks which don't match persist (as with match_platform()
+            # and friends)
+            found = None
+            symbols = {}
+            version = _parse_version(self.safe_version)
+            for block, block_symbols, system, if_version in index.entries:
+                symbols.update(block_symbols)
+                if system and (not if_version or
+                               version in _specifier_set(if_version)):
+                    found = block
+                    break
+            result = (found, symbols)
+            index.results[self.safe_version] = result
+
+        found, symbols = result
+        for symbol, value in symbols.items():
+            logger.debug(f"Matched {symbol} {value}")
+            self.symbols[symbol] = value
+        return found
+
+    def _block_index(self, blocks):
+        """
+        Returns the _BlockIndex of the list "blocks", creating it if
+        necessary
+        """
 
-        return None
+        key = (id(blocks), tuple(self.platforms), tuple(self.arches))
+        index = self.block_indexes.get(key)
+        if index is not None and index.blocks is blocks:
+            return index
 
-    def _match_system(self, block, if_directive, system_values, symbol):
+        platforms = set(self.platforms)
+        arches = set(self.arches)
+        entries = []
+        for block in blocks:
+            symbols = {}
+            system = self._system_value(block, "if_platform", platforms)
+            if system is not None:
+                if system is not True:
+                    symbols.update(self._platform_symbols(system))
+                system = self._system_value(block, "if_arch", arches)
+                if system is not None and system is not True:
+                    symbols["ARCH"] = system
+            entries.append(
+                (block, symbols, system is not None, block.get("if_version"))
+            )
+
+        index = _BlockIndex(blocks, entries)
+        self.block_indexes[key] = index
+        return index
+
+    def _system_value(self, block, if_directive, system_values):
         """
-        Common implementation for if_platform and if_arch.
+        Returns the first value of the if_platform or if_arch directive
+        "if_directive" of block which is in system_values, True if block
+        has no such directive, or None if no value matches
         """
-        if if_directive not in block:
-            return True
 
-        if_directive_values = block[if_directive]
+        if_directive_values = self._directive(block, if_directive)
+        if if_directive_values is None:
+            return True
         if not isinstance(if_directive_values, list):
             if_directive_values = [if_directive_values]
 
@@ -323,28 +577,49 @@ class Installer:
         # `x64`. cbdep.config authors should place the more-specific
         # `x64-alpine` first in the `if_arch` directive to ensure the
         # Alpine variant is matched when it exists.
-        matched_value = None
         for directive_value in if_directive_values:
             if directive_value.casefold() in system_values:
-                matched_value = directive_value
-                break
+                return directive_value
 
-        if matched_value is not None:
-            self.symbols[symbol] = matched_value
-            logger.debug(f"Matched {symbol} {matched_value}")
+        return None
 
-            # Default value for PLATFORM_EXT - kind of a hack to put this here
-            # QQQ Allow overriding in config
-            if symbol == "PLATFORM":
-                if matched_value.startswith(("win", "pc-win")):
-                    self.symbols['PLATFORM_EXT'] = "zip"
-                    self.symbols['PLATFORM_EXE_EXT'] = ".exe"
-                else:
-                    self.symbols['PLATFORM_EXT'] = "tar.gz"
-                    self.symbols['PLATFORM_EXE_EXT'] = ""
-            return True
+    @staticmethod
+    def _platform_symbols(platform):
+        """
+        Returns a dictionary of the symbols set by matching the platform
+        "platform"
+        """
 
-        return False
+        # Default value for PLATFORM_EXT - kind of a hack to put this here
+        # QQQ Allow overriding in config
+        if platform.startswith(("win", "pc-win")):
+            return {
+                "PLATFORM": platform,
+                "PLATFORM_EXT": "zip",
+                "PLATFORM_EXE_EXT": ".exe",
+            }
+        return {
+            "PLATFORM": platform,
+            "PLATFORM_EXT": "tar.gz",
+            "PLATFORM_EXE_EXT": "",
+        }
+
+    def _match_system(self, block, if_directive, system_values, symbol):
+        """
+        Common implementation for if_platform and if_arch.
+        """
+
+        matched_value = self._system_value(block, if_directive, system_values)
+        if matched_value is None:
+            return False
+
+        if matched_value is not True:
+            logger.debug(f"Matched {symbol} {matched_value}")
+            if symbol == "PLATFORM":
+                self.symbols.update(self._platform_symbols(matched_value))
+            else:
+                self.symbols[symbol] = matched_value
+        return True
 
     def match_platform(self, block):
         """
@@ -370,15 +645,6 @@ class Installer:
         If the block does not contain either key, return true.
         """
 
-        arches = None
-        if "default_arches" in block:
-            arches = get_default_arches()
-        elif "default_cbdeps_arches" in block:
-            arches = get_default_arches(cbdeps_arches=True)
-        if arches is not None:
-            block["if_arch"] = arches
-            logger.debug(f"Set if_arch: {block['if_arch']}")
-
         return self._match_system(
             block,
             "if_arch",
@@ -386,6 +652,23 @@ class Installer:
             "ARCH"
         )
 
+    def _directive(self, block, if_directive):
+        """
+        Returns the value of the if_platform or if_arch directive
+        "if_directive" of block, or None if it has none. A default_arches
+        or default_cbdeps_arches key acts as an if_arch of the default
+        arches for the installer's platforms. The block is not modified,
+        as it may be shared by installers for other platforms.
+        """
+
+        if if_directive == "if_arch":
+            if "default_arches" in block:
+                return get_default_arches(platforms=self.platforms)
+            if "default_cbdeps_arches" in block:
+                return get_default_arches(
+                    cbdeps_arches=True, platforms=self.platforms)
+        return block.get(if_directive)
+
     def match_version(self, block):
         """
         If the block contains an if_version key, return true if the current
@@ -400,7 +683,7 @@ class Installer:
         if not if_version:
             return True
 
-        return SpecifierSet(if_version).__contains__(self.safe_version)
+        return _parse_version(self.safe_version) in _specifier_set(if_version)
 
     def execute_block(self, block):
         """
@@ -412,8 +695,10 @@ class Installer:
         if "base_url" in block:
             self.handle_base_url(block.get("base_url"))
 
-        # Enable any environment overrides
-        if "set_env" in block:
+        # Enable any environment overrides. Downloads don't need them,
+        # and may be happening on several threads at once (see
+        # fetch_block()), so leave the environment alone then.
+        if "set_env" in block and not self.cache_only:
             self.handle_set_env(block.get("set_env"))
 
         actions = block.get("actions")
@@ -421,7 +706,19 @@ class Installer:
             logger.error("Malformed configuration file (missing 'actions')")
             sys.exit(1)
 
-        for action in actions:
+        if not self.cache_only and self.is_installed(block):
+            logger.info(
+                f"{self.package} {self.version} is already installed "
+                f"in {self.installdir}"
+            )
+            return
+        state = InstallState(self.installdir)
+        fingerprint = self.fingerprint(block)
+        self.installed_paths = []
+        self.downloads = []
+        self.nested = []
+
+        for index, action in enumerate(actions):
 
             # Special option "fixed_dir" may cause action to be skipped
             if "fixed_dir" in action:
@@ -429,7 +726,9 @@ class Installer:
                     continue
 
             if "url" in action:
-                self.do_url(action)
+                next_action = actions[index + 1] \
+                    if index + 1 < len(actions) else None
+                self.do_url(action, next_action)
             elif self.cache_only:
                 # Skip any other actions if doing cache-only
                 continue
@@ -449,6 +748,97 @@ class Installer:
                 )
                 sys.exit(1)
 
+        if not self.cache_only:
+            self.record_install(state, fingerprint)
+
+    def fetch_block(self, block):
+        """
+        Given a single block from the config, execute only its 'url'
+        actions, ie. populate the cache without installing anything. If
+        the package is already installed, nothing is downloaded, unless
+        this Installer is cache-only (when the point is to fill the cache)
+        or forced.
+        """
+
+        if not self.cache_only and self.is_installed(block):
+            return
+        cache_only = self.cache_only
+        self.cache_only = True
+        try:
+            self.execute_block(block)
+        finally:
+            self.cache_only = cache_only
+
+    def fingerprint(self, block):
+        """
+        Returns a digest of everything determining the result of
+        installing the current package using block
+        """
+
+        inputs = {
+            "package": self.package,
+            "version": self.version,
+            "base_url": self.base_url,
+            "installdir": self.installdir,
+            "platforms": self.platforms,
+            "arches": self.arches,
+            "block": block,
+        }
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def is_installed(self, block):
+        """
+        Returns True if the current package was previously installed using
+        block, and that install (including any nested cbdep installs) is
+        still intact
+        """
+
+        if self.force or self.recache or self.from_local_file is not None:
+            return False
+        state = InstallState(self.installdir)
+        manifest = state.load(self.package, self.version)
+        if manifest is None \
+                or not state.verify(manifest, self.fingerprint(block), self.verify):
+            return False
+
+        for nested in manifest.get("cbdeps", []):
+            installer = self.copy()
+            nested_block = installer.resolve(
+                nested["package"], nested["version"], self.base_url,
+                nested["dir"]
+            )
+            if not installer.is_installed(nested_block):
+                return False
+
+        # The most recent download of the previous install stands in for
+        # the one skipping the install avoids
+        downloads = manifest.get("downloads") or []
+        if downloads:
+            installer_file = self.cache.lookup(downloads[-1]["url"])
+            if installer_file is None and self.need_installer_file:
+                logger.debug(f"{downloads[-1]['url']} is no longer cached")
+                return False
+            self.installer_file = installer_file
+        return True
+
+    def record_install(self, state, fingerprint):
+        """
+        Records the install of the current package just completed, if it
+        created directories which can be checked later. (Packages which
+        are only installed by 'run' directives are always reinstalled.)
+        """
+
+        state.remove(self.package, self.version)
+        paths = [pathlib.Path(path) for path in self.installed_paths]
+        if not paths or not all(path.is_dir() for path in paths):
+            return
+        state.record(
+            self.package, self.version, fingerprint, paths,
+            self.downloads, self.nested, self.verify
+        )
+
     def handle_set_env(self, env_args):
         """
         Sets values in the cbdep process's environment
@@ -505,38 +895,89 @@ class Installer:
         logger.error(f"Scraped HTML did not find {regexp}")
         sys.exit(1)
 
-    def do_url(self, action):
+    def do_url(self, action, next_action=None):
         """
-        Handles a 'url' directive
+        Handles a 'url' directive. next_action is the directive following
+        it, if any.
         """
 
         # Iterate through available URLs; use first successful download.
-        # TODO This probably should somehow cache the result using the
-        # first URL as a key, or similar. As it is now, if the second URL
-        # is the "right" one, then any subsequent runs of cbdep will hit
-        # the network first before discovering the right package in the cache.
         urls = action["url"]
         if not isinstance(urls, list):
             urls = [urls]
+        real_urls = [string.Template(url).substitute(**self.symbols)
+                     for url in urls]
+
+        # The cache remembers which of the URLs was downloaded last time,
+        # keyed by the first one, and which URLs were recently not found,
+        # so that a warm-cache run does not need to touch the network.
+        # Skip that when recaching or populating the cache from a local
+        # file, which should both act on the first URL.
+        candidates = real_urls
+        if not self.recache and self.from_local_file is None:
+            winner = self.cache.alias(real_urls[0])
+            if winner in real_urls:
+                candidates = [winner] + [
+                    url for url in real_urls if url != winner
+                ]
+            candidates = [
+                url for url in candidates if not self.cache.is_missing(url)
+            ] or candidates
+
+        # Optionally find out up front which URL exists, so that slow
+        # failures for the other URLs happen concurrently
+        if self.probe_urls and len(candidates) > 1 \
+                and self.from_local_file is None \
+                and (self.recache or self.cache.lookup(candidates[0]) is None):
+            found = self.cache.probe(candidates)
+            if found is not None:
+                candidates = [found] + [
+                    url for url in candidates if url != found
+                ]
+
+        # In stream-extract mode, if the download is going to be unpacked
+        # next, unpack it while it downloads
+        stream = self.stream_extract and not self.cache_only \
+            and next_action is not None and "unarchive" in next_action \
+            and "fixed_dir" not in next_action and "scrape_html" not in action
 
         exception = None
-        for url in urls:
-            template = string.Template(url)
-            real_url = template.substitute(**self.symbols)
-
+        for real_url in candidates:
             # If we've been asked to use a local file, here is where we
             # pre-populate the cache
             if self.from_local_file is not None:
                 self.cache.put(real_url, self.from_local_file)
 
+            extractor = None
+            streamed = False
+            if stream:
+                from cbdep.streaming_extract import StreamingExtractor
+                temp_dir_handle = self.unpack_temp_dir()
+                extractor = StreamingExtractor(
+                    pathlib.Path(temp_dir_handle.name) / 'unpack')
             try:
-                localfile = self.cache.get(real_url, self.recache)
+                localfile = self.cache.get(
+                    real_url, self.recache,
+                    self.get_checksum(action, real_url), extractor
+                )
+                streamed = extractor is not None and extractor.finish()
                 break
             except Exception as e:
                 exception = e
+            finally:
+                if extractor is not None and not streamed:
+                    extractor.finish()
+                    temp_dir_handle.cleanup()
         else:
             raise exception
 
+        if streamed:
+            logger.debug(f"Unpacked {localfile} while downloading")
+            self.unpacked = (localfile, temp_dir_handle)
+
+        if len(real_urls) > 1:
+            self.cache.set_alias(real_urls[0], real_url)
+
         # Handle strange redirects
         if "scrape_html" in action:
             try:
@@ -550,8 +991,52 @@ class Installer:
 
         # Remember the downloaded file
         self.installer_file = localfile
+        self.installer_url = None if "scrape_html" in action else real_url
+        self.downloads.append({
+            "url": real_url,
+            "sha256": self.cache.digest(real_url),
+        })
         self.symbols['DL'] = localfile
 
+    def get_checksum(self, action, real_url):
+        """
+        Returns the expected (algorithm, hex digest) of the file downloaded
+        from real_url by a 'url' directive, or None if the directive does
+        not specify one. The directive may contain a 'sha256' or 'sha512'
+        key with the digest itself, or a 'checksum_url' key with the URL
+        of a checksum file (in which ${URL} is the download URL).
+        """
+
+        for algorithm in CHECKSUM_ALGORITHMS.values():
+            if algorithm in action:
+                return (algorithm, self.templatize(str(action[algorithm])).lower())
+
+        if "checksum_url" not in action:
+            return None
+
+        # ${URL} is only defined here, not for later actions
+        checksum_url = string.Template(action["checksum_url"]).substitute(
+            self.symbols, URL=real_url)
+        checksum_file = self.cache.get(checksum_url, self.recache)
+
+        # Checksum files contain either just a digest, or lines of the
+        # form "<digest>  <filename>"
+        filename = real_url.rsplit('/', 1)[-1]
+        digest = None
+        with open(checksum_file, encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if not fields:
+                    continue
+                if len(fields) == 1 or fields[1].lstrip('*') == filename:
+                    digest = fields[0].lower()
+                    break
+        if digest is None or len(digest) not in CHECKSUM_ALGORITHMS:
+            raise ChecksumError(
+                f"No checksum for {filename} found in {checksum_url}")
+
+        return (CHECKSUM_ALGORITHMS[len(digest)], digest)
+
     def do_install_dir(self, action):
         """
         Handles an 'install_dir' directive, which resets self.installdir
@@ -580,18 +1065,70 @@ class Installer:
             target_dir_name = f"{self.package}-{self.version}"
         target_dir = install_dir / target_dir_name
 
-        # We extract the archive to a temporary directory
-        temp_dir_handle = tempfile.TemporaryDirectory(dir=install_dir)
-        temp_dir = pathlib.Path(temp_dir_handle.name)
-        unpack_dir = temp_dir / 'unpack'
-        unpack_dir.mkdir()
-        logger.info(f"Unpacking archive to {target_dir}")
+        # With the tree cache enabled, an archive which was unpacked
+        # before with the same options is copied from the cache instead
+        digest = None
+        tree = None
+        if self.tree_cache is not None and self.installer_url is not None:
+            digest = self.cache.digest(self.installer_url)
+        if digest is not None:
+            tree_key = self.tree_key(args)
+            tree = self.cache.tree(digest, tree_key)
+
+        unpacked, self.unpacked = self.unpacked, None
+        if tree is not None:
+            if unpacked is not None:
+                unpacked[1].cleanup()
+            temp_dir_handle = self.unpack_temp_dir()
+            temp_dir = pathlib.Path(temp_dir_handle.name)
+            logger.info(f"Installing previously unpacked archive to {target_dir}")
+        else:
+            temp_dir_handle, contents_dir = self.unpack_contents(
+                args, target_dir, unpacked)
+            temp_dir = pathlib.Path(temp_dir_handle.name)
+            if digest is not None:
+                tree = self.cache.put_tree(digest, tree_key, contents_dir)
 
-        try:
-            shutil.unpack_archive(self.installer_file, unpack_dir)
-        except UnicodeEncodeError as e:
-            print("ERROR: Extraction failed - please check LANG/LC_ALL in your environment are pointing at character sets inclusive of UTF-8")
-            sys.exit(1)
+        if tree is not None:
+            contents_dir = temp_dir / 'tree'
+            materialize(tree, contents_dir, self.tree_cache)
+
+        # Finally as atomically as possible, move the existing
+        # target directory out of the way (if it exists) and move
+        # the contents directory to the target directory.
+        if target_dir.exists():
+            target_dir.rename(temp_dir / "recycle")
+        contents_dir.rename(target_dir)
+        self.installed_paths.append(str(target_dir))
+
+    def unpack_contents(self, args, target_dir, unpacked):
+        """
+        Unpacks the downloaded file as specified by the 'unarchive'
+        directive arguments "args", or uses the tuple "unpacked" from
+        do_url() if it already did that. Returns the TemporaryDirectory
+        unpacked into and the pathlib handle of the resulting contents
+        directory within it.
+        """
+
+        # We extract the archive to a temporary directory, unless do_url()
+        # already did so while downloading it
+        if unpacked is not None and unpacked[0] == self.installer_file:
+            temp_dir_handle = unpacked[1]
+            temp_dir = pathlib.Path(temp_dir_handle.name)
+            unpack_dir = temp_dir / 'unpack'
+            logger.info(f"Installing unpacked archive to {target_dir}")
+        else:
+            temp_dir_handle = self.unpack_temp_dir()
+            temp_dir = pathlib.Path(temp_dir_handle.name)
+            unpack_dir = temp_dir / 'unpack'
+            logger.info(f"Unpacking archive to {target_dir}")
+
+            _register_unpackers()
+            try:
+                shutil.unpack_archive(self.installer_file, unpack_dir)
+            except UnicodeEncodeError as e:
+                print("ERROR: Extraction failed - please check LANG/LC_ALL in your environment are pointing at character sets inclusive of UTF-8")
+                sys.exit(1)
 
         # Now we want to find the single directory containing the
         # contents we care about from the unpacked archive.
@@ -614,12 +1151,34 @@ class Installer:
                 wrap_dir / self.templatize(args["create_toplevel_dir"]))
             contents_dir = wrap_dir
 
-        # Finally as atomically as possible, move the existing
-        # target directory out of the way (if it exists) and move
-        # the contents directory to the target directory.
-        if target_dir.exists():
-            target_dir.rename(temp_dir / "recycle")
-        contents_dir.rename(target_dir)
+        return temp_dir_handle, contents_dir
+
+    def tree_key(self, args):
+        """
+        Returns the tree cache key for the 'unarchive' directive arguments
+        "args", identifying how the archive is unpacked
+        """
+
+        options = {
+            name: self.templatize(args[name])
+            for name in ("toplevel_dir", "create_toplevel_dir")
+            if args and name in args
+        }
+        return hashlib.sha256(
+            json.dumps(options, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def unpack_temp_dir(self):
+        """
+        Returns a TemporaryDirectory in the install directory, containing
+        an empty 'unpack' directory to extract an archive into
+        """
+
+        install_dir = pathlib.Path(self.installdir)
+        install_dir.mkdir(exist_ok=True, parents=True)
+        temp_dir_handle = tempfile.TemporaryDirectory(dir=install_dir)
+        (pathlib.Path(temp_dir_handle.name) / 'unpack').mkdir()
+        return temp_dir_handle
 
     def do_raw_binary(self, action):
         """
@@ -669,6 +1228,7 @@ class Installer:
         if target_dir.exists():
             target_dir.rename(temp_dir / "recycle")
         contents_dir.rename(target_dir)
+        self.installed_paths.append(str(target_dir))
 
     def do_cbdep(self, action):
         """
@@ -680,10 +1240,23 @@ class Installer:
         install_dir = self.templatize(
             action.get("install_dir", self.installdir))
 
-        installer = self.copy()
-        logger.info(
-            f"Calling nested cbdep install -d {install_dir} {package} {version}")
-        installer.install(package, str(version), self.base_url, install_dir)
+        key = self.install_key(package, version, install_dir, self.base_url)
+        if key in self.completed:
+            logger.debug(
+                f"Nested cbdep install of {package} {version} already done")
+        else:
+            installer = self.copy()
+            logger.info(
+                f"Calling nested cbdep install -d {install_dir} {package} {version}")
+            block = installer.resolve(
+                package, str(version), self.base_url, install_dir)
+            installer.execute_block(block)
+            self.completed.add(key)
+        self.nested.append({
+            "package": package,
+            "version": str(version),
+            "dir": install_dir,
+        })
 
     def do_run(self, action):
         """
@@ -0,0 +1,186 @@
+"""
+Records of completed installs
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import time
+
+logger = logging.getLogger('cbdep')
+
+# Ways of checking that a recorded install is still intact:
+#   stat - the number, total size and latest modification time of the
+#       installed files match
+#   hash - additionally the contents of every installed file match
+VERIFY_MODES = ["stat", "hash"]
+
+# Directory within an install directory holding its install records
+STATE_DIR = ".cbdep"
+
+
+class InstallState:
+    """
+    Manifests of the packages installed into an install directory, kept
+    in <install directory>/.cbdep/<package>-<version>.json. Each manifest
+    records:
+        package, version - what was installed
+        fingerprint - digest of everything which determines the result
+            of the install (the descriptor block, base URL, platforms,
+            install directory, ...)
+        downloads - list of {"url", "sha256"} for each downloaded file
+        targets - list of {"path", "files", "size", "mtime"} describing
+            each directory created by the install, optionally with
+            "sha256", a digest of all file names and contents
+        cbdeps - list of {"package", "version", "dir"} for each nested
+            cbdep install
+        installed_at - time.time() of the install
+    """
+
+    def __init__(self, installdir):
+        """
+        Initialize the records of the install directory "installdir"
+        """
+
+        self.directory = pathlib.Path(installdir) / STATE_DIR
+
+    def manifest_path(self, package, version):
+        """
+        Returns pathlib handle to the manifest of package and version
+        """
+
+        name = f"{package}-{version}".replace("/", "_").replace("\\", "_")
+        return self.directory / f"{name}.json"
+
+    def load(self, package, version):
+        """
+        Returns the manifest of package and version, or None
+        """
+
+        try:
+            with open(self.manifest_path(package, version),
+                      encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def record(self, package, version, fingerprint, targets, downloads,
+               cbdeps, mode):
+        """
+        Writes the manifest of a completed install. "targets" are the
+        paths of the directories it created; the others are as described
+        for the class. If mode is "hash", the contents of the targets are
+        hashed for later verification.
+        """
+
+        manifest = {
+            "package": package,
+            "version": version,
+            "fingerprint": fingerprint,
+            "downloads": downloads,
+            "targets": [
+                dict(self.scan(target, mode == "hash"), path=str(target))
+                for target in targets
+            ],
+            "cbdeps": cbdeps,
+            "installed_at": time.time(),
+        }
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.manifest_path(package, version)
+        temp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(temp, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temp, path)
+
+    def remove(self, package, version):
+        """
+        Forgets any install of package and version
+        """
+
+        try:
+            self.manifest_path(package, version).unlink()
+        except FileNotFoundError:
+            pass
+
+    def verify(self, manifest, fingerprint, mode):
+        """
+        Returns True if manifest has the given fingerprint and all its
+        targets are intact, checked according to "mode"
+        """
+
+        if manifest.get("fingerprint") != fingerprint:
+            logger.debug("Install record does not match descriptor")
+            return False
+        for target in manifest.get("targets", []):
+            if mode == "hash" and "sha256" not in target:
+                logger.debug(f"Install record has no digest of {target['path']}")
+                return False
+            path = pathlib.Path(target["path"])
+            if not path.is_dir():
+                logger.debug(f"Installed directory {path} is missing")
+                return False
+            current = self.scan(path, mode == "hash")
+            for field, value in current.items():
+                if target.get(field) != value:
+                    logger.debug(f"Installed directory {path} has changed")
+                    return False
+        return True
+
+    @staticmethod
+    def scan(path, hash_contents=False):
+        """
+        Returns a dictionary with the number of files in the directory tree
+        "path", their total size and latest modification time, and if
+        hash_contents is True, a digest of all their names and contents
+        """
+
+        files = 0
+        size = 0
+        mtime = 0
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            # Symbolic links to directories are listed (but not followed)
+            # in dirnames
+            links = [
+                name for name in dirnames
+                if os.path.islink(os.path.join(dirpath, name))
+            ]
+            for name in sorted(filenames + links):
+                full = os.path.join(dirpath, name)
+                st = os.lstat(full)
+                files += 1
+                size += st.st_size
+                mtime = max(mtime, st.st_mtime_ns)
+                if hash_contents:
+                    entries.append((os.path.relpath(full, path), full))
+
+        result = {"files": files, "size": size, "mtime": mtime}
+        if hash_contents:
+            digest = hashlib.sha256()
+            for relpath, full in entries:
+                digest.update(relpath.encode("utf-8", "surrogateescape"))
+                digest.update(b"\0")
+                if os.path.islink(full):
+                    digest.update(b"link:")
+                    digest.update(os.readlink(full).encode(
+                        "utf-8", "surrogateescape"))
+                else:
+                    digest.update(_file_digest(full).encode("ascii"))
+                digest.update(b"\0")
+            result["sha256"] = digest.hexdigest()
+        return result
+
+
+def _file_digest(path):
+    """
+    Returns the hex SHA-256 digest of the contents of path
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
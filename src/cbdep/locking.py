@@ -0,0 +1,96 @@
+"""
+Inter-process file locking
+"""
+
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger('cbdep')
+
+
+class FileLock:
+    """
+    Exclusive advisory lock on a lock file, shared between processes (and
+    between threads, as each FileLock opens the file separately). Usable
+    as a context manager, which blocks until the lock is acquired; after
+    entering, "waited" is True if another holder had to be waited for.
+    """
+
+    def __init__(self, path):
+        """
+        Initialize a lock on the specified pathlib handle. The file (and
+        its parent directory) is created if necessary.
+        """
+
+        self.path = path
+        self.waited = False
+        self._fd = None
+
+    def acquire(self, blocking=True):
+        """
+        Acquires the lock, returning True. If blocking is False and the
+        lock is held elsewhere, returns False immediately.
+        """
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        self.waited = False
+        if self._try_lock():
+            return True
+        if not blocking:
+            os.close(self._fd)
+            self._fd = None
+            return False
+
+        self.waited = True
+        logger.debug(f"Waiting for lock {self.path}")
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        else:
+            while not self._try_lock():
+                time.sleep(0.1)
+        return True
+
+    def release(self):
+        """
+        Releases the lock
+        """
+
+        if self._fd is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        else:
+            os.lseek(self._fd, 0, os.SEEK_SET)
+            msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        os.close(self._fd)
+        self._fd = None
+
+    def _try_lock(self):
+        """
+        Attempts to acquire the lock without blocking
+        """
+
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
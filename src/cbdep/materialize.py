@@ -0,0 +1,71 @@
+"""
+Fast copying of directory trees
+"""
+
+import errno
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Ways of materializing a tree:
+#   link - hard links; the copy shares files with the original, so
+#       neither may be modified in place
+#   reflink - copy-on-write clones, on filesystems which support them
+#       (eg. btrfs, XFS); otherwise ordinary copies
+#   copy - ordinary copies
+MATERIALIZE_MODES = ["link", "reflink", "copy"]
+
+# ioctl request number of Linux's FICLONE
+FICLONE = 0x40049409
+
+
+def materialize(source, target, mode="reflink"):
+    """
+    Recreates the directory tree "source" as the new directory "target",
+    using "mode" (one of MATERIALIZE_MODES) for files. Modes which the
+    filesystem does not support fall back to copying.
+    """
+
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError(f"Unknown materialize mode {mode}")
+    copy_function = {
+        "link": _link,
+        "reflink": _reflink,
+        "copy": shutil.copy2,
+    }[mode]
+    shutil.copytree(source, target, symlinks=True,
+                    copy_function=copy_function)
+
+
+def _link(source, target):
+    """
+    Hard links source to target, or copies it if that isn't possible
+    """
+
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _reflink(source, target):
+    """
+    Clones source to target, or copies it if that isn't possible
+    """
+
+    if fcntl is None:
+        return shutil.copy2(source, target)
+
+    try:
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError as e:
+        if e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                           errno.EINVAL, errno.ENOSYS):
+            raise
+        return shutil.copy2(source, target)
+    shutil.copystat(source, target)
@@ -0,0 +1,93 @@
+"""
+Resolution of packages for many target systems at once
+"""
+
+import itertools
+import logging
+
+from cbdep.platform_introspection import get_arches, get_target_platforms
+from cbdep.scheduler import DependencyGraph
+
+logger = logging.getLogger('cbdep')
+
+# Default platforms and arches combined by "cbdep resolve --matrix"
+MATRIX_PLATFORMS = ["linux", "windows", "macos"]
+MATRIX_ARCHES = ["x86_64", "aarch64"]
+
+
+def matrix_targets(platforms=None, arches=None):
+    """
+    Returns a list of (name, list of platforms, arch) targets for every
+    combination of the platforms and arches (default MATRIX_PLATFORMS and
+    MATRIX_ARCHES). Each platform is a target name, as accepted by
+    get_target_platforms().
+    """
+
+    if platforms is None:
+        platforms = MATRIX_PLATFORMS
+    if arches is None:
+        arches = MATRIX_ARCHES
+    return [
+        (platform, get_target_platforms(platform), arch)
+        for platform, arch in itertools.product(platforms, arches)
+    ]
+
+
+def resolve_matrix(installer, items, targets, install_dir):
+    """
+    Resolves each of "items", tuples of (package, version, base_url,
+    force_cbdeps), for each of "targets", tuples of (name, list of
+    platforms, arch or None), without downloading anything. "installer"
+    is a template Installer whose configuration is used. Returns a list of
+    dictionaries, one for each package available for a target and each
+    of its nested 'cbdep' dependencies, with keys:
+        package, version - the package
+        platform, arch - the name and arch of the target
+        urls - list of the URLs (all alternatives, in order) of each of
+            its 'url' actions
+    """
+
+    results = []
+    for name, platforms, arch in targets:
+        template = installer.copy()
+        template.platforms = list(platforms)
+        template.arches = get_arches(arch, platforms)
+        label = (name, arch or template.arches[0])
+        seen = set()
+        pending = [
+            (package, version, install_dir, base_url, force_cbdeps)
+            for package, version, base_url, force_cbdeps in items
+        ]
+        while pending:
+            package, version, inst_dir, base_url, force_cbdeps = \
+                pending.pop(0)
+            key = installer.install_key(
+                package, version, inst_dir, base_url, force_cbdeps)
+            if key in seen:
+                continue
+            seen.add(key)
+
+            resolver = template.copy()
+            block = resolver.resolve(
+                package, version, base_url, inst_dir, force_cbdeps,
+                required=False
+            )
+            if block is None:
+                logger.debug(
+                    f"{package} {version} is not available for "
+                    f"{label[0]}/{label[1]}"
+                )
+                continue
+            nested, urls = DependencyGraph.plan(resolver, block)
+            results.append({
+                "package": package,
+                "version": version,
+                "platform": label[0],
+                "arch": label[1],
+                "urls": urls,
+            })
+            pending.extend(
+                (dep_package, dep_version, dep_dir, base_url, False)
+                for dep_package, dep_version, dep_dir in nested
+            )
+    return results
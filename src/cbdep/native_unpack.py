@@ -0,0 +1,151 @@
+"""
+Unpacking of compressed tar archives using native decompressors.
+
+Python's gzip, bz2 and lzma modules decompress on a single core. Where
+a faster (usually multi-threaded) decompressor is installed on the host,
+the archive is piped through it into tarfile's streaming mode instead;
+otherwise, or if the decompressor fails, shutil's usual pure-Python
+unpacker is used. This also adds
+support for zstd-compressed tar archives, when zstd is installed.
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+
+logger = logging.getLogger('cbdep')
+
+# Commands which decompress stdin to stdout, for each shutil unpack
+# format, in order of preference. Use add_decompressor() to add more.
+DECOMPRESSORS = {
+    "gztar": [["pigz", "-d", "-c"]],
+    "bztar": [["lbzip2", "-d", "-c"], ["pbzip2", "-d", "-c"]],
+    "xztar": [["xz", "-T0", "-d", "-c"]],
+    "zstdtar": [["zstd", "-d", "-c", "-q"]],
+}
+
+# Archive formats which shutil itself doesn't know about, with their
+# extensions and descriptions
+EXTRA_FORMATS = {
+    "zstdtar": ([".tar.zst", ".tzst"], "zstd'ed tar-file"),
+}
+
+# Set this environment variable to 0 to always use the pure-Python path
+ENABLE_VARIABLE = "CBDEP_NATIVE_DECOMPRESS"
+
+
+def add_decompressor(format, command):
+    """
+    Makes the decompressor "command" (a list of the executable and its
+    arguments, which must decompress stdin to stdout) the first choice
+    for the shutil unpack format "format"
+    """
+
+    DECOMPRESSORS.setdefault(format, []).insert(0, list(command))
+
+
+def find_decompressor(format):
+    """
+    Returns the command line of the preferred decompressor installed on
+    this host for "format", or None
+    """
+
+    if os.environ.get(ENABLE_VARIABLE, "1") == "0":
+        return None
+    for command in DECOMPRESSORS.get(format, []):
+        executable = shutil.which(command[0])
+        if executable is not None:
+            return [executable] + command[1:]
+    return None
+
+
+def _unpack_tarfile_native(filename, extract_dir, format, **kwargs):
+    """
+    Unpack compressed tar `filename` to `extract_dir`, using a native
+    decompressor for `format` if possible
+    """
+
+    command = find_decompressor(format)
+    if command is None:
+        if format in EXTRA_FORMATS:
+            raise shutil.ReadError(
+                f"No decompressor available for {filename}")
+        return shutil._unpack_tarfile(filename, extract_dir, **kwargs)
+
+    logger.debug(f"Decompressing {filename} with {command[0]}")
+
+    # Errors go to a file rather than a pipe, which could fill up (and so
+    # block the decompressor) while we're reading its output
+    with tempfile.TemporaryFile() as errors:
+        try:
+            with open(filename, 'rb') as f:
+                proc = subprocess.Popen(
+                    command, stdin=f,
+                    stdout=subprocess.PIPE, stderr=errors
+                )
+        except OSError as e:
+            logger.debug(f"Unable to run {command[0]}: {e}")
+            return shutil._unpack_tarfile(filename, extract_dir, **kwargs)
+
+        error = None
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                tar.extractall(extract_dir, **kwargs)
+            # Read any padding after the end of the archive, so that the
+            # decompressor doesn't fail writing to a closed pipe
+            while proc.stdout.read(1024 * 1024):
+                pass
+        except tarfile.TarError as e:
+            error = e
+        except:
+            proc.kill()
+            raise
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+
+        if error is None and returncode == 0:
+            return
+        errors.seek(0)
+        stderr = errors.read().decode(errors="replace").strip()
+
+    message = f"Unable to unpack {filename} with {command[0]}: " \
+        f"{stderr or error or f'exit code {returncode}'}"
+    if format in EXTRA_FORMATS:
+        raise shutil.ReadError(message)
+
+    # Eg. a newer format variant the decompressor doesn't support; the
+    # pure-Python unpacker overwrites anything already extracted
+    logger.debug(f"{message}; falling back to Python unpacker")
+    return shutil._unpack_tarfile(filename, extract_dir, **kwargs)
+
+
+def register():
+    """
+    Configures shutil.unpack_archive to use native decompressors for
+    compressed tar archives
+    """
+
+    extensions = {
+        name: exts for name, exts, _ in shutil.get_unpack_formats()
+    }
+    descriptions = {
+        name: description for name, _, description
+        in shutil.get_unpack_formats()
+    }
+    for format in DECOMPRESSORS:
+        if format in extensions:
+            shutil.unregister_unpack_format(format)
+            format_extensions = extensions[format]
+            description = descriptions[format]
+        elif format in EXTRA_FORMATS:
+            format_extensions, description = EXTRA_FORMATS[format]
+        else:
+            continue
+        shutil.register_unpack_format(
+            format, format_extensions, _unpack_tarfile_native,
+            [("format", format)], description
+        )
@@ -2,55 +2,144 @@
 Functions for determining current platform information
 """
 
+import functools
+import json
+import logging
+import os
 import platform
 
-_platforms = None
-_arch = None
+logger = logging.getLogger('cbdep')
+
+_cache_file = None
+
+# Target system names accepted by get_target_platforms(), and the
+# platform.system() of each
+TARGET_SYSTEMS = {
+    "linux": "linux",
+    "darwin": "darwin",
+    "mac": "darwin",
+    "macos": "darwin",
+    "windows": "windows",
+    "win": "windows",
+}
+
+# Bump this when the results of introspection change
+CACHE_VERSION = 1
+
+# Files whose contents determine the introspected Linux distribution,
+# as read by the "distro" module
+_RELEASE_FILES = ["/etc/os-release", "/usr/lib/os-release", "/etc/lsb-release"]
+
+# Changes on every boot, so that eg. in-place OS upgrades are noticed
+_BOOT_ID_FILE = "/proc/sys/kernel/random/boot_id"
 
 _intel_arches = ["x86_64", "amd64", "x64"]
 _arm_arches = ["aarch64", "arm64", "aarch_64"]
 
-def override_platforms(platforms):
+def set_cache_file(cache_file):
+    """
+    Save introspected platforms in cache_file, and reuse them from there
+    in later processes until the system is rebooted or its release files
+    change. None disables this.
+    """
+
+    global _cache_file
+    _cache_file = cache_file
+
+def _cache_key():
     """
-    Set platform to a specific value or values, to suppress introspection
+    Returns a value identifying the current boot and OS release, or None
+    if there isn't one
     """
 
-    global _platforms
-    _platforms = platforms
+    try:
+        with open(_BOOT_ID_FILE) as f:
+            boot_id = f.read().strip()
+    except OSError:
+        return None
 
-def override_arch(arch):
+    release_files = {}
+    for release_file in _RELEASE_FILES:
+        try:
+            st = os.stat(release_file)
+        except OSError:
+            continue
+        release_files[release_file] = [st.st_ino, st.st_size, st.st_mtime_ns]
+
+    # Containers share the boot ID of their host, but usually not its
+    # host name
+    return {
+        "version": CACHE_VERSION,
+        "boot_id": boot_id,
+        "node": platform.node(),
+        "system": platform.system(),
+        "release_files": release_files,
+    }
+
+def _load_cached_platforms(key):
     """
-    Set initial architecture to specific value - additional synonyms may
-    still be added
+    Returns the platforms saved in the cache file with key, or None
     """
 
-    global _arch
-    _arch = arch
+    try:
+        with open(_cache_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("key") != key:
+        return None
+    return cached.get("platforms")
 
+def _save_cached_platforms(key, platforms):
+    """
+    Saves platforms to the cache file with key
+    """
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(_cache_file)),
+                    exist_ok=True)
+        temp = f"{_cache_file}.{os.getpid()}.tmp"
+        with open(temp, "w") as f:
+            json.dump({"key": key, "platforms": platforms}, f)
+        os.replace(temp, _cache_file)
+    except OSError as e:
+        # Only an optimization
+        logger.debug(f"Unable to save platforms to {_cache_file}: {e}")
+
+@functools.lru_cache(maxsize=None)
 def get_platforms():
     """
     Returns a list of increasingly-generic identifiers for the current
     system.
     """
 
-    global _platforms
-    if _platforms is not None:
-        return _platforms
+    key = None
+    if _cache_file is not None:
+        key = _cache_key()
+        if key is not None:
+            platforms = _load_cached_platforms(key)
+            if platforms is not None:
+                return platforms
+
+    platforms = _introspect_platforms()
+    if key is not None:
+        _save_cached_platforms(key, platforms)
+    return platforms
+
+def _introspect_platforms():
+    """
+    Determines the list returned by get_platforms()
+    """
 
     # Start with the most generic - the OS
     system = platform.system().lower()
 
-    # Initialize list with the system.
-    _platforms = [system]
-
-    # OS-specific stuff
+    dist_id = None
+    dist_ver = None
     if system == "linux":
         import distro
 
-        # Add distro-specific variants
         dist_id = distro.id()
-        _platforms.insert(0, dist_id)
-
         if dist_id == "ubuntu":
             # Ubuntu "minor" versions are distinct, eg., Ubuntu 16.10
             # is potentially quite different from Ubuntu 16.04. So we
@@ -62,47 +151,79 @@ def get_platforms():
             # Use only the major version number.
             dist_ver = distro.major_version()
 
-        _platforms.insert(0, f"{dist_id}{dist_ver}")
-        _platforms.insert(0, f"{dist_id}-{dist_ver}")
+    return get_system_platforms(system, dist_id, dist_ver)
 
-        if dist_id == "sles" or dist_id.startswith("opensuse"):
-            # Cbdeps 1.0, at least, refers to all SUSE as "suse", so offer
-            # those as platform names too
-            dist_id = "suse"
-            _platforms.insert(0, dist_id)
-            _platforms.insert(0, f"{dist_id}{dist_ver}")
-            _platforms.insert(0, f"{dist_id}-{dist_ver}")
+def get_system_platforms(system, dist_id=None, dist_ver=None):
+    """
+    Returns the list of platforms get_platforms() would return on the
+    system "system" (as from platform.system(), eg. "linux", "darwin" or
+    "windows"), and for Linux, the distribution dist_id version dist_ver
+    if specified
+    """
+
+    system = system.lower()
+
+    # Initialize list with the system.
+    platforms = [system]
+
+    # OS-specific stuff
+    if system == "linux":
+        if dist_id is not None:
+            # Add distro-specific variants
+            platforms.insert(0, dist_id)
+            platforms.insert(0, f"{dist_id}{dist_ver}")
+            platforms.insert(0, f"{dist_id}-{dist_ver}")
+
+            if dist_id == "sles" or dist_id.startswith("opensuse"):
+                # Cbdeps 1.0, at least, refers to all SUSE as "suse", so
+                # offer those as platform names too
+                dist_id = "suse"
+                platforms.insert(0, dist_id)
+                platforms.insert(0, f"{dist_id}{dist_ver}")
+                platforms.insert(0, f"{dist_id}-{dist_ver}")
 
         # Add the "target triple" version
         if dist_id == "alpine":
-            _platforms.insert(0, "unknown-linux-musl")
+            platforms.insert(0, "unknown-linux-musl")
         else:
-            _platforms.insert(0, "unknown-linux-gnu")
+            platforms.insert(0, "unknown-linux-gnu")
 
     elif system == "darwin":
-        _platforms.insert(0, "apple-darwin")
-        _platforms.insert(0, "macosx")
-        _platforms.insert(0, "macos")
-        _platforms.insert(0, "mac")
-        _platforms.insert(0, "osx")
+        platforms.insert(0, "apple-darwin")
+        platforms.insert(0, "macosx")
+        platforms.insert(0, "macos")
+        platforms.insert(0, "mac")
+        platforms.insert(0, "osx")
 
     elif system == "windows":
         # QQQ Somehow introspect MSVC version?
-        _platforms.insert(0, "windows_msvc2015")
-        _platforms.insert(0, "windows_msvc2017")
-        _platforms.insert(0, "pc-windows-msvc")
-        _platforms.insert(0, "win")
+        platforms.insert(0, "windows_msvc2015")
+        platforms.insert(0, "windows_msvc2017")
+        platforms.insert(0, "pc-windows-msvc")
+        platforms.insert(0, "win")
+
+    return platforms
+
+def get_target_platforms(target):
+    """
+    Returns the list of platforms for a target system named "target":
+    one of the systems in TARGET_SYSTEMS, or else a comma-separated list
+    of platforms as for --platform
+    """
 
-    return _platforms
+    system = TARGET_SYSTEMS.get(target.casefold())
+    if system is not None:
+        return get_system_platforms(system)
+    return [platform for platform in target.split(",") if platform]
 
-def _alpine_mod(arches):
+def _alpine_mod(arches, platforms):
     """
     If this is Alpine Linux, append "musl" and "alpine" to each arch
     entry in arches. This appears to be a common convention (at least
     nodejs, dotnet, and Bellsoft OpenJDK use it).
     """
 
-    if "alpine" not in get_platforms():
+    if "alpine" not in platforms:
         return arches.copy()
     # Ensure the -musl and -alpine variants appear first for all arches
     # - we don't want, eg., a plain "x86_64" to be on the list before
@@ -112,29 +233,38 @@ def _alpine_mod(arches):
         for arch in arches
     ]
 
-def get_arches():
+def get_arches(arch=None, platforms=None):
     """
-    Returns a list of possible architectures based on the current system
+    Returns a list of possible architectures based on the current system,
+    or on the machine type "arch" and list of platforms "platforms" if
+    specified
     """
 
-    global _arch, _intel_arches, _arm_arches
-
-    # Start from "machine" type (possibly overridden)
-    if _arch is not None:
-        arch = _arch
-    else:
+    # Start from "machine" type
+    if arch is None:
         arch = platform.machine().casefold()
+    if platforms is None:
+        platforms = get_platforms()
+
+    return list(_arches_for(arch, tuple(platforms)))
+
+@functools.lru_cache(maxsize=None)
+def _arches_for(arch, platforms):
+    """
+    Returns the tuple of architectures for get_arches(), given the machine
+    type "arch" and the tuple of platforms
+    """
 
     # If we recognize this as being Intel or ARM, return a set of common
     # synonyms
     if arch in _intel_arches:
-        return _alpine_mod(_intel_arches)
+        return tuple(_alpine_mod(_intel_arches, platforms))
     if arch in _arm_arches:
-        return _alpine_mod(_arm_arches)
+        return tuple(_alpine_mod(_arm_arches, platforms))
     # Otherwise, just return what we've got
-    return _alpine_mod([arch])
+    return tuple(_alpine_mod([arch], platforms))
 
-def get_default_arches(cbdeps_arches=False):
+def get_default_arches(cbdeps_arches=False, platforms=None):
     """
     Returns a platform-dependent value suitable for if_arch directives.
     Important: this is a list of arch names most frequently used in *package*
@@ -143,18 +273,31 @@ def get_default_arches(cbdeps_arches=False):
     if_arch works, only the first will ever get matched. Basically these
     should contain just the most common name (if any) for "32-bit Intel",
     "64-bit Intel", "64-bit ARM", and any other supported arches on each OS.
+    The value is for the current system, or for the list of platforms
+    "platforms" if specified.
+    """
+
+    if platforms is None:
+        platforms = get_platforms()
+    return list(_default_arches_for(tuple(platforms), cbdeps_arches))
+
+@functools.lru_cache(maxsize=None)
+def _default_arches_for(platforms, cbdeps_arches):
+    """
+    Returns the tuple of arches for get_default_arches(), given the tuple
+    of platforms
     """
 
-    for plat in get_platforms():
+    for plat in platforms:
         if plat.startswith("win"):
             if cbdeps_arches:
-                return ["x86", "amd64", "arm64"]
+                return ("x86", "amd64", "arm64")
             else:
-                return ["x86", "x86_64", "arm64"]
+                return ("x86", "x86_64", "arm64")
         elif "darwin" in plat or "mac" in plat:
-            return ["x86_64", "arm64"]
+            return ("x86_64", "arm64")
         elif "android" in plat:
-            return ["armv7a", "aarch64", "i686", "x86_64"]
+            return ("armv7a", "aarch64", "i686", "x86_64")
 
     # Didn't find anything else, so return the list for Linux, including Alpine
-    return ["x86", "x86_64", "aarch64", "x64-musl"]
+    return ("x86", "x86_64", "aarch64", "x64-musl")
@@ -0,0 +1,286 @@
+"""
+Scheduling of nested cbdep installs
+"""
+
+import logging
+import os
+import sys
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger("cbdep")
+
+# Default number of concurrent downloads or installs
+DEFAULT_JOBS = 8
+
+
+class Node:
+    """
+    A single install in a DependencyGraph: the Installer which has
+    resolved it, its descriptor block, and the keys of the installs which
+    must be completed first
+    """
+
+    def __init__(self, key, installer, block, deps):
+        self.key = key
+        self.installer = installer
+        self.block = block
+        self.deps = deps
+
+        # Blocks which change the environment of the cbdep process, or
+        # run commands (which may share state outside the install
+        # directory, such as ~/.pyenv) are not installed concurrently with
+        # anything else
+        self.exclusive = "set_env" in block or any(
+            "run" in action for action in block.get("actions") or [])
+
+
+class DependencyGraph:
+    """
+    Directed acyclic graph of installs. Adding a package resolves it and
+    walks its descriptor block for nested 'cbdep' actions, which are added
+    as its dependencies (recursively). Identical installs are only added
+    once, however many packages depend on them. fetch() then downloads the
+    files for every install concurrently, and run() installs the packages
+    which were added, independent ones concurrently.
+
+    Nested installs are still performed by their 'cbdep' actions, at their
+    position in the block; the graph only ensures that each is performed
+    once, and that packages sharing a nested install are not installed at
+    the same time. Blocks which run commands or set environment variables
+    (most of them, in practice) are never installed concurrently, so the
+    main benefits are concurrent downloads and de-duplicated installs.
+
+    Installs are identified by a key as returned by Installer.install_key().
+    Nested installs whose arguments can't be determined without running
+    the block (eg. because they refer to ${DL}) are left to the block to
+    perform itself, as usual.
+    """
+
+    def __init__(self, installer, include_nested=True):
+        """
+        "installer" is a template Installer whose configuration, cache and
+        options are used for every install. If include_nested is False,
+        nested 'cbdep' actions are ignored.
+        """
+
+        self.installer = installer
+        self.include_nested = include_nested
+        self.nodes = {}
+        self.roots = []
+        self._visiting = []
+
+    def add(self, package, version, install_dir, base_url=None,
+            force_cbdeps=False, required=True):
+        """
+        Adds an install of package, and the installs it depends on, to
+        the graph. Returns its key. If "required" is False and no
+        descriptor block of package (or of an install it depends on) is
+        appropriate for the installer's system, nothing is added and None
+        is returned.
+        """
+
+        key = self._add(package, version, install_dir, base_url,
+                        force_cbdeps, required)
+        if key is not None and key not in self.roots:
+            self.roots.append(key)
+        return key
+
+    def _add(self, package, version, install_dir, base_url=None,
+             force_cbdeps=False, required=True):
+        """
+        Adds an install to the graph, as for add(), without making it a
+        root
+        """
+
+        install_dir = os.path.abspath(install_dir)
+        key = self.installer.install_key(
+            package, version, install_dir, base_url, force_cbdeps)
+        if key in self.nodes:
+            logger.debug(f"Already scheduled {package} {version}")
+            return key
+        if key in self._visiting:
+            logger.error(
+                f"Circular cbdep dependency on {package} {version}")
+            sys.exit(1)
+
+        installer = self.installer.copy()
+        installer.set_recache(self.installer.recache)
+        installer.set_cache_only(self.installer.cache_only)
+        block = installer.resolve(
+            package, version, base_url, install_dir, force_cbdeps, required)
+        if block is None:
+            return None
+
+        self._visiting.append(key)
+        deps = []
+        try:
+            if self.include_nested:
+                for dep in self.nested(installer, block):
+                    dep_key = self._add(
+                        *dep, base_url=base_url, required=required)
+                    if dep_key is None:
+                        return None
+                    deps.append(dep_key)
+        finally:
+            self._visiting.pop()
+
+        self.nodes[key] = Node(key, installer, block, deps)
+        return key
+
+    @staticmethod
+    def nested(installer, block):
+        """
+        Returns a list of (package, version, install dir) for the 'cbdep'
+        actions in block, as resolved by installer, without executing it
+        """
+
+        return DependencyGraph.plan(installer, block)[0]
+
+    @staticmethod
+    def plan(installer, block):
+        """
+        Returns a tuple of the list of (package, version, install dir) for
+        the 'cbdep' actions in block, and the list of URLs (all
+        alternatives, in order) of each of its 'url' actions, as resolved
+        by installer, without executing it
+        """
+
+        # Track the effect of the actions which change the symbols
+        # on a scratch copy of the installer
+        scratch = installer.copy()
+        scratch.package = installer.package
+        scratch.version = installer.version
+        scratch.base_url = installer.base_url
+        scratch.installdir = installer.installdir
+        scratch.symbols = dict(installer.symbols)
+        if "base_url" in block:
+            scratch.handle_base_url(block["base_url"])
+
+        nested = []
+        urls = []
+        for action in block.get("actions") or []:
+            try:
+                if "fixed_dir" in action and scratch.handle_fixed_dir(action):
+                    continue
+                if "url" in action:
+                    alternatives = action["url"]
+                    if not isinstance(alternatives, list):
+                        alternatives = [alternatives]
+                    urls.append(
+                        [scratch.templatize(url) for url in alternatives])
+                elif "install_dir" in action and "cbdep" not in action:
+                    scratch.do_install_dir(action)
+                elif "cbdep" in action:
+                    nested.append((
+                        action["cbdep"],
+                        str(action["version"]),
+                        scratch.templatize(
+                            action.get("install_dir", scratch.installdir)),
+                    ))
+            except (KeyError, ValueError) as e:
+                # Depends on something only known while installing
+                logger.debug(f"Not resolving {action} in advance: {e}")
+        return nested, urls
+
+    def subtree(self, key):
+        """
+        Returns the set of keys of the install "key" and all the installs
+        it depends on, directly or indirectly
+        """
+
+        keys = set()
+        pending = [key]
+        while pending:
+            key = pending.pop()
+            if key not in keys:
+                keys.add(key)
+                pending.extend(self.nodes[key].deps)
+        return keys
+
+    def fetch(self, jobs=DEFAULT_JOBS):
+        """
+        Downloads the files for every install in the graph, using up to
+        "jobs" threads
+        """
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = [
+                executor.submit(node.installer.fetch_block, node.block)
+                for node in self.nodes.values()
+            ]
+            for future in futures:
+                future.result()
+
+    def run(self, jobs=DEFAULT_JOBS):
+        """
+        Installs the packages added to the graph, and so their nested
+        installs, using up to "jobs" threads. Packages which share any
+        install, or contain exclusive blocks, are installed one at a time,
+        in the order they were added.
+        """
+
+        subtrees = {key: self.subtree(key) for key in self.roots}
+        exclusive = {
+            key: any(self.nodes[k].exclusive for k in subtree)
+            for key, subtree in subtrees.items()
+        }
+        pending = list(self.roots)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            while pending or running:
+                if error is None:
+                    # Keys which earlier (running or pending) packages
+                    # will install
+                    claimed = set()
+                    for node in running.values():
+                        claimed |= subtrees[node.key]
+                    blocked = any(exclusive[n.key] for n in running.values())
+                    for key in list(pending):
+                        startable = not (
+                            blocked or claimed & subtrees[key]
+                            or (running and exclusive[key]))
+                        claimed |= subtrees[key]
+                        if exclusive[key]:
+                            blocked = True
+                        if not startable:
+                            continue
+                        pending.remove(key)
+                        node = self.nodes[key]
+                        running[executor.submit(self._install, node)] = node
+                elif not running:
+                    break
+
+                if not running:
+                    # Should be impossible: the first pending package can
+                    # always start once nothing is running
+                    logger.error("Unable to schedule remaining installs")
+                    sys.exit(1)
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    try:
+                        future.result()
+                    except BaseException as e:
+                        if error is None:
+                            error = e
+
+        if error is not None:
+            raise error
+
+    @staticmethod
+    def _install(node):
+        """
+        Executes the block of node, and records that it is complete
+        """
+
+        installer = node.installer
+        if node.key in installer.completed:
+            logger.debug(
+                f"{installer.package} {installer.version} already installed "
+                f"as a nested install")
+            return
+        logger.info(f"Installing {installer.package} {installer.version}")
+        installer.execute_block(node.block)
+        installer.completed.add(node.key)
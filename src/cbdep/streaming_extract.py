@@ -0,0 +1,139 @@
+"""
+Extraction of tar archives while they are being downloaded
+"""
+
+import logging
+import queue
+import tarfile
+import threading
+
+logger = logging.getLogger('cbdep')
+
+# Maximum number of downloaded chunks waiting to be extracted. When
+# extraction falls behind, the download is slowed down to match.
+STREAM_QUEUE_CHUNKS = 16
+
+
+class _QueueReader:
+    """
+    Minimal read-only file object returning the chunks placed on a queue,
+    until a None chunk marks the end of the data
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.current = b""
+        self.pos = 0
+        self.eof = False
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos >= len(self.current):
+                if self.eof:
+                    break
+                chunk = self.chunks.get()
+                if chunk is None:
+                    self.eof = True
+                    break
+                self.current, self.pos = chunk, 0
+            available = len(self.current) - self.pos
+            count = available if size < 0 else min(size, available)
+            parts.append(self.current[self.pos:self.pos + count])
+            self.pos += count
+            if size > 0:
+                size -= count
+        return b"".join(parts)
+
+    def drain(self):
+        """
+        Discards all remaining data
+        """
+
+        self.current = b""
+        while not self.eof:
+            if self.chunks.get() is None:
+                self.eof = True
+
+
+class StreamingExtractor:
+    """
+    Extracts a (possibly compressed) tar archive into a directory from
+    data passed to write(), in a background thread, so that extraction
+    overlaps with downloading. Anything which is not a tar archive, or
+    which can not be extracted from a stream, makes finish() return
+    False; the caller should then extract the complete file as usual.
+    """
+
+    def __init__(self, directory):
+        """
+        Starts extracting into "directory", which must exist
+        """
+
+        self.directory = directory
+        self.error = None
+        self._chunks = queue.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        self._complete = False
+        self._ended = False
+        self._thread = threading.Thread(target=self._extract, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        """
+        Passes the next chunk of the archive to the extractor
+        """
+
+        if not self._ended:
+            self._chunks.put(bytes(data))
+
+    def close(self):
+        """
+        Marks the end of the archive; all of it has been written
+        """
+
+        self._end(complete=True)
+
+    def abort(self):
+        """
+        Marks that the archive will not be completely written, eg. because
+        its download failed
+        """
+
+        self._end(complete=False)
+
+    def finish(self):
+        """
+        Waits for the extraction to finish. Returns True if the whole
+        archive was written and successfully extracted.
+        """
+
+        self.abort()
+        self._thread.join()
+        if self.error is not None:
+            logger.debug(f"Streaming extraction failed: {self.error}")
+        return self._complete and self.error is None
+
+    def _end(self, complete):
+        """
+        Implementation of close() and abort(); only the first call counts
+        """
+
+        if not self._ended:
+            self._ended = True
+            self._complete = complete
+            self._chunks.put(None)
+
+    def _extract(self):
+        """
+        Thread body: extracts the archive from the queued chunks
+        """
+
+        reader = _QueueReader(self._chunks)
+        try:
+            with tarfile.open(fileobj=reader, mode="r|*") as tar:
+                tar.extractall(self.directory)
+        except Exception as e:
+            self.error = e
+        finally:
+            # Keep consuming, so write() never blocks on a full queue
+            reader.drain()
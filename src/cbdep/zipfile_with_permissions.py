@@ -1,6 +1,8 @@
 import os
 import sys
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from shutil import ReadError, _ensure_directory, copyfileobj, register_unpack_format, unregister_unpack_format
 
 """
@@ -30,6 +32,52 @@ class ZipFileWithPermissions(zipfile.ZipFile):
 
         return targetpath
 
+    def extractall_parallel(self, path, workers=None):
+        """
+        Like extractall(), but decompresses files using a pool of "workers"
+        threads (default: one per CPU), each reading the archive through
+        its own file handle. Directories are created first, in order.
+        """
+        path = os.fspath(path)
+        if workers is None:
+            workers = os.cpu_count() or 1
+        members = self.infolist()
+        files = [m for m in members if not m.is_dir()]
+        if workers < 2 or len(files) < 2 or self.filename is None:
+            return self.extractall(path=path)
+
+        for member in members:
+            if member.is_dir():
+                self._extract_member(member, path, None)
+
+        # Largest files first, so no thread is left with a big one at
+        # the end
+        files.sort(key=lambda m: m.file_size, reverse=True)
+        local = threading.local()
+        handles = []
+        handles_lock = threading.Lock()
+
+        def extract(member):
+            handle = getattr(local, "handle", None)
+            if handle is None:
+                handle = local.handle = ZipFileWithPermissions(self.filename)
+                with handles_lock:
+                    handles.append(handle)
+            try:
+                handle._extract_member(member, path, None)
+            except FileExistsError:
+                # Another thread created a parent directory between the
+                # check and the creation; that's fine, so try again
+                handle._extract_member(member, path, None)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in executor.map(extract, files):
+                    pass
+        finally:
+            for handle in handles:
+                handle.close()
+
 def _unpack_zipfile_with_permissions(filename, extract_dir):
     """
     Unpack zip `filename` to `extract_dir`
@@ -38,7 +86,7 @@ def _unpack_zipfile_with_permissions(filename, extract_dir):
         raise ReadError("%s is not a zip file" % filename)
 
     with ZipFileWithPermissions(filename) as zip:
-        zip.extractall(path=extract_dir)
+        zip.extractall_parallel(extract_dir)
 
 def register():
     """
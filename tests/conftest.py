@@ -0,0 +1,141 @@
+import email.utils
+import functools
+import io
+import json
+import os
+import pytest
+import tarfile
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_tarball(path, toplevel, contents, mode="w:gz"):
+    """
+    Creates a tarball containing a single file toplevel/README whose
+    text is contents
+    """
+    with tarfile.open(path, mode) as tar:
+        data = contents.encode("utf-8")
+        info = tarfile.TarInfo(f"{toplevel}/README")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def package_config(name, ext="tar.gz", urls=None,
+                   base_url="http://127.0.0.1:1", checksum_url=None):
+    """
+    Returns a descriptor for a package "name" which downloads the first
+    available of urls (default ${BASE_URL}/name-${VERSION}.ext), checked
+    against checksum_url if specified, and unpacks it. The default
+    base_url refuses connections.
+    """
+    if urls is None:
+        urls = f"${{BASE_URL}}/{name}-${{VERSION}}.{ext}"
+    checksum = f"\n          checksum_url: {checksum_url}" if checksum_url else ""
+    return f"""
+packages:
+  {name}:
+    - base_url: {base_url}
+      actions:
+        - url: {json.dumps(urls)}{checksum}
+        - unarchive:
+            toplevel_dir: {name}-${{VERSION}}
+"""
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler with support for simple byte-range requests.
+    The path of every GET request is appended to `paths`, the path of
+    every HEAD request to `heads`, and every Range header received is
+    appended to `ranges`.
+    """
+    paths = []
+    heads = []
+    ranges = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def do_HEAD(self):
+        self.heads.append(self.path)
+        return super().do_HEAD()
+
+    def do_GET(self):
+        self.paths.append(self.path)
+        path = self.translate_path(self.path)
+        rng = self.headers.get("Range")
+        if rng is None or not os.path.isfile(path):
+            return super().do_GET()
+        self.ranges.append(rng)
+
+        with open(path, "rb") as f:
+            data = f.read()
+        last_modified = email.utils.formatdate(
+            os.stat(path).st_mtime, usegmt=True)
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range != last_modified:
+            return super().do_GET()
+
+        first, last = rng.split("=")[1].split("-")
+        first = int(first)
+        last = int(last) if last else len(data) - 1
+        if first >= len(data):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(data)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = data[first:last + 1]
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {first}-{last}/{len(data)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Last-Modified", last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope="session")
+def http_server(tmp_path_factory):
+    """
+    Serves a temporary directory over HTTP on localhost. Yields a tuple
+    of (directory, base URL).
+    """
+    root = tmp_path_factory.mktemp("www")
+    handler = functools.partial(QuietHandler, directory=str(root))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield root, f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def tarball_package(http_server, tmp_path):
+    """
+    Returns a function make(name, version, ext="tar.gz", **kwargs) which
+    serves a tarball name-version.ext from http_server, and returns a
+    tuple of (Installer, base URL) for package_config(name, ext, **kwargs)
+    with a cache in tmp_path / "cache"
+    """
+    from cbdep.cache import Cache
+    from cbdep.install import Installer
+
+    root, base = http_server
+
+    def make(name, version, ext="tar.gz", **kwargs):
+        mode = "w:xz" if ext.endswith("xz") else "w:gz"
+        make_tarball(root / f"{name}-{version}.{ext}", f"{name}-{version}",
+                     version, mode)
+        config = package_config(name, ext, **kwargs)
+        installer = Installer.fromYaml(
+            config, Cache(tmp_path / "cache"), "linux", "x86_64")
+        return installer, base
+
+    return make
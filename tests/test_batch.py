@@ -0,0 +1,141 @@
+import pytest
+from conftest import make_tarball
+from cbdep.batch import BatchInstaller
+from cbdep.cache import Cache
+from cbdep.install import Installer
+
+config = """
+packages:
+  widget:
+    - base_url: http://127.0.0.1:1
+      actions:
+        - url: ${BASE_URL}/widget-${VERSION}.tar.gz
+        - unarchive:
+            toplevel_dir: widget-${VERSION}
+"""
+
+
+@pytest.fixture
+def installer(http_server, tmp_path):
+    root, base = http_server
+    for version in ["1.0", "2.0"]:
+        make_tarball(root / f"widget-{version}.tar.gz", f"widget-{version}",
+                     version)
+    installer = Installer.fromYaml(
+        config, Cache(tmp_path / "cache"), "linux", "x86_64")
+    return installer, base
+
+
+class TestBatchInstaller:
+
+    def test_parse_manifest(self):
+        entries = BatchInstaller.parse_manifest(
+            [{"package": "widget", "version": 1.5},
+             {"package": "gadget", "version": "2", "dir": "/opt"}],
+            "/install"
+        )
+        assert entries[0]["version"] == "1.5"
+        assert entries[0]["install_dir"] == "/install"
+        assert entries[1]["install_dir"] == "/opt"
+
+    def test_parse_manifest_malformed(self):
+        with pytest.raises(SystemExit):
+            BatchInstaller.parse_manifest([{"package": "widget"}], "/install")
+
+    def test_install(self, installer, tmp_path):
+        installer, base = installer
+        batch = BatchInstaller(installer, jobs=2)
+        batch.add("widget", "1.0", tmp_path / "a", base)
+        batch.add("widget", "2.0", tmp_path / "b", base)
+        batch.add("widget", "2.0", tmp_path / "b", base)
+        assert len(batch.items) == 2
+        batch.install()
+        assert (tmp_path / "a" / "widget-1.0" / "README").read_text() == "1.0"
+        assert (tmp_path / "b" / "widget-2.0" / "README").read_text() == "2.0"
+
+    def test_install_cache_only(self, installer, tmp_path):
+        installer, base = installer
+        installer.set_cache_only(True)
+        batch = BatchInstaller(installer)
+        batch.add("widget", "1.0", tmp_path / "a", base)
+        batch.install()
+        assert not (tmp_path / "a" / "widget-1.0").exists()
+
+    def test_install_cache_only_installed(self, installer, tmp_path):
+        installer, base = installer
+        installer.install("widget", "1.0", base, tmp_path / "a")
+
+        # -n still fills a (here, fresh) cache with installed packages
+        cache = Cache(tmp_path / "cache2")
+        installer = Installer(
+            installer.descriptor, cache, installer.platforms,
+            installer.arches)
+        installer.set_cache_only(True)
+        batch = BatchInstaller(installer)
+        batch.add("widget", "1.0", tmp_path / "a", base)
+        batch.install()
+        assert cache.lookup(f"{base}/widget-1.0.tar.gz") is not None
+
+    def test_unknown_package(self, installer, tmp_path):
+        batch = BatchInstaller(installer[0])
+        batch.add("nonesuch", "1.0", tmp_path / "a")
+        with pytest.raises(SystemExit):
+            batch.install()
+
+
+prefetch_config = """
+packages:
+  gadget:
+    - if_platform: linux
+      default_arches: true
+      base_url: http://127.0.0.1:1
+      actions:
+        - url: ${BASE_URL}/gadget-${VERSION}-${PLATFORM}-${ARCH}.tar.gz
+        - unarchive:
+            toplevel_dir: gadget
+    - if_platform: windows
+      default_arches: true
+      base_url: http://127.0.0.1:1
+      actions:
+        - url: ${BASE_URL}/gadget-${VERSION}-${PLATFORM}-${ARCH}.tar.gz
+        - unarchive:
+            toplevel_dir: gadget
+"""
+
+
+class TestPrefetcher:
+
+    def test_prefetch(self, http_server, tmp_path):
+        from cbdep.batch import Prefetcher
+        from cbdep.platform_introspection import get_arches
+        root, base = http_server
+        names = ["gadget-1.0-linux-aarch64.tar.gz",
+                 "gadget-1.0-windows-x86_64.tar.gz",
+                 "gadget-1.0-windows-arm64.tar.gz"]
+        for name in names:
+            make_tarball(root / name, "gadget", name)
+        cache = Cache(tmp_path / "cache")
+        installer = Installer.fromYaml(
+            prefetch_config, cache, "linux", "x86_64")
+        targets = [
+            (["linux"], get_arches("arm64", ["linux"])),
+            (["windows"], get_arches("x86_64", ["windows"])),
+            (["windows"], get_arches("aarch64", ["windows"])),
+            (["macos"], get_arches("arm64", ["macos"])),
+        ]
+        prefetcher = Prefetcher(installer, targets, jobs=4)
+        prefetcher.add("gadget", "1.0", base)
+        prefetcher.add("gadget", "1.0", base)
+        assert prefetcher.prefetch(tmp_path / "install") == 1
+        for name in names:
+            assert cache.lookup(f"{base}/{name}") is not None
+        assert not (tmp_path / "install").exists()
+
+    def test_unknown_package(self, tmp_path):
+        from cbdep.batch import Prefetcher
+        installer = Installer.fromYaml(
+            prefetch_config, Cache(tmp_path / "cache"), "linux", "x86_64")
+        prefetcher = Prefetcher(installer, [(["linux"], ["x86_64"])])
+        prefetcher.add("gadgte", "1.0")
+        with pytest.raises(SystemExit):
+            prefetcher.prefetch(tmp_path / "install")
@@ -1,3 +1,4 @@
+import os
 import pytest
 import requests
 import sys
@@ -81,3 +82,289 @@ class TestCache:
         assert md5(open(cachedir/name_sha["ubuntu"][0:2]/name_sha["ubuntu"]/filename["ubuntu"], "rb").read()).hexdigest() == hash["ubuntu"]
         self.cache.get(url["ubuntu"], recache=True)
         assert md5(open(cachedir/name_sha["ubuntu"][0:2]/name_sha["ubuntu"]/filename["ubuntu"], "rb").read()).hexdigest() == hash["ubuntu"]
+
+    def test_session(self):
+        session = self.cache.session
+        assert session is self.cache.session
+        adapter = session.get_adapter("https://packages.couchbase.com/")
+        assert adapter._pool_maxsize == self.cache.pool_size
+        assert adapter.max_retries.total == self.cache.retries
+
+    def test_get_local(self, http_server, tmp_path):
+        root, base = http_server
+        (root / "local.txt").write_bytes(b"hello" * 1000)
+        cache = Cache(tmp_path, connect_timeout=5.0, read_timeout=5.0)
+        assert cache.timeout == (5.0, 5.0)
+        cachefile = cache.get(f"{base}/local.txt")
+        assert cachefile.read_bytes() == b"hello" * 1000
+        assert cachefile.name == "local.txt"
+
+    def test_get_large(self, http_server, tmp_path):
+        root, base = http_server
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        (root / "large.bin").write_bytes(data)
+        cachefile = Cache(tmp_path).get(f"{base}/large.bin")
+        assert cachefile.read_bytes() == data
+
+    def test_get_resume(self, http_server, tmp_path):
+        from conftest import QuietHandler
+        root, base = http_server
+        data = os.urandom(100000)
+        (root / "resume.bin").write_bytes(data)
+        cache = Cache(tmp_path)
+        dl_url = f"{base}/resume.bin"
+        validator = cache.session.head(dl_url).headers["last-modified"]
+        cachedir = cache._cachedir(dl_url)
+        (cachedir / "download.part").write_bytes(data[:40000])
+        (cachedir / "download.validator").write_text(validator)
+        QuietHandler.ranges.clear()
+        assert cache.get(dl_url).read_bytes() == data
+        assert QuietHandler.ranges == ["bytes=40000-"]
+        assert not (cachedir / "download.part").exists()
+        assert not (cachedir / "download.validator").exists()
+
+    def test_get_resume_stale(self, http_server, tmp_path):
+        root, base = http_server
+        data = os.urandom(1000)
+        (root / "stale.bin").write_bytes(data)
+        cache = Cache(tmp_path)
+        dl_url = f"{base}/stale.bin"
+        cachedir = cache._cachedir(dl_url)
+        (cachedir / "download.part").write_bytes(b"x" * 500)
+        (cachedir / "download.validator").write_text("Thu, 01 Jan 1970 00:00:00 GMT")
+        assert cache.get(dl_url).read_bytes() == data
+
+    def test_get_segmented(self, http_server, tmp_path):
+        from conftest import QuietHandler
+        root, base = http_server
+        data = os.urandom(1000003)
+        (root / "segmented.bin").write_bytes(data)
+        cache = Cache(tmp_path, segments=4, segment_threshold=1000)
+        QuietHandler.ranges.clear()
+        assert cache.get(f"{base}/segmented.bin").read_bytes() == data
+        assert len(QuietHandler.ranges) == 4
+
+    def test_get_dedup(self, http_server, tmp_path):
+        root, base = http_server
+        data = os.urandom(5000)
+        (root / "dedup1.bin").write_bytes(data)
+        (root / "dedup2.bin").write_bytes(data)
+        cache = Cache(tmp_path)
+        file1 = cache.get(f"{base}/dedup1.bin")
+        file2 = cache.get(f"{base}/dedup2.bin")
+        assert file1.read_bytes() == file2.read_bytes() == data
+        assert file1.stat().st_ino == file2.stat().st_ino
+        sha = (file1.parent / "sha256").read_text()
+        assert cache._blobpath(sha).stat().st_ino == file1.stat().st_ino
+
+    def test_migrate(self, tmp_path):
+        cache = Cache(tmp_path)
+        for legacy_url in ["https://example.com/a.tgz", "https://mirror.example.com/a.tgz"]:
+            legacydir = cache._cachedir(legacy_url)
+            (legacydir / "a.tgz").write_bytes(b"legacy" * 100)
+            cache._writefilename(legacydir, "a.tgz")
+        assert cache.migrate() == 600
+        file1 = cache.get("https://example.com/a.tgz")
+        file2 = cache.get("https://mirror.example.com/a.tgz")
+        assert file1.read_bytes() == b"legacy" * 100
+        assert file1.stat().st_ino == file2.stat().st_ino
+        assert cache.migrate() == 0
+
+    def test_put_locked(self, tmp_path):
+        import threading
+        from cbdep.locking import FileLock
+        local = tmp_path / "local.tgz"
+        local.write_bytes(b"local")
+        cache = Cache(tmp_path / "cache")
+        put_url = "https://example.com/local.tgz"
+        cachedir = cache._cachedir(put_url)
+        (cachedir / "download.part").write_bytes(b"partial")
+
+        # put() waits for a download of the same URL to finish
+        lock = FileLock(cache._lockpath(put_url))
+        lock.acquire()
+        thread = threading.Thread(target=cache.put, args=(put_url, local))
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive()
+        assert (cachedir / "download.part").read_bytes() == b"partial"
+        lock.release()
+        thread.join()
+        assert cache.lookup(put_url).read_bytes() == b"local"
+        assert not (cachedir / "download.part").exists()
+
+    def test_gc(self, http_server, tmp_path):
+        root, base = http_server
+        for name in ["gc1.bin", "gc2.bin", "gc3.bin"]:
+            (root / name).write_bytes(name.encode() * 1000)
+        (root / "gc4.bin").write_bytes(b"gc3.bin" * 1000)
+        cache = Cache(tmp_path, max_size=15000)
+        files = [cache.get(f"{base}/gc{n}.bin") for n in range(1, 5)]
+        # gc1 is the least-recently used once the others have been hit
+        for n in range(4):
+            cache.index.update(f"{base}/gc{n + 1}.bin", last_access=1000 + n)
+        assert cache.gc() == 7000
+        assert not files[0].parent.exists()
+        assert files[1].exists() and files[2].exists() and files[3].exists()
+        # gc3 and gc4 share content, so evicting gc3 alone frees nothing
+        cache.index.update(f"{base}/gc2.bin", last_access=2000)
+        cache.max_size = 7000
+        assert cache.gc() == 7000
+        assert not files[2].parent.exists() and not files[3].parent.exists()
+        assert files[1].exists()
+
+    def test_gc_copied(self, http_server, tmp_path, monkeypatch):
+        import cbdep.cache
+        root, base = http_server
+        (root / "copy1.bin").write_bytes(b"copied" * 1000)
+        (root / "copy2.bin").write_bytes(b"copied" * 1000)
+        cache = Cache(tmp_path)
+
+        # Without hard links, entries hold copies of their blob
+        def no_link(src, dst):
+            raise OSError("hard links not supported")
+        monkeypatch.setattr(os, "link", no_link)
+        file1 = cache.get(f"{base}/copy1.bin")
+        file2 = cache.get(f"{base}/copy2.bin")
+        monkeypatch.undo()
+        blob = cache._blobpath((file1.parent / "sha256").read_text())
+        assert blob.stat().st_ino != file1.stat().st_ino
+
+        # The blob is still referenced, however old it is
+        monkeypatch.setattr(cbdep.cache, "GC_GRACE_PERIOD", -1)
+        assert cache.gc() == 0
+        assert blob.exists()
+
+        # Once both entries are gone, so is the blob
+        cache.max_size = 0
+        assert cache.gc() == 18000
+        assert not blob.exists()
+        assert not file1.exists() and not file2.exists()
+
+    def test_gc_trees(self, http_server, tmp_path):
+        root, base = http_server
+        (root / "small.tgz").write_bytes(b"small" * 200)
+        (root / "other.tgz").write_bytes(b"other" * 200)
+        cache = Cache(tmp_path / "cache")
+        small = cache.get(f"{base}/small.tgz")
+        cache.get(f"{base}/other.tgz")
+        cache.index.update(f"{base}/small.tgz", last_access=1000)
+        source = tmp_path / "unpacked"
+        source.mkdir()
+        (source / "big").write_bytes(b"x" * 10000)
+        tree = cache.put_tree(cache.digest(f"{base}/small.tgz"), "k", source)
+
+        # The archive alone fits, but not with its unpacked tree
+        cache.max_size = 5000
+        assert cache.gc() == 11000
+        assert not small.exists() and not tree.exists()
+        assert cache.lookup(f"{base}/other.tgz") is not None
+
+    def test_gc_lfu(self, http_server, tmp_path):
+        root, base = http_server
+        for name in ["lfu1.bin", "lfu2.bin"]:
+            (root / name).write_bytes(name.encode() * 1000)
+        cache = Cache(tmp_path, max_size=9000, policy="lfu")
+        file1 = cache.get(f"{base}/lfu1.bin")
+        file2 = cache.get(f"{base}/lfu2.bin")
+        cache.get(f"{base}/lfu1.bin")
+        assert cache.index.get(f"{base}/lfu1.bin")["hits"] == 1
+        cache.gc()
+        assert file1.exists()
+        assert not file2.parent.exists()
+
+    def test_gc_max_age(self, http_server, tmp_path):
+        root, base = http_server
+        (root / "old.bin").write_bytes(b"old")
+        cache = Cache(tmp_path, max_age=24 * 60 * 60)
+        cachefile = cache.get(f"{base}/old.bin")
+        assert cache.gc() == 0
+        cache.index.update(f"{base}/old.bin", last_access=0)
+        assert cache.gc() == 3
+        assert not cachefile.parent.exists()
+
+    def test_index(self, http_server, tmp_path):
+        root, base = http_server
+        (root / "index.bin").write_bytes(b"indexed")
+        cache = Cache(tmp_path)
+        cachefile = cache.get(f"{base}/index.bin")
+        entry = cache.index.get(f"{base}/index.bin")
+        assert entry["size"] == 7
+        assert entry["filename"] == "index.bin"
+        assert cache.lookup(f"{base}/index.bin") == cachefile
+        cache.index.flush()
+
+        # A fresh Cache answers from the index file alone
+        cache = Cache(tmp_path)
+        assert [e["url"] for e in cache.entries()] == [f"{base}/index.bin"]
+        assert cache.lookup("https://example.com/missing") is None
+        assert not cache._cachedir("https://example.com/missing", create=False).exists()
+
+    def test_index_flush_at_exit(self, tmp_path):
+        import gc
+        import weakref
+        from cbdep import cache_index
+        index = cache_index.CacheIndex(tmp_path / "index.log")
+        index.update("https://example.com/a.tgz", filename="a.tgz")
+        ref = weakref.ref(index)
+        del index
+        gc.collect()
+        assert ref() is None
+
+        index = cache_index.CacheIndex(tmp_path / "index.log")
+        index.touch("https://example.com/a.tgz", 100)
+        cache_index._flush_all()
+        assert index not in cache_index._unflushed
+        entry = cache_index.CacheIndex(tmp_path / "index.log").get(
+            "https://example.com/a.tgz")
+        assert entry["hits"] == 1
+
+    def test_index_rebuild(self, tmp_path):
+        cache = Cache(tmp_path)
+        legacydir = cache._cachedir("https://example.com/legacy.tgz")
+        (legacydir / "legacy.tgz").write_bytes(b"legacy")
+        cache._writefilename(legacydir, "legacy.tgz")
+        cache = Cache(tmp_path)
+        assert cache.entries()[0]["url"] == "https://example.com/legacy.tgz"
+        assert (tmp_path / "index.log").exists()
+
+    def test_get_concurrent(self, http_server, tmp_path):
+        from concurrent.futures import ThreadPoolExecutor
+        from conftest import QuietHandler
+        root, base = http_server
+        data = os.urandom(2 * 1024 * 1024)
+        (root / "concurrent.bin").write_bytes(data)
+        cache = Cache(tmp_path)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: cache.get(f"{base}/concurrent.bin"), range(4)))
+        assert all(r.read_bytes() == data for r in results)
+        assert QuietHandler.paths.count("/concurrent.bin") == 1
+
+    def test_get_checksum(self, http_server, tmp_path):
+        import hashlib
+        from cbdep.cache import ChecksumError
+        root, base = http_server
+        data = os.urandom(10000)
+        (root / "checksum.bin").write_bytes(data)
+        dl_url = f"{base}/checksum.bin"
+        sha512 = hashlib.sha512(data).hexdigest()
+        cache = Cache(tmp_path)
+        with pytest.raises(ChecksumError):
+            cache.get(dl_url, checksum=("sha512", "0" * 128))
+        assert cache.lookup(dl_url) is None
+        cachefile = cache.get(dl_url, checksum=("sha512", sha512))
+        assert cache.index.get(dl_url)["digests"] == {"sha512": sha512}
+        assert cache.get(dl_url, checksum=("sha256", hashlib.sha256(data).hexdigest())) == cachefile
+
+    def test_get_checksum_corrupt(self, http_server, tmp_path):
+        import hashlib
+        from conftest import QuietHandler
+        root, base = http_server
+        data = os.urandom(10000)
+        (root / "corrupt.bin").write_bytes(data)
+        dl_url = f"{base}/corrupt.bin"
+        cache = Cache(tmp_path)
+        cachefile = cache.get(dl_url)
+        cache.index.update(dl_url, sha256="0" * 64)
+        cache.get(dl_url, checksum=("sha256", hashlib.sha256(data).hexdigest()))
+        assert QuietHandler.paths.count("/corrupt.bin") == 2
@@ -0,0 +1,55 @@
+import cbdep.config as config
+
+
+class TestConfig:
+
+    def test_bundled(self):
+        assert "packages" in config.load_config()
+
+    def test_compiled(self, tmp_path, monkeypatch):
+        yamlfile = tmp_path / "test.config"
+        yamlfile.write_text("packages:\n  widget: []\n")
+        cache_dir = tmp_path / "compiled"
+        assert config.load_config(yamlfile, cache_dir) == \
+            {"packages": {"widget": []}}
+        assert len(list(cache_dir.glob("*.json"))) == 1
+
+        # Now loaded without parsing
+        def fail(text):
+            raise AssertionError("parsed again")
+        monkeypatch.setattr(config, "load_yaml", fail)
+        assert config.load_config(yamlfile, cache_dir) == \
+            {"packages": {"widget": []}}
+        monkeypatch.undo()
+
+        # Changes are noticed; corrupt compiled files are ignored
+        yamlfile.write_text("packages:\n  gadget: []\n")
+        assert config.load_config(yamlfile, cache_dir) == \
+            {"packages": {"gadget": []}}
+        for compiled in cache_dir.glob("*.json"):
+            compiled.write_bytes(b"junk")
+        assert config.load_config(yamlfile, cache_dir) == \
+            {"packages": {"gadget": []}}
+
+    def test_prune(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(config, "COMPILED_KEEP", 2)
+        yamlfile = tmp_path / "test.config"
+        for i in range(4):
+            yamlfile.write_text(f"version: {i}\n")
+            config.load_config(yamlfile, tmp_path / "compiled")
+        assert len(list((tmp_path / "compiled").glob("*.json"))) == 2
+
+    def test_compiled_json(self, tmp_path):
+        cache_dir = tmp_path / "compiled"
+        cache_dir.mkdir()
+        (cache_dir / "old.pickle").write_bytes(b"junk")
+        yamlfile = tmp_path / "test.config"
+        yamlfile.write_text("packages:\n  widget: [{if_version: 1}]\n")
+        config.load_config(yamlfile, cache_dir)
+        assert [p.suffix for p in cache_dir.iterdir()] == [".json"]
+
+        # Configurations JSON can't represent exactly aren't compiled
+        yamlfile.write_text("packages:\n  widget: {1: 2019-01-01}\n")
+        result = config.load_config(yamlfile, cache_dir)
+        assert list(result["packages"]["widget"]) == [1]
+        assert len(list(cache_dir.iterdir())) == 1
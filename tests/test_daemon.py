@@ -0,0 +1,114 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from cbdep.daemon import Daemon, forward
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(socket, "AF_UNIX"), reason="requires Unix domain sockets")
+
+CBDEP = [sys.executable, "-c", "from cbdep.cli import main; main()"]
+
+
+def cbdep(tmp_path, *args):
+    env = dict(os.environ, HOME=str(tmp_path / "home"))
+    return subprocess.run(
+        CBDEP + list(args), env=env, cwd=tmp_path,
+        capture_output=True, text=True
+    )
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    env = dict(os.environ, HOME=str(tmp_path / "home"))
+    proc = subprocess.Popen(
+        CBDEP + ["serve"], env=env, cwd=tmp_path,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    sock = tmp_path / "home" / ".cbdepcache" / "cbdep.sock"
+    for _ in range(100):
+        if sock.exists():
+            break
+        time.sleep(0.1)
+    yield sock
+    proc.terminate()
+    proc.wait(timeout=10)
+    assert not sock.exists()
+
+
+class TestDaemon:
+
+    def test_forward(self, tmp_path, daemon):
+        (tmp_path / "test.config").write_text(
+            "packages:\n  widget: []\ncbdeps:\n  packages: [gadget]\n")
+
+        # Relative paths are relative to the client
+        result = cbdep(tmp_path, "--debug", "list", "-c", "test.config")
+        assert result.returncode == 0
+        assert "Forwarding command" in result.stderr
+        assert result.stdout.split()[-2:] == ["gadget", "widget"]
+
+        # As are exit codes and errors
+        result = cbdep(tmp_path, "install", "-c", "test.config", "nosuch", "1")
+        assert result.returncode == 1
+        assert "Unknown package: nosuch" in result.stderr
+
+        # Global options prevent forwarding
+        result = cbdep(tmp_path, "--debug", "--no-daemon",
+                       "list", "-c", "test.config")
+        assert result.returncode == 0
+        assert "Forwarding command" not in result.stderr
+
+    def test_subprocess_output(self, tmp_path, daemon):
+        (tmp_path / "test.config").write_text(
+            "packages:\n"
+            "  noisy:\n"
+            "    - actions:\n"
+            "        - run: echo HELLO; echo ERR 1>&2; exit 3\n"
+        )
+
+        # Output of commands run by the daemon reaches the client
+        result = cbdep(tmp_path, "--debug", "install", "-c", "test.config",
+                       "noisy", "1")
+        assert "Forwarding command" in result.stderr
+        assert result.returncode == 3
+        assert result.stdout == "HELLO\n"
+        assert "ERR\n" in result.stderr
+        assert "Command failed with exit code 3" in result.stderr
+
+    def test_no_daemon(self, tmp_path):
+        path = tmp_path / "cbdep.sock"
+        assert forward(str(path), ["platform"]) is None
+
+        # Nothing listening on the socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(str(path))
+        sock.close()
+        assert forward(str(path), ["platform"]) is None
+
+    def test_run(self, tmp_path, capsys):
+        def run_command(cbdep, argv):
+            print(os.getcwd(), os.environ["TEST_VALUE"], argv)
+            sys.exit(int(argv[0]))
+
+        class Stream:
+
+            def __init__(self):
+                self.text = ""
+
+            def write(self, text):
+                self.text += text
+
+        daemon = Daemon(None, str(tmp_path / "cbdep.sock"), run_command)
+        out = Stream()
+        cwd = os.getcwd()
+        returncode = daemon.run(["3"], str(tmp_path), {"TEST_VALUE": "x"},
+                                out, Stream())
+        assert returncode == 3
+        assert out.text == f"{tmp_path} x ['3']\n"
+        assert os.getcwd() == cwd
+        assert "TEST_VALUE" not in os.environ
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Modules which are slow to import, and which commands that don't
+# download, parse or unpack anything must not import
+HEAVY_MODULES = [
+    "requests", "urllib3", "yaml", "packaging", "importlib.metadata",
+    "cbdep.install", "cbdep.native_unpack", "cbdep.zipfile_with_permissions",
+    "cbdep.streaming_extract",
+]
+
+
+def imported_modules(tmp_path, code):
+    """
+    Runs code in a new interpreter with -X importtime, and returns a
+    dictionary of the modules it imported (excluding those imported during
+    interpreter startup) and their cumulative import times in microseconds
+    """
+
+    env = dict(os.environ, HOME=str(tmp_path))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env, capture_output=True, text=True, check=True
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if name.strip() == "site" and name.startswith(" site"):
+            # Everything so far was imported by interpreter startup
+            modules = {}
+            continue
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative)
+    return modules
+
+
+@pytest.mark.parametrize("code", [
+    "import cbdep.cli",
+    "import sys; sys.argv = ['cbdep', '-p', 'linux', 'platform']; "
+    "import cbdep.cli; cbdep.cli.main()",
+])
+def test_import_time(tmp_path, code):
+    modules = imported_modules(tmp_path, code)
+    assert "cbdep.cli" in modules
+    assert [m for m in HEAVY_MODULES if m in modules] == []
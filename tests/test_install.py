@@ -197,6 +197,7 @@ class TestInstaller:
     def test_copy(self):
         installer = Installer.fromYaml(yamltext, Cache(wd), "linux", "x86_64")
         assert type(installer.copy()) == Installer
+        assert installer.copy().cache is installer.cache
 
     def test_set_cache_only(self):
         installer = Installer.fromYaml(yamltext, Cache(wd), "linux", "x86_64")
@@ -307,3 +308,205 @@ class TestInstaller:
         installer = Installer.fromYaml(yamltext, Cache(wd), "linux", "x86_64")
         installer.do_cbdep({"cbdep": "analytics-jars", "version": "7.0.2-6512", "install_dir": str(wd/"test_do_cbdep")})
         assert md5(open(wd/"test_do_cbdep"/"analytics-jars-7.0.2-6512"/"cbas-install-7.0.2.jar", "rb").read()).hexdigest() == "3436fda4756c9aed996a6ad2ed9ddb30"
+
+    def test_checksum_url(self, tarball_package, http_server, tmp_path):
+        import hashlib
+        root, _ = http_server
+        installer, base = tarball_package(
+            "widget", "3.0", checksum_url="${URL}.sha256")
+        digest = hashlib.sha256((root / "widget-3.0.tar.gz").read_bytes()).hexdigest()
+        (root / "widget-3.0.tar.gz.sha256").write_text(f"{digest}  widget-3.0.tar.gz\n")
+        installer.install("widget", "3.0", base, tmp_path / "install")
+        assert (tmp_path / "install" / "widget-3.0" / "README").read_text() == "3.0"
+        # ${URL} doesn't leak into later actions
+        assert "URL" not in installer.symbols
+        assert installer.get_checksum({"sha512": "AB" * 64}, "x") == ("sha512", "ab" * 64)
+
+    def test_url_fallback_alias(self, tarball_package, tmp_path):
+        from conftest import package_config, QuietHandler
+        urls = ["${BASE_URL}/missing/gadget-${VERSION}.tar.gz",
+                "${BASE_URL}/gadget-${VERSION}.tar.gz"]
+        installer, base = tarball_package("gadget", "2.0", urls=urls)
+        cache = installer.cache
+        installer.install("gadget", "2.0", base, tmp_path / "install1")
+        first = f"{base}/missing/gadget-2.0.tar.gz"
+        assert cache.alias(first) == f"{base}/gadget-2.0.tar.gz"
+        assert cache.is_missing(first)
+
+        # A new process with a warm cache goes straight to the second URL
+        QuietHandler.paths.clear()
+        cache = Cache(tmp_path / "cache")
+        installer = Installer.fromYaml(
+            package_config("gadget", urls=urls), cache, "linux", "x86_64")
+        installer.install("gadget", "2.0", base, tmp_path / "install2")
+        assert (tmp_path / "install2" / "gadget-2.0" / "README").read_text() == "2.0"
+        assert QuietHandler.paths == []
+
+        # Once the negative result expires the first URL is tried again
+        cache.missing_ttl = 0
+        assert not cache.is_missing(first)
+
+    def test_probe_urls(self, tarball_package, tmp_path):
+        from conftest import QuietHandler
+        installer, base = tarball_package("gizmo", "1.0", urls=[
+            "${BASE_URL}/nowhere/gizmo-${VERSION}.tar.gz",
+            "${BASE_URL}/gizmo-${VERSION}.tar.gz",
+            "${BASE_URL}/elsewhere/gizmo-${VERSION}.tar.gz",
+        ])
+        cache = installer.cache
+        installer.set_probe_urls(True)
+        assert installer.copy().probe_urls
+        QuietHandler.paths.clear()
+        QuietHandler.heads.clear()
+        installer.install("gizmo", "1.0", base, tmp_path / "install")
+        assert (tmp_path / "install" / "gizmo-1.0" / "README").read_text() == "1.0"
+        assert "/nowhere/gizmo-1.0.tar.gz" in QuietHandler.heads
+        assert QuietHandler.paths == ["/gizmo-1.0.tar.gz"]
+        assert cache.is_missing(f"{base}/nowhere/gizmo-1.0.tar.gz")
+        assert cache.probe([f"{base}/nowhere/x", f"{base}/elsewhere/x"]) is None
+
+    def test_installed_state(self, tarball_package, tmp_path, caplog):
+        installer, base = tarball_package("whatsit", "1.0")
+        installer.descriptor["packages"]["onlyrun"] = [
+            {"actions": [{"run": "true"}]}
+        ]
+        installdir = tmp_path / "install"
+        caplog.set_level(logging.INFO, logger="cbdep")
+        installer.install("whatsit", "1.0", base, installdir)
+        assert "already installed" not in caplog.text
+        installer.install("whatsit", "1.0", base, installdir)
+        assert "already installed" in caplog.text
+
+        # A damaged install is repaired
+        caplog.clear()
+        readme = installdir / "whatsit-1.0" / "README"
+        readme.write_text("oops")
+        installer.install("whatsit", "1.0", base, installdir)
+        assert "already installed" not in caplog.text
+        assert readme.read_text() == "1.0"
+
+        # --force always reinstalls
+        installer.set_force(True)
+        installer.install("whatsit", "1.0", base, installdir)
+        assert "already installed" not in caplog.text
+
+        # Installs which only run commands are never recorded
+        installer.install("onlyrun", "1.0", base, installdir)
+        assert not (installdir / ".cbdep" / "onlyrun-1.0.json").exists()
+
+    def test_tree_cache(self, tarball_package, tmp_path, caplog):
+        installer, base = tarball_package("thingamajig", "1.0")
+        cache = installer.cache
+        installer.set_tree_cache("link")
+        caplog.set_level(logging.DEBUG, logger="cbdep")
+        installer.install("thingamajig", "1.0", base, tmp_path / "install1")
+        assert "previously unpacked" not in caplog.text
+        installer.install("thingamajig", "1.0", base, tmp_path / "install2")
+        assert "previously unpacked" in caplog.text
+        readme1 = tmp_path / "install1" / "thingamajig-1.0" / "README"
+        readme2 = tmp_path / "install2" / "thingamajig-1.0" / "README"
+        assert readme2.read_text() == "1.0"
+        assert readme1.stat().st_ino == readme2.stat().st_ino
+        assert sorted(os.listdir(tmp_path / "install2")) == [".cbdep", "thingamajig-1.0"]
+
+        # Trees go away with their archives
+        assert list(cache.directory.glob("trees/??/*"))
+        cache.max_size = 0
+        cache.gc()
+        assert not list(cache.directory.glob("trees/??/*"))
+
+    def test_stream_extract(self, tarball_package, http_server, tmp_path, caplog):
+        root, _ = http_server
+        installer, base = tarball_package("doohickey", "1.0", "tar.xz")
+        (root / "doohickey-1.0.zip").write_bytes(b"not a tarball")
+        installer.set_stream_extract(True)
+        installdir = tmp_path / "install"
+        caplog.set_level(logging.DEBUG, logger="cbdep")
+        installer.install("doohickey", "1.0", base, installdir)
+        assert "while downloading" in caplog.text
+        assert (installdir / "doohickey-1.0" / "README").read_text() == "1.0"
+        assert sorted(os.listdir(installdir)) == [".cbdep", "doohickey-1.0"]
+
+        # Cache hits, and files which can't be streamed, unpack as usual
+        installer.set_force(True)
+        installer.install("doohickey", "1.0", base, installdir)
+        assert (installdir / "doohickey-1.0" / "README").read_text() == "1.0"
+        installer.descriptor["packages"]["doohickey"][0]["actions"][0]["url"] = \
+            "${BASE_URL}/doohickey-${VERSION}.zip"
+        with pytest.raises(Exception):
+            installer.install("doohickey", "1.0", base, installdir)
+        assert sorted(os.listdir(installdir)) == [".cbdep", "doohickey-1.0"]
+
+    def test_find_block(self, tmp_path):
+        config = """
+packages:
+  widget:
+    - if_platform: [windows, linux]
+      if_arch: aarch64
+      actions: [{run: arm}]
+    - if_platform: linux
+      if_arch: [x64-musl, x86_64]
+      if_version: ">=2"
+      actions: [{run: new}]
+    - if_version: "<2"
+      actions: [{run: old}]
+    - if_platform: macos
+      actions: [{run: mac}]
+"""
+        installer = Installer.fromYaml(
+            config, Cache(tmp_path / "cache"), ["linux"], ["x86_64"])
+        blocks = installer.descriptor["packages"]["widget"]
+        block = installer.resolve("widget", "2.1", None, tmp_path)
+        assert block is blocks[1]
+        assert installer.symbols["PLATFORM"] == "linux"
+        assert installer.symbols["PLATFORM_EXT"] == "tar.gz"
+        assert installer.symbols["ARCH"] == "x86_64"
+
+        # Symbols set by earlier blocks persist, as with the match_*()
+        # methods
+        other = installer.copy()
+        assert other.resolve("widget", "1.5", None, tmp_path) is blocks[2]
+        assert other.symbols["ARCH"] == "x86_64"
+        assert other.block_indexes is installer.block_indexes
+        assert len(installer.block_indexes) == 1
+        for block in blocks:
+            check = installer.copy()
+            check.safe_version = "1.5"
+            if block is blocks[2]:
+                break
+            assert not (check.match_platform(block)
+                        and check.match_arch(block)
+                        and check.match_version(block))
+
+        # Invalid versions match no if_version
+        assert installer.find_block(blocks[1:2]) is blocks[1]
+        installer.safe_version = "not a version"
+        assert installer.find_block(blocks[1:3]) is None
+
+        # Different arches use a different index
+        arm = Installer(installer.descriptor, installer.cache,
+                        ["windows"], ["aarch64"])
+        assert arm.resolve("widget", "2.1", None, tmp_path) is blocks[0]
+        assert arm.symbols["PLATFORM_EXT"] == "zip"
+        assert arm.symbols["PLATFORM_EXE_EXT"] == ".exe"
+
+    def test_output_installed(self, tarball_package, http_server, tmp_path, monkeypatch):
+        from conftest import package_config
+        from cbdep.cli import main
+        root, _ = http_server
+        _, base = tarball_package("whatsit", "1.0")
+        (tmp_path / "test.config").write_text(
+            package_config("whatsit", base_url=base))
+        monkeypatch.setenv("HOME", str(tmp_path / "home"))
+        argv = ["--no-daemon", "install", "-c", str(tmp_path / "test.config"),
+                "-d", str(tmp_path / "install"), "whatsit", "1.0"]
+        for output in ["first.tgz", "second.tgz"]:
+            main(argv + ["-o", str(tmp_path / output)])
+            assert (tmp_path / output).read_bytes() == \
+                (root / "whatsit-1.0.tar.gz").read_bytes()
+
+        # If the download has left the cache, it is downloaded again
+        Cache(tmp_path / "home" / ".cbdepcache", max_size=1).gc()
+        (tmp_path / "first.tgz").unlink()
+        main(argv + ["-o", str(tmp_path / "first.tgz")])
+        assert (tmp_path / "first.tgz").exists()
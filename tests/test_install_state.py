@@ -0,0 +1,45 @@
+import os
+from cbdep.install_state import InstallState
+
+
+class TestInstallState:
+
+    def make_tree(self, path):
+        (path / "bin").mkdir(parents=True)
+        (path / "bin" / "tool").write_text("tool")
+        (path / "README").write_text("readme")
+        os.symlink("bin", path / "link")
+
+    def test_record_verify(self, tmp_path):
+        target = tmp_path / "pkg-1.0"
+        self.make_tree(target)
+        state = InstallState(tmp_path)
+        assert state.load("pkg", "1.0") is None
+        state.record("pkg", "1.0", "fp", [target], [], [], "hash")
+        manifest = state.load("pkg", "1.0")
+        assert manifest["targets"][0]["files"] == 3
+        assert state.verify(manifest, "fp", "stat")
+        assert state.verify(manifest, "fp", "hash")
+        assert not state.verify(manifest, "other", "stat")
+
+        # Same size and mtime, different contents: only hashing notices
+        stat = (target / "README").stat()
+        (target / "README").write_text("README")
+        os.utime(target / "README", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert state.verify(manifest, "fp", "stat")
+        assert not state.verify(manifest, "fp", "hash")
+
+        (target / "extra").write_text("")
+        assert not state.verify(manifest, "fp", "stat")
+
+        state.remove("pkg", "1.0")
+        assert state.load("pkg", "1.0") is None
+
+    def test_stat_record_has_no_digest(self, tmp_path):
+        target = tmp_path / "pkg-1.0"
+        self.make_tree(target)
+        state = InstallState(tmp_path)
+        state.record("pkg", "1.0", "fp", [target], [], [], "stat")
+        manifest = state.load("pkg", "1.0")
+        assert state.verify(manifest, "fp", "stat")
+        assert not state.verify(manifest, "fp", "hash")
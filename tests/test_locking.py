@@ -0,0 +1,13 @@
+from cbdep.locking import FileLock
+
+
+class TestFileLock:
+
+    def test_exclusive(self, tmp_path):
+        lockfile = tmp_path / "sub" / "test.lock"
+        with FileLock(lockfile) as lock:
+            assert lock.waited == False
+            other = FileLock(lockfile)
+            assert other.acquire(blocking=False) == False
+        assert other.acquire(blocking=False) == True
+        other.release()
@@ -0,0 +1,31 @@
+import os
+import pytest
+from cbdep.materialize import materialize
+
+
+class TestMaterialize:
+
+    @pytest.fixture
+    def tree(self, tmp_path):
+        source = tmp_path / "source"
+        (source / "bin").mkdir(parents=True)
+        (source / "bin" / "tool").write_text("#!/bin/sh\n")
+        (source / "bin" / "tool").chmod(0o755)
+        (source / "README").write_text("readme")
+        os.symlink("bin/tool", source / "tool")
+        return source
+
+    @pytest.mark.parametrize("mode", ["link", "reflink", "copy"])
+    def test_materialize(self, tree, tmp_path, mode):
+        target = tmp_path / "target"
+        materialize(tree, target, mode)
+        assert (target / "README").read_text() == "readme"
+        assert os.readlink(target / "tool") == "bin/tool"
+        assert os.access(target / "bin" / "tool", os.X_OK)
+        shared = (target / "README").stat().st_ino == \
+            (tree / "README").stat().st_ino
+        assert shared == (mode == "link")
+
+    def test_unknown_mode(self, tree, tmp_path):
+        with pytest.raises(ValueError):
+            materialize(tree, tmp_path / "target", "teleport")
@@ -0,0 +1,61 @@
+import pytest
+from cbdep.cache import Cache
+from cbdep.install import Installer
+from cbdep.matrix import matrix_targets, resolve_matrix
+
+config = """
+packages:
+  gizmo:
+    - if_platform: [linux, windows]
+      default_arches: true
+      base_url: http://127.0.0.1:1
+      actions:
+        - url: ${BASE_URL}/gizmo-${VERSION}-${PLATFORM}-${ARCH}.${PLATFORM_EXT}
+        - cbdep: helper
+          version: 2.0
+  helper:
+    - if_platform: linux
+      base_url: http://127.0.0.1:1
+      actions:
+        - url:
+            - ${BASE_URL}/helper-${VERSION}.tar.gz
+            - ${BASE_URL}/mirror/helper-${VERSION}.tar.gz
+"""
+
+
+@pytest.fixture
+def installer(tmp_path):
+    return Installer.fromYaml(
+        config, Cache(tmp_path / "cache"), ["linux"], ["x86_64"])
+
+
+def test_matrix_targets():
+    targets = matrix_targets(["linux", "ubuntu,linux"], ["x86_64", "aarch64"])
+    assert [(name, arch) for name, _, arch in targets] == [
+        ("linux", "x86_64"), ("linux", "aarch64"),
+        ("ubuntu,linux", "x86_64"), ("ubuntu,linux", "aarch64"),
+    ]
+    assert targets[0][1] == ["unknown-linux-gnu", "linux"]
+    assert targets[2][1] == ["ubuntu", "linux"]
+
+
+def test_resolve_matrix(installer, tmp_path):
+    base = "http://example.com"
+    items = [("gizmo", "1.0", base, False), ("helper", "2.0", base, False)]
+    results = resolve_matrix(
+        installer, items, matrix_targets(arches=["x86_64"]), tmp_path)
+    assert [(r["package"], r["platform"]) for r in results] == [
+        ("gizmo", "linux"), ("helper", "linux"),
+        ("gizmo", "windows"),
+    ]
+    assert results[0]["urls"] == [
+        [f"{base}/gizmo-1.0-linux-x86_64.tar.gz"]]
+    assert results[1]["urls"] == [
+        [f"{base}/helper-2.0.tar.gz", f"{base}/mirror/helper-2.0.tar.gz"]]
+    assert results[2]["urls"] == [[f"{base}/gizmo-1.0-windows-x86_64.zip"]]
+    assert all(r["arch"] == "x86_64" for r in results)
+
+    # Resolving for other platforms leaves the configuration untouched
+    block = installer.descriptor["packages"]["gizmo"][0]
+    assert "if_arch" not in block
+    assert installer.platforms == ["linux"]
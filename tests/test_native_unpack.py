@@ -0,0 +1,63 @@
+import pytest
+import shutil
+import subprocess
+import cbdep.native_unpack as native_unpack
+from conftest import make_tarball
+
+native_unpack.register()
+
+
+class TestNativeUnpack:
+
+    def test_find_decompressor(self, monkeypatch):
+        monkeypatch.setattr(
+            native_unpack, "DECOMPRESSORS", {"gztar": [["no-such-tool"]]})
+        assert native_unpack.find_decompressor("gztar") is None
+        native_unpack.add_decompressor("gztar", ["gzip", "-d", "-c"])
+        assert native_unpack.find_decompressor("gztar")[1:] == ["-d", "-c"]
+        monkeypatch.setenv(native_unpack.ENABLE_VARIABLE, "0")
+        assert native_unpack.find_decompressor("gztar") is None
+
+    @pytest.mark.parametrize(
+        "tools", [[["gzip", "-d", "-c"]], [["no-such-tool"]]])
+    def test_unpack_gztar(self, tmp_path, monkeypatch, tools):
+        monkeypatch.setitem(native_unpack.DECOMPRESSORS, "gztar", tools)
+        archive = tmp_path / "test.tar.gz"
+        make_tarball(archive, "top", "gz")
+        shutil.unpack_archive(archive, tmp_path / "out")
+        assert (tmp_path / "out" / "top" / "README").read_text() == "gz"
+
+    @pytest.mark.skipif(shutil.which("xz") is None, reason="xz not installed")
+    def test_unpack_xztar(self, tmp_path):
+        archive = tmp_path / "test.tar.xz"
+        make_tarball(archive, "top", "xz", "w:xz")
+        shutil.unpack_archive(archive, tmp_path / "out")
+        assert (tmp_path / "out" / "top" / "README").read_text() == "xz"
+
+    @pytest.mark.parametrize("tool", [
+        # Fails outright
+        ["sh", "-c", "echo unsupported >&2; exit 1"],
+        # Writes more errors than a pipe holds before any output
+        ["sh", "-c", "head -c 1000000 /dev/zero >&2; exec gzip -d -c"],
+    ])
+    def test_unpack_tool_errors(self, tmp_path, monkeypatch, tool):
+        monkeypatch.setitem(native_unpack.DECOMPRESSORS, "gztar", [tool])
+        archive = tmp_path / "test.tar.gz"
+        make_tarball(archive, "top", "gz")
+        shutil.unpack_archive(archive, tmp_path / "out")
+        assert (tmp_path / "out" / "top" / "README").read_text() == "gz"
+
+    def test_unpack_corrupt(self, tmp_path):
+        archive = tmp_path / "test.tar.gz"
+        archive.write_bytes(b"\x1f\x8b garbage")
+        with pytest.raises(shutil.ReadError):
+            shutil.unpack_archive(archive, tmp_path / "out")
+
+    @pytest.mark.skipif(
+        shutil.which("zstd") is None, reason="zstd not installed")
+    def test_unpack_zstdtar(self, tmp_path):
+        tar = tmp_path / "test.tar"
+        make_tarball(tar, "top", "zstd", "w")
+        subprocess.run(["zstd", "-q", str(tar)], check=True)
+        shutil.unpack_archive(tmp_path / "test.tar.zst", tmp_path / "out")
+        assert (tmp_path / "out" / "top" / "README").read_text() == "zstd"
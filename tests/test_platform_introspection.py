@@ -8,9 +8,66 @@ class TestPlatformIntrospection:
     @pytest.fixture(autouse=True)
     def cleanup(self):
         yield
-        plat._processor = None
-        plat._platforms = None
+        plat.get_platforms.cache_clear()
+        plat._cache_file = None
 
-    def test__override_arch(self):
-        plat.override_arch("arm64")
-        assert plat.get_arches() == ["aarch64", "arm64", "aarch_64"]
+    def test_arches_arm(self):
+        assert plat.get_arches("arm64", ["ubuntu", "linux"]) == \
+            ["aarch64", "arm64", "aarch_64"]
+
+    def test_arches_alpine(self):
+        alpine = ["alpine", "linux"]
+        arches = plat.get_arches("x86_64", alpine)
+        assert arches[:3] == ["x86_64-musl", "amd64-musl", "x64-musl"]
+        arches.append("junk")
+        assert "junk" not in plat.get_arches("x86_64", alpine)
+        assert plat.get_arches("x86_64", ["ubuntu", "linux"]) == \
+            ["x86_64", "amd64", "x64"]
+        assert plat.get_default_arches(
+            cbdeps_arches=True, platforms=["win", "windows"]) == \
+            ["x86", "amd64", "arm64"]
+
+    def test_cache_file(self, tmp_path, monkeypatch):
+        boot_id = tmp_path / "boot_id"
+        boot_id.write_text("one")
+        release = tmp_path / "os-release"
+        release.write_text("ID=fakeos")
+        monkeypatch.setattr(plat, "_BOOT_ID_FILE", str(boot_id))
+        monkeypatch.setattr(plat, "_RELEASE_FILES", [str(release)])
+        calls = []
+        def introspect():
+            calls.append(1)
+            return ["fakeos", "linux"]
+        monkeypatch.setattr(plat, "_introspect_platforms", introspect)
+
+        plat.set_cache_file(str(tmp_path / "cache" / "platform.json"))
+        assert plat.get_platforms() == ["fakeos", "linux"]
+        plat.get_platforms.cache_clear()
+        assert plat.get_platforms() == ["fakeos", "linux"]
+        assert len(calls) == 1
+
+        # Rebooting or changing the OS release invalidates the cache
+        boot_id.write_text("two")
+        plat.get_platforms.cache_clear()
+        plat.get_platforms()
+        assert len(calls) == 2
+        release.write_text("ID=fakeos2\n")
+        plat.get_platforms.cache_clear()
+        plat.get_platforms()
+        assert len(calls) == 3
+
+        # As do corrupt files
+        (tmp_path / "cache" / "platform.json").write_text("junk")
+        plat.get_platforms.cache_clear()
+        plat.get_platforms()
+        assert len(calls) == 4
+
+    def test_target_platforms(self):
+        assert plat.get_target_platforms("macos") == \
+            ["osx", "mac", "macos", "macosx", "apple-darwin", "darwin"]
+        assert plat.get_target_platforms("Linux") == \
+            ["unknown-linux-gnu", "linux"]
+        assert plat.get_target_platforms("ubuntu-22.04,linux") == \
+            ["ubuntu-22.04", "linux"]
+        assert plat.get_system_platforms("linux", "alpine", "3")[:2] == \
+            ["unknown-linux-musl", "alpine-3"]
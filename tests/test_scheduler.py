@@ -0,0 +1,118 @@
+import os
+
+import pytest
+from cbdep.batch import BatchInstaller
+from cbdep.cache import Cache
+from cbdep.install import Installer
+from cbdep.scheduler import DependencyGraph
+
+config = """
+packages:
+  app:
+    - actions:
+        - run: echo app-start >> ${INSTALL_DIR}/log
+        - cbdep: left
+          version: 1
+        - cbdep: right
+          version: 1
+        - run: echo app >> ${INSTALL_DIR}/log
+  left:
+    - actions:
+        - cbdep: base
+          version: 1
+        - run: echo left >> ${INSTALL_DIR}/log
+  right:
+    - actions:
+        - cbdep: base
+          version: 1
+        - run: echo right >> ${INSTALL_DIR}/log
+  base:
+    - actions:
+        - run: echo base >> ${INSTALL_DIR}/log
+  loop:
+    - actions:
+        - cbdep: loop
+          version: 1
+  lonely:
+    - actions:
+        - install_dir: ${INSTALL_DIR}/lonely
+  envy:
+    - set_env:
+        CBDEP_TEST_ENVY: envy
+      actions:
+        - install_dir: ${INSTALL_DIR}/envy
+"""
+
+
+@pytest.fixture
+def installer(tmp_path):
+    return Installer.fromYaml(
+        config, Cache(tmp_path / "cache"), "linux", "x86_64")
+
+
+class TestDependencyGraph:
+
+    def test_graph(self, installer, tmp_path):
+        graph = DependencyGraph(installer)
+        graph.add("app", "1", tmp_path)
+        graph.add("right", "1", tmp_path)
+        assert [key[0] for key in graph.nodes] == \
+            ["base", "left", "right", "app"]
+        app = installer.install_key("app", "1", tmp_path)
+        assert len(graph.nodes[app].deps) == 2
+
+    def test_install(self, installer, tmp_path):
+        installer.install("app", "1", None, tmp_path)
+        lines = (tmp_path / "log").read_text().split()
+
+        # Nested installs happen at their position in the block, once
+        assert lines == ["app-start", "base", "left", "right", "app"]
+
+    def test_batch(self, installer, tmp_path):
+        batch = BatchInstaller(installer, jobs=4)
+        batch.add("left", "1", tmp_path)
+        batch.add("app", "1", tmp_path)
+        batch.install()
+        lines = (tmp_path / "log").read_text().split()
+        assert lines == ["base", "left", "app-start", "right", "app"]
+
+    def test_exclusive(self, installer, tmp_path, monkeypatch):
+        import threading
+        import time
+        active = []
+        overlaps = []
+        lock = threading.Lock()
+
+        def execute_block(self, block):
+            with lock:
+                active.append(self.package)
+                overlaps.append(list(active))
+            time.sleep(0.1)
+            with lock:
+                active.remove(self.package)
+
+        monkeypatch.setattr(Installer, "execute_block", execute_block)
+        graph = DependencyGraph(installer)
+        for package in ["base", "lonely", "left"]:
+            graph.add(package, "1", tmp_path)
+        assert [node.exclusive for node in graph.nodes.values()] == \
+            [True, False, True]
+        graph.run(jobs=4)
+
+        # Blocks with 'run' actions never run alongside anything else
+        assert all(len(packages) == 1 for packages in overlaps)
+
+    def test_fetch_set_env(self, installer, tmp_path, monkeypatch):
+        monkeypatch.delenv("CBDEP_TEST_ENVY", raising=False)
+        graph = DependencyGraph(installer)
+        graph.add("envy", "1", tmp_path)
+
+        # Only installing changes the environment
+        graph.fetch()
+        assert "CBDEP_TEST_ENVY" not in os.environ
+        graph.run()
+        assert os.environ["CBDEP_TEST_ENVY"] == "envy"
+
+    def test_cycle(self, installer, tmp_path):
+        with pytest.raises(SystemExit):
+            DependencyGraph(installer).add("loop", "1", tmp_path)
@@ -0,0 +1,40 @@
+import os
+from cbdep.streaming_extract import StreamingExtractor
+from conftest import make_tarball
+
+
+class TestStreamingExtractor:
+
+    def feed(self, extractor, data, chunk_size=1000):
+        for i in range(0, len(data), chunk_size):
+            extractor.write(data[i:i + chunk_size])
+
+    def test_extract(self, tmp_path):
+        for mode in ["w", "w:gz", "w:bz2", "w:xz"]:
+            archive = tmp_path / f"archive.{mode[2:] or 'tar'}"
+            make_tarball(archive, "top", mode)
+            dest = tmp_path / f"dest-{mode[2:]}"
+            dest.mkdir()
+            extractor = StreamingExtractor(dest)
+            self.feed(extractor, archive.read_bytes())
+            extractor.close()
+            assert extractor.finish()
+            assert (dest / "top" / "README").read_text() == mode
+
+    def test_not_tar(self, tmp_path):
+        extractor = StreamingExtractor(tmp_path)
+        # More data than the queue holds, to check nothing blocks
+        self.feed(extractor, os.urandom(100000), chunk_size=100)
+        extractor.close()
+        assert not extractor.finish()
+        assert extractor.error is not None
+
+    def test_abort(self, tmp_path):
+        archive = tmp_path / "archive.tar.gz"
+        make_tarball(archive, "top", "x" * 100000)
+        dest = tmp_path / "dest"
+        dest.mkdir()
+        extractor = StreamingExtractor(dest)
+        self.feed(extractor, archive.read_bytes()[:500])
+        extractor.abort()
+        assert not extractor.finish()
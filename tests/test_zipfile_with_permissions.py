@@ -0,0 +1,31 @@
+import os
+import stat
+import zipfile
+from cbdep.zipfile_with_permissions import ZipFileWithPermissions
+
+
+def make_zip(path, count):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(zipfile.ZipInfo("top/"), "")
+        for i in range(count):
+            info = zipfile.ZipInfo(f"top/sub{i % 3}/file{i}")
+            info.create_system = 3
+            info.external_attr = (0o755 if i % 2 else 0o644) << 16
+            zf.writestr(info, os.urandom(1000 * i), zipfile.ZIP_DEFLATED)
+
+
+class TestZipFileWithPermissions:
+
+    def test_extractall_parallel(self, tmp_path):
+        archive = tmp_path / "test.zip"
+        make_zip(archive, 20)
+        with ZipFileWithPermissions(archive) as zf:
+            zf.extractall(tmp_path / "serial")
+            zf.extractall_parallel(tmp_path / "parallel", workers=4)
+        for i in range(20):
+            name = f"top/sub{i % 3}/file{i}"
+            serial = tmp_path / "serial" / name
+            parallel = tmp_path / "parallel" / name
+            assert parallel.read_bytes() == serial.read_bytes()
+            mode = stat.S_IMODE(parallel.stat().st_mode)
+            assert mode == (0o755 if i % 2 else 0o644)